@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""Measure what compressed downloads save and what they cost.
+
+Serves text-heavy files (CSV, JSON, logs, HTML) and, for comparison,
+random bytes from a local origin that honours ‘Accept-Encoding’, and
+downloads each of them through ‘url.Url’ once per content coding
+available (see ‘codings’).  Reports, per file and coding, the bytes
+that crossed the network, the time taken and the CPU time the client
+spent (mostly decoding).  The origin compresses ahead of time, so its
+own CPU time is not counted.  With --bandwidth the origin sends no
+faster than that many bytes per second, as over a slow link.
+
+    python bench_compression.py --size 8388608 --bandwidth 10000000
+"""
+
+import argparse
+import gzip
+import http.server
+import json
+import os
+import random
+import threading
+import time
+import zlib
+from unittest.mock import patch
+
+import url as urlm
+import codings
+
+
+def make_corpus(size, seed):
+    """Return sample files of about SIZE bytes, by name."""
+
+    rng = random.Random(seed)
+    words = ['alpha', 'beta', 'gamma', 'delta', 'error', 'warning', 'user',
+             'request', 'upload', 'drive', 'folder', 'chunk', 'session']
+
+    def fill(line):
+        parts, total = [], 0
+        while total < size:
+            parts.append(line(len(parts)))
+            total += len(parts[-1])
+        return ''.join(parts).encode()[:size]
+
+    return {
+        'data.csv': fill(lambda i: '{},{},{:.4f},{}\n'.format(
+            i, rng.choice(words), rng.random() * 1000,
+            rng.randrange(10 ** 6))),
+        'data.json': fill(lambda i: json.dumps(
+            {'id': i, 'name': rng.choice(words), 'size': rng.randrange(10 ** 9),
+             'tags': rng.sample(words, 3)}) + ',\n'),
+        'server.log': fill(lambda i: '2024-01-01T00:{:02}:{:02}Z {} {} {}ms\n'
+                           .format(i // 60 % 60, i % 60,
+                                   rng.choice(('INFO', 'WARN', 'ERROR')),
+                                   ' '.join(rng.sample(words, 4)),
+                                   rng.randrange(500))),
+        'index.html': fill(lambda i: '<tr><td><a href="/f/{0}">{1} {0}</a>'
+                           '</td><td>{2}</td></tr>\n'.format(
+                               i, rng.choice(words), rng.randrange(10 ** 6))),
+        'random.bin': bytes(rng.getrandbits(8) for _ in range(size)),
+    }
+
+
+def compressors():
+    """Return functions compressing a whole body, by content coding."""
+
+    found = {'gzip': gzip.compress,
+             'deflate': zlib.compress}
+    if 'br' in codings.CODINGS:
+        found['br'] = codings.brotli.compress
+    if 'zstd' in codings.CODINGS:
+        from compression import zstd
+        found['zstd'] = zstd.compress
+    return found
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    """Serves the corpus, compressed with the first coding accepted."""
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def do_GET(self):
+        name = self.path.lstrip('/')
+        bodies = self.server.bodies.get(name)
+        if bodies is None:
+            self.send_error(404)
+            return
+
+        accepted = [coding.strip().split(';')[0] for coding in
+                    (self.headers.get('Accept-Encoding') or '').split(',')]
+        coding = next((c for c in accepted if c in bodies), 'identity')
+        body = bodies[coding]
+
+        self.send_response(200)
+        if coding != 'identity':
+            self.send_header('Content-Encoding', coding)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.server.sent[name] = len(body)
+
+        bandwidth = self.server.bandwidth
+        start = time.perf_counter()
+        for offset in range(0, len(body), urlm.COPY_BUFSIZE):
+            self.wfile.write(body[offset:offset + urlm.COPY_BUFSIZE])
+            if bandwidth:
+                ahead = (offset + urlm.COPY_BUFSIZE) / bandwidth \
+                    - (time.perf_counter() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+
+def measure(root, name, original, server, coding, rounds):
+    """Download NAME accepting only CODING.  Return the measurements."""
+
+    accepted = {} if coding == 'identity' \
+        else {coding: codings.CODINGS[coding]}
+    seconds = cpu = 0.0
+    with patch.dict('codings.CODINGS', accepted, clear=True):
+        for _ in range(rounds):
+            url = urlm.Url(root + name, 'token')
+            start, start_cpu = time.perf_counter(), time.thread_time()
+            filename, _ = url.download()
+            seconds += time.perf_counter() - start
+            cpu += time.thread_time() - start_cpu
+            with open(filename, 'rb') as f:
+                if f.read() != original:
+                    raise RuntimeError('{} differs after {}'.format(name,
+                                                                    coding))
+            os.remove(filename)
+
+    return {'wire_bytes': server.sent[name],
+            'ratio': len(original) / server.sent[name],
+            'seconds': seconds / rounds,
+            'cpu_ms': 1000 * cpu / rounds}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size', type=int, default=4 * 1024 * 1024,
+                        help='bytes per file')
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help='bytes per second the origin sends (0: no '
+                        'limit)')
+    parser.add_argument('--rounds', type=int, default=3,
+                        help='downloads per file and coding')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.size, args.seed)
+    found = compressors()
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    server.daemon_threads = True
+    server.bandwidth = args.bandwidth
+    server.sent = {}
+    server.bodies = {name: dict({coding: compress(data)
+                                 for coding, compress in found.items()},
+                                identity=data)
+                     for name, data in corpus.items()}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    root = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+
+    results = {}
+    try:
+        for name, data in corpus.items():
+            for coding in ['identity'] + list(found):
+                results[name, coding] = measure(root, name, data, server,
+                                                coding, args.rounds)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    if args.json:
+        print(json.dumps([dict(r, file=name, coding=coding)
+                          for (name, coding), r in results.items()],
+                         indent=2))
+        return
+
+    print('{} byte files, {}'.format(
+        args.size, '{:.0f} B/s'.format(args.bandwidth) if args.bandwidth
+        else 'no bandwidth limit'))
+    print('{:12} {:9} {:>11} {:>7} {:>9} {:>9} {:>8}'.format(
+        'file', 'coding', 'wire bytes', 'ratio', 'saved', 's', 'CPU ms'))
+    for (name, coding), r in results.items():
+        print('{:12} {:9} {:>11} {:>7.1f} {:>8.0%} {:>9.3f} {:>8.1f}'.format(
+            name, coding, r['wire_bytes'], r['ratio'],
+            1 - r['wire_bytes'] / args.size, r['seconds'], r['cpu_ms']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""Compare the HTTP/1.1 and HTTP/2 transports of the upload path.
+
+Runs concurrent uploads through ‘url.Url’ against a local stand-in for
+the Drive API (‘fake_drive.StandInServer’) and reports, per transport,
+the number of connections opened, their mean handshake time, the wall
+time and the throughput.  With --tls (needs the ‘openssl’ command) the
+stand-in uses a throw-away self-signed certificate and ALPN, as
+googleapis.com does.
+
+    python bench_transport.py --uploads 32 --size 4194304 --tls
+"""
+
+import argparse
+import os
+import pathlib
+import shutil
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+from unittest.mock import patch
+
+import url as urlm
+import transport as transportm
+from fake_drive import FakeDrive, StandInServer
+
+
+def make_certificate(directory):
+    """Create a self-signed certificate for 127.0.0.1 in DIRECTORY.
+
+    Returns the paths of the certificate and of its key."""
+
+    cert = os.path.join(directory, 'cert.pem')
+    key = os.path.join(directory, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048',
+                    '-nodes', '-days', '1', '-subj', '/CN=127.0.0.1',
+                    '-addext', 'subjectAltName=IP:127.0.0.1',
+                    '-keyout', key, '-out', cert],
+                   check=True, capture_output=True)
+    return cert, key
+
+
+def run(transport, args, ssl_context, sources):
+    """Upload SOURCES through TRANSPORT.  Return the measurements."""
+
+    drive = FakeDrive(latency=args.latency)
+    server = StandInServer(drive, ssl_context).start()
+    errors = []
+
+    def upload(i, path):
+        try:
+            url_obj = urlm.Url(pathlib.Path(path).as_uri(),
+                               'token{}'.format(i), transport=transport)
+            url_obj.download()
+            url_obj._upload(upload_chunk_size=args.chunk)
+            os.remove(url_obj.filename)
+        except Exception as e:
+            errors.append(e)
+
+    with patch('url.API_ROOT', server.url):
+        threads = [threading.Thread(target=upload, args=item)
+                   for item in enumerate(sources)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+    server.stop()
+
+    if errors:
+        raise RuntimeError('{} uploads failed: {!r}'.format(len(errors),
+                                                            errors[0]))
+
+    handshakes = [seconds for _, seconds in server.connections]
+    return {'connections': len(handshakes),
+            'handshake_ms': 1000 * sum(handshakes) / len(handshakes),
+            'handshake_total_ms': 1000 * sum(handshakes),
+            'seconds': elapsed,
+            'mb_per_s': args.uploads * args.size / elapsed / 1e6}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--uploads', type=int, default=16,
+                        help='concurrent uploads')
+    parser.add_argument('--size', type=int, default=1024 * 1024,
+                        help='bytes per upload')
+    parser.add_argument('--chunk', type=int, default=urlm.UPLOAD_CHUNK_SIZE,
+                        help='upload chunk size')
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='seconds the stand-in spends per request')
+    parser.add_argument('--connections', type=int,
+                        default=transportm.HTTP2_CONNECTIONS,
+                        help='connections kept by the HTTP/2 transport')
+    parser.add_argument('--tls', action='store_true',
+                        help='use TLS with ALPN (needs openssl)')
+    args = parser.parse_args()
+
+    if not transportm.http2_available():
+        parser.error('the HTTP/2 transport needs httpx[http2]')
+
+    directory = tempfile.mkdtemp()
+    try:
+        ssl_context, verify = None, True
+        if args.tls:
+            cert, key = make_certificate(directory)
+            ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            ssl_context.load_cert_chain(cert, key)
+            verify = cert
+            # ‘requests’ picks the CA bundle from the environment.
+            os.environ['REQUESTS_CA_BUNDLE'] = cert
+
+        sources = []
+        for _ in range(args.uploads):
+            with tempfile.NamedTemporaryFile(dir=directory,
+                                             delete=False) as f:
+                f.write(os.urandom(args.size))
+            sources.append(f.name)
+
+        # Every upload uses its own token, so the per-token limits of
+        # ‘ratelimit’ do not serialise the benchmark.
+        results = {}
+        results['http/1.1'] = run(transportm.RequestsTransport(), args,
+                                  ssl_context, sources)
+        http2 = transportm.Http2Transport(connections=args.connections,
+                                          verify=verify,
+                                          http1=args.tls)
+        results['h2'] = run(http2, args, ssl_context, sources)
+        http2.close()
+    finally:
+        shutil.rmtree(directory)
+
+    print('{} uploads of {} bytes in {} byte chunks, {}'.format(
+        args.uploads, args.size, args.chunk,
+        'TLS' if args.tls else 'plain text'))
+    print('{:10} {:>11} {:>14} {:>16} {:>9} {:>8}'.format(
+        'transport', 'connections', 'handshake ms', 'handshakes ms', 's',
+        'MB/s'))
+    for name, r in results.items():
+        print('{:10} {:>11} {:>14.3f} {:>16.1f} {:>9.2f} {:>8.1f}'.format(
+            name, r['connections'], r['handshake_ms'],
+            r['handshake_total_ms'], r['seconds'], r['mb_per_s']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""Cancellation and deadlines of transfers.
+
+A ‘CancelToken’ is handed to ‘url.Url’, which checks it between reads
+from the source and between chunk uploads.  Once the token is cancelled
+or a deadline passes, the transfer stops at the next check, releasing
+its sockets, temporary file and upload session."""
+
+import threading
+import time
+
+
+class Cancelled(RuntimeError):
+    """The transfer was cancelled."""
+
+
+class DeadlineExceeded(Cancelled):
+    """The transfer, or one of its phases, took too long."""
+
+
+class CancelToken:
+    """Cancellation flag with an overall and per-phase deadlines."""
+
+    def __init__(self, deadline=None, phase_deadlines=None):
+        """DEADLINE is the number of seconds the whole transfer may take,
+        counted from now.  PHASE_DEADLINES maps phase names (‘download’,
+        ‘upload’) to the seconds each of them may take once started."""
+
+        now = time.monotonic()
+        self._lock = threading.Lock()
+        self._reason = None
+        self.abandoned = False
+        self._callbacks = []
+        self._deadline = None if deadline is None else now + deadline
+        self._phase_deadlines = dict(phase_deadlines or {})
+        self._phase = None
+        self._phase_deadline = None
+
+
+    @property
+    def cancelled(self):
+        """Whether the transfer must stop."""
+
+        return self._reason is not None or self._expired() is not None
+
+
+    def cancel(self, reason='Transfer cancelled'):
+        """Ask the transfer to stop, giving REASON."""
+
+        with self._lock:
+            if self._reason is not None:
+                return
+            self._reason = reason
+            callbacks, self._callbacks = self._callbacks, []
+
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                pass
+
+
+    def abandon(self, reason='Transfer taken over'):
+        """Stop, leaving the upload session for whoever takes over."""
+
+        self.abandoned = True
+        self.cancel(reason)
+
+
+    def on_cancel(self, callback):
+        """Call CALLBACK once if and when the token is cancelled.
+
+        Returns a function that unregisters it."""
+
+        with self._lock:
+            if self._reason is None:
+                self._callbacks.append(callback)
+                return lambda: self._forget(callback)
+
+        callback()
+        return lambda: None
+
+
+    def _forget(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+
+    def enter_phase(self, phase):
+        """Start PHASE, arming its deadline if there is one."""
+
+        seconds = self._phase_deadlines.get(phase)
+        self._phase = phase
+        self._phase_deadline = None if seconds is None \
+            else time.monotonic() + seconds
+
+
+    def _expired(self):
+        """Return the description of a passed deadline, or None."""
+
+        now = time.monotonic()
+        if self._deadline is not None and now >= self._deadline:
+            return 'Transfer deadline exceeded'
+        if self._phase_deadline is not None and now >= self._phase_deadline:
+            return 'Deadline exceeded while in {}'.format(self._phase)
+        return None
+
+
+    def remaining(self):
+        """Seconds until the nearest deadline, or None if there is none."""
+
+        deadlines = [d for d in (self._deadline, self._phase_deadline)
+                     if d is not None]
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - time.monotonic())
+
+
+    def check(self):
+        """Raise ‘Cancelled’ or ‘DeadlineExceeded’ if it is time to stop."""
+
+        if self._reason is not None:
+            raise Cancelled(self._reason)
+
+        expired = self._expired()
+        if expired is not None:
+            raise DeadlineExceeded(expired)
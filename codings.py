@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""Compressed transfer of downloads (HTTP content codings).
+
+‘url.Url’ asks the origin for a compressed body with ‘Accept-Encoding’
+and decodes it as it arrives, so the file stored is the original one,
+byte for byte, while fewer bytes cross the network.  gzip and deflate
+are always available; br only if a recent enough ‘brotli’ package is
+installed and zstd only with Python’s own ‘compression.zstd’, both of
+them decoding in bounded pieces.
+
+Files that are compressed already, judging by their extension, are
+fetched as they are: compressing them again would cost the origin CPU
+time and save nothing."""
+
+import posixpath
+import urllib.parse
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+else:
+    # Older releases decode a whole block at once, however large.
+    if not hasattr(brotli.Decompressor, 'can_accept_more_data'):
+        brotli = None
+
+try:
+    from compression.zstd import ZstdDecompressor as _zstd_decompressor
+except ImportError:
+    _zstd_decompressor = None
+
+
+# Extensions of files that are not worth asking to compress.
+COMPRESSED_EXTENSIONS = frozenset((
+    '.gz', '.tgz', '.bz2', '.tbz2', '.xz', '.txz', '.zst', '.br', '.lz',
+    '.lzma', '.z', '.zip', '.7z', '.rar', '.jar', '.apk', '.whl',
+    '.deb', '.rpm', '.dmg', '.iso', '.jpg', '.jpeg', '.png', '.gif',
+    '.webp', '.avif', '.heic', '.mp3', '.aac', '.ogg', '.opus', '.flac',
+    '.mp4', '.m4a', '.m4v', '.mkv', '.webm', '.mov', '.avi', '.pdf',
+    '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.epub', '.woff2'))
+
+# Most bytes decoded at once.  A few compressed bytes may decode to
+# gigabytes; they are handed on in pieces no larger than this.
+MAX_PIECE = 256 * 1024
+
+# Most codings applied one over the other that are accepted.  Each
+# one multiplies what a small body may decode to.
+MAX_CODINGS = 2
+
+
+class _Zlib:
+    """Decoders built on ‘zlib’, which keep the input left over when
+    they stop at MAX_LENGTH bytes of output."""
+
+    def __init__(self, wbits):
+        self._decompressor = zlib.decompressobj(wbits)
+        self._tail = b''
+
+
+    @property
+    def eof(self):
+        return self._decompressor.eof
+
+
+    def _decompress(self, data, max_length):
+        output = self._decompressor.decompress(self._tail + data, max_length)
+        self._tail = self._decompressor.unconsumed_tail
+        return output
+
+
+class _Gzip(_Zlib):
+    """gzip, possibly as several members one after the other."""
+
+    def __init__(self):
+        super().__init__(16 + zlib.MAX_WBITS)
+
+
+    def decompress(self, data, max_length):
+        output = self._decompress(data, max_length)
+        while self._decompressor.eof and self._decompressor.unused_data \
+              and len(output) < max_length:
+            data = self._decompressor.unused_data
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            output += self._decompress(data, max_length - len(output))
+        return output
+
+
+class _Deflate(_Zlib):
+    """deflate: zlib data, or raw deflate as some servers send."""
+
+    def __init__(self):
+        super().__init__(zlib.MAX_WBITS)
+        self._started = False
+
+
+    def decompress(self, data, max_length):
+        if self._started or not data:
+            return self._decompress(data, max_length)
+
+        self._started = True
+        try:
+            return self._decompress(data, max_length)
+        except zlib.error:
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self._decompress(data, max_length)
+
+
+class _Brotli:
+
+    def __init__(self):
+        self._decompressor = brotli.Decompressor()
+
+
+    @property
+    def eof(self):
+        return self._decompressor.is_finished()
+
+
+    def decompress(self, data, max_length):
+        if self.eof or (not data
+                        and self._decompressor.can_accept_more_data()):
+            return b''
+        return self._decompressor.process(data,
+                                          output_buffer_limit=max_length)
+
+
+class _Zstd:
+
+    def __init__(self):
+        self._decompressor = _zstd_decompressor()
+
+
+    @property
+    def eof(self):
+        return self._decompressor.eof
+
+
+    def decompress(self, data, max_length):
+        if self.eof:
+            return b''
+        return self._decompressor.decompress(data, max_length)
+
+
+# Decoders of the content codings that can be accepted.  Each one’s
+# ‘decompress(data, max_length)’ returns at most MAX_LENGTH bytes and
+# keeps the rest of DATA for the next calls, with no more data.
+CODINGS = {'gzip': _Gzip, 'deflate': _Deflate}
+if _zstd_decompressor is not None:
+    CODINGS['zstd'] = _Zstd
+if brotli is not None:
+    CODINGS['br'] = _Brotli
+
+
+def accept_encoding(url):
+    """Return the ‘Accept-Encoding’ to send for URL, or None.
+
+    None means the file is fetched as it is: URL is not an HTTP one or
+    its file is compressed already."""
+
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not CODINGS:
+        return None
+    if posixpath.splitext(parts.path)[1].lower() in COMPRESSED_EXTENSIONS:
+        return None
+
+    return ', '.join(CODINGS)
+
+
+class Decoder:
+    """Decodes a body sent with a ‘Content-Encoding’, block by block.
+
+    Raises RuntimeError if the coding is not one of CODINGS, if more
+    than MAX_CODINGS are stacked, if the body is corrupt, or, from
+    ‘finish’, if it ended early."""
+
+    def __init__(self, content_encoding):
+        # Codings are listed in the order they were applied.
+        self.codings = [coding.strip().lower()
+                        for coding in content_encoding.split(',')
+                        if coding.strip().lower() not in ('', 'identity')]
+        unknown = [coding for coding in self.codings
+                   if coding not in CODINGS]
+        if unknown:
+            raise RuntimeError('Unsupported Content-Encoding: {}'
+                               .format(', '.join(unknown)))
+        if len(self.codings) > MAX_CODINGS:
+            raise RuntimeError('Too many content codings: {}'
+                               .format(content_encoding))
+        self._decoders = [CODINGS[coding]()
+                          for coding in reversed(self.codings)]
+
+
+    def decode(self, data):
+        """Yield what DATA, the next block of the body, decodes to, in
+        pieces of at most MAX_PIECE bytes."""
+
+        try:
+            yield from self._pieces(data, self._decoders)
+        except Exception as e:
+            raise RuntimeError('Corrupt {} body: {}'.format(
+                ', '.join(self.codings), e)) from e
+
+
+    def _pieces(self, data, decoders):
+        if not decoders:
+            yield data
+            return
+
+        while True:
+            piece = decoders[0].decompress(data, MAX_PIECE)
+            if not piece:
+                return
+            data = b''
+            yield from self._pieces(piece, decoders[1:])
+
+
+    def finish(self):
+        """Check that the whole body was decoded."""
+
+        if not all(decoder.eof for decoder in self._decoders):
+            raise RuntimeError('Compressed body ended early')
+
+
+def decoder(response):
+    """Return a ‘Decoder’ for the body of RESPONSE, or None if it is
+    not encoded."""
+
+    content_encoding = response.headers.get('Content-Encoding')
+    if not content_encoding:
+        return None
+
+    result = Decoder(content_encoding)
+    return result if result.codings else None
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""Content-addressed deduplication of uploads.
+
+Each user has an index mapping the (MD5, size) of every file uploaded
+through the application to its Drive file id.  Before uploading, the
+index is consulted and the candidate is verified against the files API,
+so a file that is already in the user’s Drive is not sent again."""
+
+import hashlib
+import json
+import logging as log
+import os
+import tempfile
+import threading
+
+import ratelimit
+import transport as transportm
+import url as urlm
+
+
+# Where the per-user indexes are kept by default.  On App Engine only
+# the temporary directory is writable.
+DEFAULT_DIRECTORY = os.path.join(tempfile.gettempdir(), 'driveet-dedup')
+
+HASH_BUFSIZE = 1024 * 1024
+
+# The indexes handed out by ‘DedupIndex.for_user’, by path.
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def fingerprint(filename):
+    """Return the (MD5 hex digest, size) of the contents of FILENAME."""
+
+    md5 = hashlib.md5()
+    size = 0
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BUFSIZE), b''):
+            md5.update(block)
+            size += len(block)
+
+    return md5.hexdigest(), size
+
+
+def verify(file_id, fp, token, transport=None, cancel=None):
+    """Tell if FILE_ID still is in Drive with fingerprint FP.
+
+    Files that were trashed, deleted or changed do not count.  The
+    call goes through TRANSPORT, the process-wide default if not
+    given, within the limits of TOKEN and the deadline of CANCEL.
+    Network errors are raised as they are (see ‘transport.ERRORS’)."""
+
+    if transport is None:
+        transport = transportm.default()
+    response = ratelimit.send(
+        transport.get, urlm.API_ROOT + '/drive/v3/files/' + file_id, token,
+        cancel=cancel, timeout=urlm.API_TIMEOUT,
+        params={'fields': 'id,md5Checksum,size,trashed'},
+        headers={'Authorization': 'Bearer ' + token})
+
+    if response.status_code != 200:
+        return False
+
+    metadata = response.json()
+    md5, size = fp
+    return (not metadata.get('trashed')
+            and metadata.get('md5Checksum') == md5
+            and str(metadata.get('size')) == str(size))
+
+
+class DedupIndex:
+    """Persistent (MD5, size) → Drive file id index of one user."""
+
+    fingerprint = staticmethod(fingerprint)
+
+    def __init__(self, path):
+        """Keep the index in the JSON file at PATH."""
+
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = None
+
+
+    @classmethod
+    def for_user(cls, user_key, directory=DEFAULT_DIRECTORY):
+        """Return the index of the user identified by USER_KEY.
+
+        Every call for the same user gets the same index, so that
+        concurrent transfers see each other’s additions."""
+
+        os.makedirs(directory, exist_ok=True)
+        name = hashlib.sha256(user_key.encode()).hexdigest() + '.json'
+        path = os.path.join(directory, name)
+        with _indexes_lock:
+            if path not in _indexes:
+                _indexes[path] = cls(path)
+            return _indexes[path]
+
+
+    @staticmethod
+    def _key(fp):
+        md5, size = fp
+        return '{}:{}'.format(md5, size)
+
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self.path) as f:
+                    self._entries = json.load(f)
+            except FileNotFoundError:
+                self._entries = {}
+            except ValueError:
+                log.error('Corrupt dedup index {}, starting over'
+                          .format(self.path))
+                self._entries = {}
+
+        return self._entries
+
+
+    def _save(self):
+        # Write to a temporary file first so that a crash never leaves
+        # a truncated index behind.
+        directory = os.path.dirname(self.path) or '.'
+        with tempfile.NamedTemporaryFile('w', dir=directory,
+                                         delete=False) as f:
+            json.dump(self._entries, f)
+        os.replace(f.name, self.path)
+
+
+    def find(self, fp, token, transport=None, cancel=None):
+        """Return the id of a Drive file with fingerprint FP, or None.
+
+        The candidate is checked against the API with TOKEN, through
+        TRANSPORT and within the deadline of CANCEL (see ‘verify’);
+        stale entries are dropped from the index.  If the check cannot
+        be made, the entry is kept and None is returned."""
+
+        with self._lock:
+            file_id = self._load().get(self._key(fp))
+
+        if file_id is None:
+            return None
+
+        try:
+            if verify(file_id, fp, token, transport, cancel):
+                return file_id
+        except transportm.ERRORS as e:
+            log.error('Could not check {} in Drive: {}'.format(file_id, e))
+            return None
+
+        with self._lock:
+            if self._load().get(self._key(fp)) == file_id:
+                del self._entries[self._key(fp)]
+                self._save()
+
+        return None
+
+
+    def add(self, fp, file_id):
+        """Record that FILE_ID has fingerprint FP."""
+
+        with self._lock:
+            self._load()[self._key(fp)] = file_id
+            self._save()
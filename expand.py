@@ -0,0 +1,457 @@
+# -*- coding: utf-8 -*-
+"""Expansion of archives into Drive, member by member.
+
+The archive is never extracted to disk.  A tar archive (compressed or
+not) is read as a stream and each member is piped straight into its own
+resumable upload (see ‘url.Url.upload_stream’); the reader moves on to
+the next member as soon as the previous one is in its pipe, so small
+members upload in parallel.  A zip archive is opened through its
+central directory with ranged reads of the source, so every worker
+reads only the members it uploads.
+
+Memory is bounded by the number of members in flight: each holds a
+pipe of PIPE_BLOCKS blocks and an upload chunk."""
+
+import concurrent.futures
+import functools
+import io
+import logging as log
+import os
+import posixpath
+import queue
+import tarfile
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+import zipfile
+
+import url as urlm
+import cancellation
+import folders
+import origins
+import tracing
+import transport as transportm
+
+
+TAR_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz',
+                '.txz')
+ZIP_SUFFIXES = ('.zip',)
+
+# Blocks of ‘url.COPY_BUFSIZE’ bytes buffered between the tar reader
+# and the upload of each member.
+PIPE_BLOCKS = 16
+
+# Bytes fetched by each ranged read of a remote zip archive.
+RANGE_BLOCK = 1024 * 1024
+
+# Seconds allowed for opening the source or for one ranged read.
+TIMEOUT = 30
+
+
+def archive_kind(url):
+    """Return ‘tar’ or ‘zip’ after the name in URL, or None."""
+
+    path = urllib.parse.urlparse(url).path.lower()
+    if path.endswith(TAR_SUFFIXES):
+        return 'tar'
+    if path.endswith(ZIP_SUFFIXES):
+        return 'zip'
+    return None
+
+
+def _top_name(url):
+    """Name of the folder for the archive at URL: its name, sans suffix."""
+
+    name = urllib.parse.unquote(
+        posixpath.basename(urllib.parse.urlparse(url).path))
+    for suffix in TAR_SUFFIXES + ZIP_SUFFIXES:
+        if name.lower().endswith(suffix):
+            return name[:-len(suffix)] or name
+    return name or 'archive'
+
+
+def _member_path(name):
+    """Return the relative path of member NAME, or None if it is unsafe."""
+
+    path = posixpath.normpath(name.replace('\\', '/')).lstrip('/')
+    if path in ('', '.') or path == '..' or path.startswith('../'):
+        return None
+    return path
+
+
+class _Broken(Exception):
+    """The upload reading from a pipe is gone."""
+
+
+class _Pipe:
+    """Bounded pipe of blocks from the archive reader to one upload."""
+
+    def __init__(self, blocks=PIPE_BLOCKS):
+        self._queue = queue.Queue(blocks)
+        self._pending = b''
+        self._error = None
+        self._eof = False
+        self.broken = False
+
+
+    def write(self, block):
+        """Queue BLOCK, waiting for room.  Raises ‘_Broken’."""
+
+        while True:
+            if self.broken:
+                raise _Broken()
+            try:
+                self._queue.put(block, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+
+    def close(self, error=None):
+        """Mark the end of the data, or that reading it failed with ERROR."""
+
+        self._error = error
+        try:
+            self.write(None)
+        except _Broken:
+            pass
+
+
+    def read(self, size):
+        while not self._pending and not self._eof:
+            block = self._queue.get()
+            if block is None:
+                self._eof = True
+                if self._error is not None:
+                    raise RuntimeError(self._error)
+            else:
+                self._pending = block
+
+        data, self._pending = self._pending[:size], self._pending[size:]
+        return data
+
+
+class RangeFile(io.RawIOBase):
+    """Seekable, read-only file on an HTTP(S) URL, through ranged GETs.
+
+    Wrap it in ‘io.BufferedReader’ so that small reads are batched."""
+
+    def __init__(self, url, size):
+        self.url = url
+        self.size = size
+        self._position = 0
+
+
+    def readable(self):
+        return True
+
+
+    def seekable(self):
+        return True
+
+
+    def tell(self):
+        return self._position
+
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self._position = max(0, offset)
+        return self._position
+
+
+    def readinto(self, buffer):
+        if self._position >= self.size or not len(buffer):
+            return 0
+
+        last = min(self._position + len(buffer), self.size) - 1
+        request = urllib.request.Request(self.url, headers={
+            'Range': 'bytes={}-{}'.format(self._position, last)})
+        try:
+            with origins.urlopen(request, timeout=TIMEOUT) as response:
+                if response.status != 206:
+                    raise RuntimeError('{} ignores ranged reads'
+                                       .format(self.url))
+                data = response.read(last - self._position + 1)
+        except urllib.error.URLError as e:
+            msg = 'Problems reading {}: {}'.format(self.url, e)
+            log.error(msg)
+            raise RuntimeError(msg) from e
+
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+
+def _ranges(url):
+    """Return the size of URL if it can be read in ranges, else None."""
+
+    try:
+        request = urllib.request.Request(url, method='HEAD')
+        with origins.urlopen(request, timeout=TIMEOUT) as response:
+            headers = response.headers
+    except Exception:
+        return None
+
+    length = headers.get('Content-Length')
+    if headers.get('Accept-Ranges') != 'bytes' or length is None \
+       or not length.isdigit():
+        return None
+    return int(length)
+
+
+class ExpandResult:
+    """Outcome of an ‘Expand.run()’: member paths by what happened."""
+
+    def __init__(self):
+        self.transferred = []
+        self.failed = []
+
+
+    def summary(self):
+        msg = 'Expanded {} files'.format(len(self.transferred))
+        if self.failed:
+            msg += ', {} failed'.format(len(self.failed))
+        return msg + '.'
+
+
+class Expand:
+    """Expansion of the archive at a URL into a Drive folder."""
+
+    def __init__(self, url, token, workers=4, folder_name=None,
+                 progress=None, cancel=None, transport=None):
+        """Expand the archive at URL with TOKEN.
+
+        WORKERS members are uploaded at once.  FOLDER_NAME is the name
+        of the Drive folder the members go to, by default the name of
+        the archive.  PROGRESS, if given, counts the members done, and
+        CANCEL stops the expansion."""
+
+        self.url = url
+        self.token = token
+        self.workers = workers
+        self.folder_name = folder_name
+        self.progress = progress
+        self.cancel = cancel
+        self.transport = transport if transport is not None \
+            else transportm.default()
+        self._lock = threading.Lock()
+        self._result = None
+        self._done = 0
+
+
+    def _check(self):
+        if self.cancel is not None:
+            self.cancel.check()
+
+
+    def _upload_member(self, path, stream, size):
+        """Upload SIZE bytes of STREAM as the file at PATH."""
+
+        self._check()
+        parent = self.folders.get(posixpath.dirname(path))
+
+        # Each member gets a token of its own, for its phases;
+        # cancelling the expansion cancels them all.
+        cancel = cancellation.CancelToken(
+            None if self.cancel is None else self.cancel.remaining())
+        forget = lambda: None
+        if self.cancel is not None:
+            forget = self.cancel.on_cancel(cancel.cancel)
+        try:
+            url = urlm.Url(self.url, self.token, cancel=cancel,
+                           transport=self.transport,
+                           name=posixpath.basename(path), parents=[parent])
+            return url.upload_stream(stream, size)
+        finally:
+            forget()
+
+
+    def _finished(self, path, future):
+        """Record the outcome of the upload of PATH."""
+
+        with self._lock:
+            try:
+                future.result()
+            except (concurrent.futures.CancelledError,
+                    cancellation.Cancelled):
+                pass
+            except RuntimeError as e:
+                self._result.failed.append((path, str(e)))
+            except Exception:
+                log.exception('Expanding {} failed'.format(path))
+                self._result.failed.append((path, 'Unexpected error'))
+            else:
+                self._result.transferred.append(path)
+
+            self._done += 1
+            if self.progress is not None:
+                self.progress.update(self._done)
+
+
+    def _member_done(self, slots, pipe, path, future):
+        # Stops the reader from feeding a failed upload.
+        pipe.broken = True
+        slots.release()
+        self._finished(path, future)
+
+
+    def _expand_tar(self, pool):
+        slots = threading.BoundedSemaphore(self.workers)
+        try:
+            response = origins.urlopen(self.url, timeout=TIMEOUT)
+        except (ValueError, urllib.error.URLError) as e:
+            msg = 'Problems accessing URL: {}'.format(e)
+            log.error(msg)
+            raise RuntimeError(msg) from e
+
+        if self.progress is not None:
+            self.progress.start('expand')
+
+        try:
+            with response, tarfile.open(fileobj=response, mode='r|*') as tar:
+                for member in tar:
+                    self._check()
+                    path = _member_path(member.name)
+                    if not member.isfile() or path is None:
+                        continue
+
+                    # Wait for one of the members in flight to finish.
+                    while not slots.acquire(timeout=0.1):
+                        self._check()
+
+                    pipe = _Pipe()
+                    future = pool.submit(tracing.bind(self._upload_member),
+                                         path, pipe, member.size)
+                    future.add_done_callback(functools.partial(
+                        self._member_done, slots, pipe, path))
+
+                    source = tar.extractfile(member)
+                    try:
+                        for block in iter(
+                                lambda: source.read(urlm.COPY_BUFSIZE), b''):
+                            pipe.write(block)
+                    except _Broken:
+                        # The upload failed; the rest of the member is
+                        # skipped by the next iteration.
+                        continue
+                    except Exception as e:
+                        # Do not leave the upload waiting for the rest.
+                        pipe.close('Problems reading the archive: {}'
+                                   .format(e))
+                        raise
+                    pipe.close()
+        except (tarfile.TarError, OSError, EOFError) as e:
+            msg = 'Problems reading tar archive: {}'.format(e)
+            log.error(msg)
+            raise RuntimeError(msg) from e
+
+
+    def _zip_opener(self):
+        """Return a function opening the zip archive, and a cleanup one.
+
+        Remote archives are read in ranges when the server allows it;
+        otherwise, or for other schemes, the archive is downloaded
+        once."""
+
+        parsed = urllib.parse.urlparse(self.url)
+        if parsed.scheme == 'file':
+            path = urllib.request.url2pathname(parsed.path)
+            return lambda: open(path, 'rb'), lambda: None
+
+        size = _ranges(self.url) if parsed.scheme in ('http', 'https') \
+            else None
+        if size is not None:
+            return (lambda: io.BufferedReader(RangeFile(self.url, size),
+                                              RANGE_BLOCK),
+                    lambda: None)
+
+        archive = urlm.Url(self.url, self.token, cancel=self.cancel)
+        filename = archive.download()[0]
+        return lambda: open(filename, 'rb'), lambda: os.remove(filename)
+
+
+    def _expand_zip(self, pool):
+        opener, cleanup = self._zip_opener()
+        local = threading.local()
+        opened = []
+        opened_lock = threading.Lock()
+
+        def upload(info, path):
+            # zipfile objects are not safe to share between threads:
+            # each worker reads through its own.
+            archive = getattr(local, 'archive', None)
+            if archive is None:
+                archive = local.archive = zipfile.ZipFile(opener())
+                with opened_lock:
+                    opened.append(archive)
+            with archive.open(info) as stream:
+                return self._upload_member(path, stream, info.file_size)
+
+        try:
+            try:
+                with zipfile.ZipFile(opener()) as archive:
+                    infos = archive.infolist()
+            except (zipfile.BadZipFile, OSError) as e:
+                msg = 'Problems reading zip archive: {}'.format(e)
+                log.error(msg)
+                raise RuntimeError(msg) from e
+
+            members = [(info, _member_path(info.filename)) for info in infos
+                       if not info.is_dir()]
+            members = [(info, path) for info, path in members
+                       if path is not None]
+            if self.progress is not None:
+                self.progress.start('expand', len(members))
+
+            futures = []
+            for info, path in members:
+                future = pool.submit(tracing.bind(upload), info, path)
+                future.add_done_callback(
+                    lambda future, path=path: self._finished(path, future))
+                futures.append(future)
+
+            # Queued members are dropped as soon as the expansion is
+            # cancelled.
+            if self.cancel is not None:
+                self.cancel.on_cancel(
+                    lambda: [future.cancel() for future in futures])
+            concurrent.futures.wait(futures)
+        finally:
+            with opened_lock:
+                for archive in opened:
+                    archive.close()
+            cleanup()
+
+
+    @tracing.traced('expand')
+    def run(self):
+        """Expand the archive.  Return an ‘ExpandResult’.
+
+        Members that fail are reported in the result.  Raises
+        RuntimeError if the archive cannot be read, and
+        ‘cancellation.Cancelled’ if the expansion was cancelled."""
+
+        kind = archive_kind(self.url)
+        if kind is None:
+            msg = 'Not a tar or zip archive: {}'.format(self.url)
+            log.error(msg)
+            raise RuntimeError(msg)
+
+        self.folders = folders.FolderTree(
+            self.token, self.folder_name or _top_name(self.url),
+            transport=self.transport)
+        self._result = ExpandResult()
+        self._done = 0
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+            if kind == 'tar':
+                self._expand_tar(pool)
+            else:
+                self._expand_zip(pool)
+
+        self._check()
+        return self._result
@@ -0,0 +1,639 @@
+# -*- coding: utf-8 -*-
+"""Local stand-in for the parts of the Google Drive API used here.
+
+It is meant for tests and benchmarks: point ‘url.API_ROOT’ at
+‘FakeDrive().url’ and the upload path talks to it instead of Google.
+
+    with FakeDrive() as drive:
+        with patch('url.API_ROOT', drive.url):
+            ...
+
+‘StandInServer’ serves the same fake over HTTP/2 as well, which needs
+the optional ‘h2’ package.
+"""
+
+import email.message
+import email.parser
+import email.policy
+import hashlib
+import http.client
+import http.server
+import itertools
+import json
+import re
+import socket
+import threading
+import time
+import urllib.parse
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.events
+    import h2.exceptions
+    import h2.settings
+except ImportError:
+    h2 = None
+
+
+UPLOAD_PATH = '/upload/drive/v3/files'
+FILES_PATH = '/drive/v3/files'
+ABOUT_PATH = '/drive/v3/about'
+BATCH_PATH = '/batch/drive/v3'
+
+# The most calls the batch endpoint takes at once.
+BATCH_LIMIT = 100
+
+
+def _encode(body):
+    """Return the bytes of BODY, JSON unless it is bytes already."""
+
+    if body is None:
+        return b''
+    return body if isinstance(body, bytes) else json.dumps(body).encode()
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    """Route requests to the owning ‘FakeDrive’."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+
+    def _reply(self, status, body=None, headers=None):
+        data = _encode(body)
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if body is not None and not isinstance(body, bytes):
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+    def _dispatch(self):
+        parsed = urllib.parse.urlparse(self.path)
+        query = dict(urllib.parse.parse_qsl(parsed.query))
+        self._reply(*self.server.drive.serve(
+            self.command, parsed.path, query, self.headers, self._body(),
+            getattr(self.server, 'base', None)))
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _dispatch
+
+
+class FakeDrive:
+    """In-memory Drive with resumable uploads and file metadata.
+
+    ‘files’ maps file ids to their metadata, ‘content’ maps them to
+    the uploaded bytes and ‘permissions’ to the permissions granted.
+    ‘requests’ records every (method, path) seen, including those of
+    the calls in batches, and ‘bytes_received’ counts the upload
+    payload bytes.
+
+    The calls of a batch answer in turn with the statuses put in
+    ‘item_errors’, if any, as if they had failed; None lets a call
+    through.
+
+    To stand in for the API’s rate limits, requests beyond
+    MAX_IN_FLIGHT concurrent ones are answered with THROTTLE_STATUS
+    (403 ‘userRateLimitExceeded’ or 429); LATENCY seconds are spent on
+    every other request.  ‘throttled’ counts those answers and
+    ‘max_seen’ the highest concurrency observed.
+
+    Without KEEP_CONTENT, uploaded bytes are only counted and hashed,
+    e.g. for load tests with large files."""
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0,
+                 max_in_flight=None, throttle_status=403,
+                 keep_content=True):
+        self.lock = threading.RLock()
+        self.keep_content = keep_content
+        self.files = {}
+        self.content = {}
+        self.permissions = {}
+        self.item_errors = []
+        # Drive permission ids of access tokens; others get one each.
+        self.users = {}
+        self.requests = []
+        self.bytes_received = 0
+        self.latency = latency
+        self.max_in_flight = max_in_flight
+        self.throttle_status = throttle_status
+        self.in_flight = 0
+        self.max_seen = 0
+        self.throttled = 0
+        self._sessions = {}
+        self._ids = itertools.count(1)
+
+        self._server = http.server.ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.drive = self
+        self._thread = None
+
+
+    @property
+    def url(self):
+        """Root URL to be used in place of ‘url.API_ROOT’."""
+
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+    def __enter__(self):
+        return self.start()
+
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+    def count(self, method, path_prefix=''):
+        """Number of requests seen for METHOD under PATH_PREFIX."""
+
+        with self.lock:
+            return sum(1 for m, p in self.requests
+                       if m == method and p.startswith(path_prefix))
+
+
+    def add_file(self, data, name='file', **metadata):
+        """Store DATA as a new file and return its metadata."""
+
+        with self.lock:
+            file_id = 'fake{}'.format(next(self._ids))
+            self.files[file_id] = dict(
+                {'id': file_id,
+                 'name': name,
+                 'md5Checksum': hashlib.md5(data).hexdigest(),
+                 'size': str(len(data)),
+                 'trashed': False},
+                **metadata)
+            self.content[file_id] = data
+            return self.files[file_id]
+
+
+    def serve(self, method, path, query, headers, body, base=None):
+        """Record, maybe throttle, and answer a request.
+
+        BASE is the root URL the client used, if it is not ‘url’.
+        Returns (status, json body, headers); the body of batch answers
+        is bytes instead."""
+
+        with self.lock:
+            self.requests.append((method, path))
+            self.in_flight += 1
+            self.max_seen = max(self.max_seen, self.in_flight)
+            throttle = (self.max_in_flight is not None
+                        and self.in_flight > self.max_in_flight)
+            if throttle:
+                self.throttled += 1
+        try:
+            if throttle:
+                return self.throttle_reply()
+            time.sleep(self.latency)
+            return self.handle(method, path, query, headers, body, base)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+    def throttle_reply(self, status=None):
+        """Answer of the API when asked to slow down."""
+
+        if (status or self.throttle_status) == 429:
+            return 429, {'error': {'code': 429,
+                                   'message': 'Too Many Requests'}}, None
+
+        reason = 'userRateLimitExceeded'
+        return 403, {'error': {'code': 403,
+                               'message': 'User Rate Limit Exceeded',
+                               'errors': [{'domain': 'usageLimits',
+                                           'reason': reason}]}}, None
+
+
+    def handle(self, method, path, query, headers, body, base=None):
+        """Answer a request.  Return (status, json body, headers)."""
+
+        if path == BATCH_PATH and method == 'POST':
+            return self._batch(headers, body)
+        with self.lock:
+            if path == UPLOAD_PATH and method == 'POST':
+                return self._create_session(query, headers, body, base)
+            if path == UPLOAD_PATH and method == 'PUT':
+                return self._put_chunk(query, headers, body)
+            if path == UPLOAD_PATH and method == 'DELETE':
+                return self._cancel_session(query)
+            if path == FILES_PATH and method == 'POST':
+                return self._create_file(body)
+            if path == ABOUT_PATH and method == 'GET':
+                return self._about(headers)
+            match = re.fullmatch(FILES_PATH + '/([^/]+)', path)
+            if match and method == 'GET':
+                return self._get_file(match.group(1))
+            if match and method == 'DELETE':
+                return self._delete_file(match.group(1))
+            if match and method == 'PATCH':
+                return self._update_file(match.group(1), query, body)
+            match = re.fullmatch(FILES_PATH + '/([^/]+)/permissions', path)
+            if match and method == 'POST':
+                return self._add_permission(match.group(1), body)
+        return 404, {'error': {'code': 404, 'message': 'Not Found'}}, None
+
+
+    def _create_session(self, query, headers, body, base=None):
+        upload_id = str(next(self._ids))
+        metadata = json.loads(body or b'{}')
+        self._sessions[upload_id] = {'metadata': metadata,
+                                     'data': bytearray(),
+                                     'received': 0,
+                                     'md5': hashlib.md5()}
+        location = '{}{}?uploadType=resumable&upload_id={}'.format(
+            base or self.url, UPLOAD_PATH, upload_id)
+        return 200, None, {'Location': location}
+
+
+    def _put_chunk(self, query, headers, body):
+        session = self._sessions.get(query.get('upload_id'))
+        if session is None:
+            return 404, {'error': {'code': 404,
+                                   'message': 'No such session'}}, None
+
+        # Content-Range: bytes FIRST-LAST/TOTAL, or bytes */TOTAL to
+        # ask for the status of the upload.
+        match = re.fullmatch(r'bytes (?:(\d+)-(\d+)|\*)/(\d+)',
+                             headers.get('Content-Range', ''))
+        total = int(match.group(3))
+        received = session['received']
+        if match.group(1) is not None and int(match.group(1)) == received:
+            if self.keep_content:
+                session['data'].extend(body)
+            session['md5'].update(body)
+            session['received'] = received = received + len(body)
+            self.bytes_received += len(body)
+
+        if received < total:
+            # Drive omits the header until it has received something.
+            if not received:
+                return 308, None, None
+            return 308, None, {'Range': 'bytes=0-{}'.format(received - 1)}
+
+        del self._sessions[query['upload_id']]
+        name = session['metadata'].get('name', 'file')
+        metadata = {k: v for k, v in session['metadata'].items()
+                    if k != 'name'}
+        metadata.update(md5Checksum=session['md5'].hexdigest(),
+                        size=str(received))
+        return 200, self.add_file(bytes(session['data']), name,
+                                  **metadata), None
+
+
+    def _cancel_session(self, query):
+        if self._sessions.pop(query.get('upload_id'), None) is None:
+            return 404, {'error': {'code': 404,
+                                   'message': 'No such session'}}, None
+        # What Drive answers to a cancelled resumable upload.
+        return 499, None, None
+
+
+    def _create_file(self, body):
+        # Metadata-only creation, e.g. of folders.
+        metadata = json.loads(body or b'{}')
+        name = metadata.pop('name', 'file')
+        return 200, self.add_file(b'', name, **metadata), None
+
+
+    def _about(self, headers):
+        token = headers.get('Authorization', '').partition(' ')[2]
+        permission_id = self.users.get(token) \
+            or hashlib.sha256(token.encode()).hexdigest()[:20]
+        return 200, {'user': {'permissionId': permission_id}}, None
+
+
+    def _get_file(self, file_id):
+        if file_id not in self.files:
+            return 404, {'error': {'code': 404,
+                                   'message': 'File not found'}}, None
+        return 200, self.files[file_id], None
+
+
+    def _delete_file(self, file_id):
+        if self.files.pop(file_id, None) is None:
+            return 404, {'error': {'code': 404,
+                                   'message': 'File not found'}}, None
+        del self.content[file_id]
+        self.permissions.pop(file_id, None)
+        return 204, None, None
+
+
+    def _update_file(self, file_id, query, body):
+        metadata = self.files.get(file_id)
+        if metadata is None:
+            return 404, {'error': {'code': 404,
+                                   'message': 'File not found'}}, None
+
+        changes = json.loads(body or b'{}')
+        for key in ('properties', 'appProperties'):
+            # Properties are merged; null removes one.
+            if key in changes:
+                merged = dict(metadata.get(key, {}), **changes.pop(key))
+                metadata[key] = {k: v for k, v in merged.items()
+                                 if v is not None}
+        metadata.update(changes)
+
+        parents = [parent for parent in metadata.get('parents', [])
+                   if parent not in query.get('removeParents', '').split(',')]
+        for parent in query.get('addParents', '').split(','):
+            if parent and parent not in parents:
+                parents.append(parent)
+        if parents or 'parents' in metadata:
+            metadata['parents'] = parents
+        return 200, metadata, None
+
+
+    def _add_permission(self, file_id, body):
+        if file_id not in self.files:
+            return 404, {'error': {'code': 404,
+                                   'message': 'File not found'}}, None
+        permissions = self.permissions.setdefault(file_id, [])
+        permission = dict(json.loads(body or b'{}'),
+                          id='perm{}'.format(next(self._ids)))
+        permissions.append(permission)
+        return 200, permission, None
+
+
+    def _batch(self, headers, body):
+        """Answer every call in the multipart BODY, in one multipart
+        answer."""
+
+        message = email.parser.BytesParser(policy=email.policy.HTTP) \
+            .parsebytes(b'Content-Type: '
+                        + headers.get('Content-Type', '').encode()
+                        + b'\r\n\r\n' + body)
+        if not message.is_multipart():
+            return 400, {'error': {'code': 400,
+                                   'message': 'Not a multipart request'}}, \
+                None
+        parts = list(message.iter_parts())
+        if len(parts) > BATCH_LIMIT:
+            return 400, {'error': {'code': 400,
+                                   'message': 'Too many calls in a batch '
+                                   'request'}}, None
+
+        boundary = 'batch_fake{}'.format(next(self._ids))
+        answer = []
+        for part in parts:
+            status, data = self._batch_call(part.get_payload(decode=True))
+            content_id = (part['Content-ID'] or '').strip('<> ')
+            lines = ['--' + boundary,
+                     'Content-Type: application/http',
+                     'Content-ID: <response-{}>'.format(content_id),
+                     '',
+                     'HTTP/1.1 {} {}'.format(
+                         status, http.client.responses.get(status, ''))]
+            if data is not None:
+                lines.append('Content-Type: application/json; charset=UTF-8')
+            lines += ['', _encode(data).decode()]
+            answer.append('\r\n'.join(lines))
+        answer.append('--{}--\r\n'.format(boundary))
+        return 200, '\r\n'.join(answer).encode(), {
+            'Content-Type': 'multipart/mixed; boundary=' + boundary}
+
+
+    def _batch_call(self, request):
+        """Answer REQUEST, one call of a batch in HTTP/1.1 form.
+
+        Returns its (status, json body)."""
+
+        head, _, body = request.replace(b'\r\n', b'\n').partition(b'\n\n')
+        method, target, _ = head.decode().split('\n')[0].split(' ', 2)
+        parsed = urllib.parse.urlparse(target)
+        query = dict(urllib.parse.parse_qsl(parsed.query))
+
+        with self.lock:
+            self.requests.append((method, parsed.path))
+            status = self.item_errors.pop(0) if self.item_errors else None
+        if status in (403, 429):
+            return self.throttle_reply(status)[:2]
+        if status is not None:
+            return status, {'error': {'code': status,
+                                      'message': 'Backend Error'}}
+        return self.handle(method, parsed.path, query, {}, body)[:2]
+
+
+H2_PREFACE = b'PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n'
+
+# Receive window advertised by the HTTP/2 server, so that large chunks
+# are not throttled by flow control.
+H2_WINDOW = 16 * 1024 * 1024
+
+
+class StandInServer:
+    """Serve a ‘FakeDrive’ over HTTP/1.1 and HTTP/2.
+
+    Plain-text connections that open with the HTTP/2 preface are
+    spoken HTTP/2 (prior knowledge); with an SSL_CONTEXT the protocol is
+    negotiated through ALPN.  ‘connections’ lists the (protocol,
+    handshake seconds) of every accepted connection, the handshake
+    being the TLS one, or the wait for the first bytes without TLS."""
+
+    def __init__(self, drive, ssl_context=None, host='127.0.0.1', port=0):
+        self.drive = drive
+        self.ssl_context = ssl_context
+        if ssl_context is not None:
+            protocols = ['h2', 'http/1.1'] if h2 is not None \
+                else ['http/1.1']
+            ssl_context.set_alpn_protocols(protocols)
+        self.connections = []
+        self._lock = threading.Lock()
+        self._open = set()
+        self._sock = socket.create_server((host, port))
+        self._thread = None
+
+
+    @property
+    def url(self):
+        host, port = self._sock.getsockname()[:2]
+        scheme = 'http' if self.ssl_context is None else 'https'
+        return '{}://{}:{}'.format(scheme, host, port)
+
+    base = url
+
+
+    def start(self):
+        self._thread = threading.Thread(target=self._accept, daemon=True)
+        self._thread.start()
+        return self
+
+
+    def stop(self):
+        self._sock.close()
+        with self._lock:
+            for conn in list(self._open):
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                conn.close()
+
+
+    def __enter__(self):
+        return self.start()
+
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+    def _accept(self):
+        while True:
+            try:
+                conn, address = self._sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn, address),
+                             daemon=True).start()
+
+
+    def _serve(self, conn, address):
+        with self._lock:
+            self._open.add(conn)
+        try:
+            start = time.perf_counter()
+            if self.ssl_context is not None:
+                conn = self.ssl_context.wrap_socket(conn, server_side=True)
+                with self._lock:
+                    self._open.add(conn)
+                protocol = conn.selected_alpn_protocol() or 'http/1.1'
+            else:
+                protocol = 'h2' if self._peek_preface(conn) else 'http/1.1'
+            handshake = time.perf_counter() - start
+
+            with self._lock:
+                self.connections.append((protocol, handshake))
+
+            if protocol == 'h2':
+                self._serve_h2(conn)
+            else:
+                _Handler(conn, address, self)
+        except OSError:
+            pass
+        finally:
+            with self._lock:
+                self._open.discard(conn)
+            conn.close()
+
+
+    @staticmethod
+    def _peek_preface(conn):
+        """Tell whether a plain-text connection opens with HTTP/2."""
+
+        data = b''
+        while len(data) < len(H2_PREFACE):
+            data = conn.recv(len(H2_PREFACE), socket.MSG_PEEK)
+            if not data or not H2_PREFACE.startswith(data):
+                return False
+            if len(data) < len(H2_PREFACE):
+                time.sleep(0.001)
+        return h2 is not None
+
+
+    def _serve_h2(self, conn):
+        config = h2.config.H2Configuration(client_side=False,
+                                           header_encoding='utf-8')
+        h2conn = h2.connection.H2Connection(config=config)
+        h2conn.local_settings = h2.settings.Settings(
+            client=False,
+            initial_values={
+                h2.settings.SettingCodes.INITIAL_WINDOW_SIZE: H2_WINDOW})
+        lock = threading.Lock()
+
+        def flush():
+            data = h2conn.data_to_send()
+            if data:
+                conn.sendall(data)
+
+        with lock:
+            h2conn.initiate_connection()
+            h2conn.increment_flow_control_window(H2_WINDOW)
+            flush()
+
+        streams = {}
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                return
+            with lock:
+                events = h2conn.receive_data(data)
+                flush()
+
+            for event in events:
+                if isinstance(event, h2.events.RequestReceived):
+                    streams[event.stream_id] = (dict(event.headers),
+                                                bytearray())
+                elif isinstance(event, h2.events.DataReceived):
+                    streams[event.stream_id][1].extend(event.data)
+                    with lock:
+                        h2conn.acknowledge_received_data(
+                            event.flow_controlled_length, event.stream_id)
+                        flush()
+                elif isinstance(event, h2.events.StreamEnded):
+                    headers, body = streams.pop(event.stream_id)
+                    # Streams are answered concurrently, as a real
+                    # server would.
+                    threading.Thread(
+                        target=self._respond_h2,
+                        args=(h2conn, lock, flush, event.stream_id,
+                              headers, bytes(body)),
+                        daemon=True).start()
+                elif isinstance(event, h2.events.ConnectionTerminated):
+                    return
+
+
+    def _respond_h2(self, h2conn, lock, flush, stream_id, headers, body):
+        parsed = urllib.parse.urlparse(headers[':path'])
+        query = dict(urllib.parse.parse_qsl(parsed.query))
+        message = email.message.Message()
+        for name, value in headers.items():
+            if not name.startswith(':'):
+                message[name] = value
+        message['Host'] = headers.get(':authority', '')
+
+        status, data, reply_headers = self.drive.serve(
+            headers[':method'], parsed.path, query, message, body, self.url)
+
+        payload = _encode(data)
+        response = [(':status', str(status)),
+                    ('content-length', str(len(payload)))]
+        if data is not None and not isinstance(data, bytes):
+            response.append(('content-type', 'application/json'))
+        response += [(name.lower(), value)
+                     for name, value in (reply_headers or {}).items()]
+
+        try:
+            with lock:
+                h2conn.send_headers(stream_id, response,
+                                    end_stream=not payload)
+                if payload:
+                    h2conn.send_data(stream_id, payload, end_stream=True)
+                flush()
+        except (OSError, h2.exceptions.H2Error):
+            pass
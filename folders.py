@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""Drive folders mirroring a directory tree.
+
+Mirrors (see ‘mirror’) and archive expansions (see ‘expand’) put files
+at relative paths such as ‘a/b/c.txt’; ‘FolderTree’ creates the Drive
+folders for those paths on first use, under one top folder."""
+
+import json
+import logging as log
+import posixpath
+import threading
+
+import url as urlm
+import ratelimit
+import transport as transportm
+
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+
+def exists(file_id, token, transport=None, cancel=None):
+    """Tell if FILE_ID still is in Drive, and not in the trash.
+
+    The call goes through TRANSPORT, the process-wide default if not
+    given, within the limits of TOKEN and the deadline of CANCEL.
+    Raises RuntimeError if Drive cannot be reached."""
+
+    if transport is None:
+        transport = transportm.default()
+    try:
+        response = ratelimit.send(
+            transport.get, urlm.API_ROOT + '/drive/v3/files/' + file_id,
+            token, cancel=cancel, timeout=urlm.API_TIMEOUT,
+            params={'fields': 'id,trashed'},
+            headers={'Authorization': 'Bearer ' + token})
+    except transportm.ERRORS as e:
+        msg = 'Problems checking {}: {}'.format(file_id, e)
+        log.error(msg)
+        raise RuntimeError(msg) from e
+
+    return response.status_code == 200 and not response.json().get('trashed')
+
+
+class FolderTree:
+    """Drive folders for the directories of relative paths."""
+
+    def __init__(self, token, top_name, known=None, on_create=None,
+                 transport=None):
+        """Create folders with TOKEN, under a top folder named TOP_NAME.
+
+        KNOWN maps paths (‘’ being the top) to the ids of folders
+        created before, which are reused if they are still in Drive.
+        ON_CREATE, if given, is called with the path and id of every
+        folder created."""
+
+        self.token = token
+        self.top_name = top_name
+        self.known = known or {}
+        self.on_create = on_create
+        self.transport = transport if transport is not None \
+            else transportm.default()
+        self._folders = {}
+        self._lock = threading.RLock()
+
+
+    def _create(self, name, parent):
+        metadata = {'name': name, 'mimeType': FOLDER_MIME_TYPE}
+        if parent is not None:
+            metadata['parents'] = [parent]
+
+        response = ratelimit.send(
+            self.transport.post, urlm.API_ROOT + '/drive/v3/files',
+            self.token,
+            headers={'Authorization': 'Bearer ' + self.token,
+                     'Content-Type': 'application/json'},
+            data=json.dumps(metadata), timeout=urlm.API_TIMEOUT)
+        if getattr(response, 'status_code') != 200:
+            msg = 'Problems creating folder {}: {}'.format(name, response)
+            log.error(msg)
+            raise RuntimeError(msg)
+
+        return response.json()['id']
+
+
+    def get(self, path):
+        """Return the Drive id of the folder for PATH (‘’ is the top).
+
+        Raises RuntimeError if it cannot be created."""
+
+        with self._lock:
+            if path in self._folders:
+                return self._folders[path]
+
+            if path:
+                parent = self.get(posixpath.dirname(path))
+                name = posixpath.basename(path)
+            else:
+                parent, name = None, self.top_name
+
+            folder_id = self.known.get(path)
+            if folder_id is not None and not exists(folder_id, self.token,
+                                                     self.transport):
+                folder_id = None
+            if folder_id is None:
+                folder_id = self._create(name, parent)
+                if self.on_create is not None:
+                    self.on_create(path, folder_id)
+
+            self._folders[path] = folder_id
+            return folder_id
@@ -0,0 +1,506 @@
+# -*- coding: utf-8 -*-
+"""Load-test the web app end to end.
+
+Starts instances of the app (separate processes, as App Engine would),
+a stand-in OAuth server, a stand-in Drive (‘fake_drive.FakeDrive’) and
+a synthetic origin serving reproducible files of any size.  Virtual
+users then go through the whole flow: POST of a link to ‘/’, sign in
+(‘/signin’, ‘/authorize’, the OAuth consent and ‘/oauth2callback’),
+‘home()’ starting the transfer, and the ‘/progress’ event stream until
+‘drive_it()’ is done; then they post the next link.
+
+Users are added in stages (e.g. 1, then 4, then 16 of them), and for
+each stage the requests per second, latency percentiles and error rate
+of every route, the transfers completed and the peak memory of every
+instance are reported.  Runs with the same --seed and --scenario pick
+the same files.
+
+    python loadtest.py --scenario mixed --users 1,4,16 --stage 30
+
+The environment of the instances is inherited, so e.g. DRIVEET_WORKERS
+can be varied between runs.  Memory is read from /proc (Linux)."""
+
+import argparse
+import http.server
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+
+import requests
+
+from fake_drive import FakeDrive
+
+
+SCOPE = 'https://www.googleapis.com/auth/drive.file'
+
+# Workloads: (weight, smallest size, largest size) of the files posted.
+SCENARIOS = {
+    'small': [(1, 64 * 1024, 1024 * 1024)],
+    'large': [(1, 32 * 1024 * 1024, 64 * 1024 * 1024)],
+    'mixed': [(8, 64 * 1024, 1024 * 1024),
+              (2, 16 * 1024 * 1024, 64 * 1024 * 1024)],
+}
+
+# Run in the instance processes.
+INSTANCE = '''
+import sys
+from werkzeug.serving import run_simple
+import main
+run_simple('127.0.0.1', int(sys.argv[1]), main.app, threaded=True)
+'''
+
+# Size of the pattern the synthetic files are made of.
+ORIGIN_BLOCK = 64 * 1024
+
+MAX_REDIRECTS = 10
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def serve(handler):
+    """Serve HANDLER on a free local port.  Return the server and URL."""
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+
+class _Quiet(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+
+class OAuthHandler(_Quiet):
+    """Stand-in for Google’s consent page and token endpoint.
+
+    Consent is granted at once; every code is exchanged for tokens of
+    their own, so that every virtual user is a different Drive user."""
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        location = '{}?{}'.format(query['redirect_uri'], urllib.parse.urlencode(
+            {'code': uuid.uuid4().hex, 'state': query.get('state', ''),
+             'scope': SCOPE}))
+        self.send_response(302)
+        self.send_header('Location', location)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        body = json.dumps({'access_token': 'token-' + uuid.uuid4().hex,
+                           'refresh_token': 'refresh-' + uuid.uuid4().hex,
+                           'expires_in': 3600,
+                           'token_type': 'Bearer',
+                           'scope': SCOPE}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class OriginHandler(_Quiet):
+    """Synthetic origin: ‘/files/SEED/SIZE/NAME’ is SIZE reproducible bytes.
+
+    The server’s ‘latency’ is waited before answering."""
+
+    def _head(self):
+        match = re.fullmatch(r'/files/(\d+)/(\d+)/[^/]+', self.path)
+        if match is None:
+            self.send_error(404)
+            return None
+
+        time.sleep(self.server.latency)
+        seed, size = int(match.group(1)), int(match.group(2))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        return random.Random(seed).randbytes(ORIGIN_BLOCK), size
+
+
+    def do_HEAD(self):
+        self._head()
+
+
+    def do_GET(self):
+        head = self._head()
+        if head is None:
+            return
+
+        block, size = head
+        try:
+            while size > 0:
+                self.wfile.write(block[:size])
+                size -= len(block)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+class Stats:
+    """Measurements of the requests and transfers of the virtual users."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (start time, route, seconds, ok)
+        self.requests = []
+        # (start time, size, seconds, ok)
+        self.transfers = []
+
+
+    def request(self, start, route, seconds, ok):
+        with self.lock:
+            self.requests.append((start, route, seconds, ok))
+
+
+    def transfer(self, start, size, seconds, ok):
+        with self.lock:
+            self.transfers.append((start, size, seconds, ok))
+
+
+class VirtualUser:
+    """One user posting links to an instance, one after the other."""
+
+    def __init__(self, index, base, origin, scenario, seed, think, stats):
+        self.base = base
+        self.origin = origin
+        self.scenario = scenario
+        self.think = think
+        self.stats = stats
+        self.random = random.Random('{}:{}'.format(seed, index))
+        self.session = requests.Session()
+
+
+    def _route(self, url):
+        """Label of the route URL belongs to, for the report."""
+
+        if not url.startswith(self.base):
+            return 'OAuth consent'
+        path = urllib.parse.urlparse(url).path
+        return re.sub(r'/(progress|jobs)/[^/]+', r'/\1/<id>', path)
+
+
+    def request(self, method, url, **kwargs):
+        """Send a request, following redirects, each one measured."""
+
+        for _ in range(MAX_REDIRECTS):
+            start = time.monotonic()
+            route = '{} {}'.format(method, self._route(url))
+            try:
+                response = self.session.request(method, url,
+                                                allow_redirects=False,
+                                                timeout=300, **kwargs)
+            except requests.RequestException:
+                self.stats.request(start, route, time.monotonic() - start,
+                                   False)
+                raise
+            self.stats.request(start, route, time.monotonic() - start,
+                               response.status_code < 400)
+
+            if not response.is_redirect:
+                return response
+            url = urllib.parse.urljoin(url, response.headers['Location'])
+            method, kwargs = 'GET', {}
+
+        raise RuntimeError('Too many redirects')
+
+
+    def pick(self):
+        """Return the URL and size of the next file to post."""
+
+        weights = [weight for weight, _, _ in self.scenario]
+        _, smallest, largest = self.random.choices(self.scenario,
+                                                   weights)[0]
+        size = self.random.randint(smallest, largest)
+        seed = self.random.randrange(2 ** 32)
+        return '{}/files/{}/{}/file-{}.bin'.format(self.origin, seed, size,
+                                                   seed), size
+
+
+    def transfer(self):
+        url, size = self.pick()
+        start = time.monotonic()
+        ok = False
+        try:
+            page = self.request('POST', self.base + '/', data={'url': url})
+            match = re.search(r'/progress/([0-9a-f]+)', page.text)
+            if page.ok and match:
+                ok = self.follow(match.group(1))
+        except (requests.RequestException, RuntimeError):
+            pass
+        self.stats.transfer(start, size, time.monotonic() - start, ok)
+
+
+    def follow(self, job):
+        """Read the progress of JOB to its end.  Return whether it worked."""
+
+        start = time.monotonic()
+        route = 'GET /progress/<id>'
+        state = None
+        try:
+            with self.session.get(self.base + '/progress/' + job,
+                                  stream=True, timeout=300) as response:
+                for line in response.iter_lines(decode_unicode=True):
+                    if line and line.startswith('data: '):
+                        state = json.loads(line[6:])['state']
+                        if state in ('done', 'error'):
+                            break
+        except requests.RequestException:
+            pass
+        self.stats.request(start, route, time.monotonic() - start,
+                           state is not None)
+        return state == 'done'
+
+
+    def run(self, stop):
+        while not stop.is_set():
+            self.transfer()
+            if self.think:
+                stop.wait(self.random.expovariate(1 / self.think))
+
+
+class MemorySampler:
+    """Peak resident memory of processes, over time windows."""
+
+    def __init__(self, pids, interval=0.5):
+        self.pids = pids
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        threading.Thread(target=self._run, daemon=True).start()
+
+
+    @staticmethod
+    def rss(pid):
+        """Resident memory of PID in bytes, or None if unknown."""
+
+        try:
+            with open('/proc/{}/status'.format(pid)) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.samples.append((time.monotonic(),
+                                 [self.rss(pid) for pid in self.pids]))
+
+
+    def peaks(self, start, end):
+        """Return the peak memory of every process between START and END."""
+
+        peaks = [None] * len(self.pids)
+        for when, values in self.samples:
+            if start <= when < end:
+                peaks = [max(filter(None, (peak, value)), default=None)
+                         for peak, value in zip(peaks, values)]
+        return peaks
+
+
+    def stop(self):
+        self._stop.set()
+
+
+def percentile(values, fraction):
+    """Return the FRACTION percentile of VALUES (nearest rank)."""
+
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def summarize(stats, memory, start, end, users):
+    """Return the report of what started between START and END."""
+
+    seconds = end - start
+    routes = {}
+    with stats.lock:
+        requests_ = [r for r in stats.requests if start <= r[0] < end]
+        transfers = [t for t in stats.transfers if start <= t[0] < end]
+
+    for _, route, latency, ok in requests_:
+        routes.setdefault(route, []).append((latency, ok))
+
+    def describe(samples):
+        latencies = [latency for latency, _ in samples]
+        errors = sum(1 for _, ok in samples if not ok)
+        return {'count': len(samples),
+                'rps': len(samples) / seconds,
+                'p50': percentile(latencies, 0.50),
+                'p95': percentile(latencies, 0.95),
+                'p99': percentile(latencies, 0.99),
+                'error_rate': errors / len(samples) if samples else 0.0}
+
+    done = [(seconds_, size) for _, size, seconds_, ok in transfers if ok]
+    transfer_report = describe([(seconds_, ok)
+                                for _, _, seconds_, ok in transfers])
+    transfer_report['bytes_per_second'] = sum(s for _, s in done) / seconds
+
+    return {'users': users,
+            'seconds': seconds,
+            'requests': describe([(latency, ok)
+                                  for _, _, latency, ok in requests_]),
+            'routes': {route: describe(samples)
+                       for route, samples in sorted(routes.items())},
+            'transfers': transfer_report,
+            'memory': memory.peaks(start, end)}
+
+
+def print_stage(report):
+    def ms(value):
+        return '{:8.1f}'.format(1000 * value) if value is not None \
+            else '{:>8}'.format('-')
+
+    print('\n{} users, {:.0f} s'.format(report['users'], report['seconds']))
+    print('{:28} {:>7} {:>7} {:>8} {:>8} {:>8} {:>7}'.format(
+        '', 'count', 'per s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors'))
+    rows = list(report['routes'].items())
+    rows += [('all requests', report['requests']),
+             ('transfers', report['transfers'])]
+    for name, row in rows:
+        print('{:28} {:>7} {:>7.2f} {} {} {} {:>6.1%}'.format(
+            name, row['count'], row['rps'], ms(row['p50']), ms(row['p95']),
+            ms(row['p99']), row['error_rate']))
+    print('throughput: {:.1f} MB/s'.format(
+        report['transfers']['bytes_per_second'] / 1e6))
+    for i, peak in enumerate(report['memory']):
+        print('instance {} peak memory: {}'.format(
+            i, '{:.1f} MB'.format(peak / 1e6) if peak else 'unknown'))
+
+
+def start_instances(count, env):
+    """Start COUNT app instances.  Return their processes and URLs."""
+
+    processes, urls = [], []
+    for _ in range(count):
+        port = free_port()
+        processes.append(subprocess.Popen(
+            [sys.executable, '-c', INSTANCE, str(port)],
+            cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        urls.append('http://127.0.0.1:{}'.format(port))
+
+    for process, url in zip(processes, urls):
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                requests.get(url + '/_ah/warmup', timeout=5)
+                break
+            except requests.ConnectionError:
+                if process.poll() is not None \
+                   or time.monotonic() > deadline:
+                    raise RuntimeError('Instance {} did not start'
+                                       .format(url))
+                time.sleep(0.1)
+
+    return processes, urls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS),
+                        default='small', help='workload')
+    parser.add_argument('--users', default='1,4,16',
+                        help='virtual users of every stage, comma-separated')
+    parser.add_argument('--stage', type=float, default=30,
+                        help='seconds of every stage')
+    parser.add_argument('--instances', type=int, default=1,
+                        help='app instances to spread the users over')
+    parser.add_argument('--think', type=float, default=0.0,
+                        help='mean seconds between two transfers of a user')
+    parser.add_argument('--drive-latency', type=float, default=0.0,
+                        help='seconds the stand-in Drive takes per request')
+    parser.add_argument('--origin-latency', type=float, default=0.0,
+                        help='seconds the origin takes to answer')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the choice of files')
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args()
+    stages = [int(users) for users in args.users.split(',')]
+
+    drive = FakeDrive(latency=args.drive_latency, keep_content=False).start()
+    oauth, oauth_url = serve(OAuthHandler)
+    origin, origin_url = serve(OriginHandler)
+    origin.latency = args.origin_latency
+
+    directory = tempfile.TemporaryDirectory()
+    secrets = os.path.join(directory.name, 'client_secrets.json')
+    with open(secrets, 'w') as f:
+        json.dump({'web': {'client_id': 'loadtest',
+                           'client_secret': 'loadtest',
+                           'auth_uri': oauth_url + '/auth',
+                           'token_uri': oauth_url + '/token',
+                           'redirect_uris': []}}, f)
+    env = dict(os.environ,
+               SECRET_KEY='loadtest',
+               DRIVEET_API_ROOT=drive.url,
+               DRIVEET_CLIENT_SECRETS=secrets,
+               OAUTHLIB_INSECURE_TRANSPORT='1',
+               OAUTHLIB_RELAX_TOKEN_SCOPE='1')
+
+    processes, urls = start_instances(args.instances, env)
+    memory = MemorySampler([process.pid for process in processes])
+    stats = Stats()
+    stop = threading.Event()
+    threads = []
+    reports = []
+    try:
+        for users in stages:
+            while len(threads) < users:
+                user = VirtualUser(len(threads), urls[len(threads) % len(urls)],
+                                   origin_url, SCENARIOS[args.scenario],
+                                   args.seed, args.think, stats)
+                threads.append(threading.Thread(target=user.run,
+                                                args=(stop,), daemon=True))
+                threads[-1].start()
+            start = time.monotonic()
+            time.sleep(args.stage)
+            reports.append(summarize(stats, memory, start, time.monotonic(),
+                                     users))
+            print_stage(reports[-1])
+    finally:
+        stop.set()
+        memory.stop()
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+        drive.stop()
+        oauth.shutdown()
+        origin.shutdown()
+        directory.cleanup()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'scenario': args.scenario, 'seed': args.seed,
+                       'instances': args.instances, 'stages': reports},
+                      f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,21 +2,38 @@
 
 import os
 from flask import (Flask, session, request, redirect, render_template,
-                   url_for, flash)
+                   url_for, flash, abort, Response, g)
 import requests
 
-import google.oauth2.credentials
-import google_auth_oauthlib.flow
-import googleapiclient.discovery
+# The google.auth and oauthlib stacks are slow to import, so they are
+# imported on first use (see 'load_credentials' and 'make_flow') or by
+# the warmup request, not when the instance starts.
 
 import json
+import hashlib
+import functools
+import threading
+import concurrent.futures
 
 import logging
 import url as urlm
+import dedup as dedupm
+import scheduler as schedulerm
+import ratelimit
+import transport as transportm
+import origins
+import progress as progressm
+import cancellation
+import store as storem
+import worker as workerm
+import mirror as mirrorm
+import expand as expandm
+import tracing
 
 # This variable specifies the name of a file that contains the OAuth 2.0
 # information for this application, including its client_id and client_secret.
-CLIENT_SECRETS_FILE = "client_secrets-web.json"
+CLIENT_SECRETS_FILE = os.environ.get('DRIVEET_CLIENT_SECRETS',
+                                     "client_secrets-web.json")
 
 # This OAuth 2.0 access scope allows for full read/write access to the
 # authenticated user's account and requires requests to use an SSL connection.
@@ -24,39 +41,321 @@ SCOPES = ['https://www.googleapis.com/auth/drive.file']
 API_SERVICE_NAME = 'drive'
 API_VERSION = 'v3'
 
+# Opt-in: when set, uploads whose content is already in the user's Drive
+# are skipped.  The value is the directory where the per-user indexes
+# are kept (empty means the default location).
+DEDUP = os.environ.get('DRIVEET_DEDUP')
+
+# Transfers run on a fixed pool of workers shared fairly among users,
+# each of them having at most USER_JOBS transfers running at once.
+WORKERS = int(os.environ.get('DRIVEET_WORKERS', 4))
+USER_JOBS = int(os.environ.get('DRIVEET_USER_JOBS', 2))
+
+# Members of an archive being expanded that are uploaded at once.
+EXPAND_WORKERS = int(os.environ.get('DRIVEET_EXPAND_WORKERS', 4))
+
+
+def _seconds(name):
+  value = os.environ.get(name)
+  return float(value) if value else None
+
+# Optional deadlines, in seconds, for a whole transfer (counted from its
+# submission) and for each of its phases.
+DEADLINE = _seconds('DRIVEET_DEADLINE')
+PHASE_DEADLINES = {'download': _seconds('DRIVEET_DOWNLOAD_DEADLINE'),
+                   'upload': _seconds('DRIVEET_UPLOAD_DEADLINE')}
+
+# Optional shared store (e.g. 'sqlite:////srv/driveet.db') of jobs and
+# credentials.  With it, transfers are queued there and run by the
+# workers of whichever instance claims them, instead of in-process.
+STORE = os.environ.get('DRIVEET_STORE')
+
+# Optional tracing of requests and transfers: spans go to a JSON-lines
+# file or, if this is an 'http(s)://' URL, to an OTLP collector.  Traces
+# not sampled by the caller are sampled with TRACE_SAMPLE probability.
+TRACE = os.environ.get('DRIVEET_TRACE')
+TRACE_SAMPLE = float(os.environ.get('DRIVEET_TRACE_SAMPLE', 0.1))
+
+if TRACE:
+  tracing.configure(tracing.exporter_from_url(TRACE), TRACE_SAMPLE)
+
 app = Flask(__name__)
 # Note: A secret key is included in the sample so that it works.
 # If you use this code in your application, replace this with a truly secret
 # key. See https://flask.palletsprojects.com/quickstart/#sessions.
 app.secret_key = os.environ.get('SECRET_KEY')
 
+scheduler = schedulerm.FairScheduler(workers=WORKERS,
+                                     per_user_limit=USER_JOBS)
+
+store = None
+if STORE:
+  store = storem.from_url(STORE)
+  workerm.start(store, WORKERS, per_user_limit=USER_JOBS,
+                deadline=DEADLINE, phase_deadlines=PHASE_DEADLINES,
+                dedup=DEDUP)
+
+# Mirrors and archive expansions run on threads of their own.  Mirrors
+# hand their files over to the scheduler; expansions feed their members
+# to EXPAND_WORKERS uploads straight from the archive stream.
+batches = concurrent.futures.ThreadPoolExecutor(max_workers=WORKERS)
+
+# Transfers not finished yet, by id: their futures and cancel tokens.
+jobs = {}
+jobs_lock = threading.Lock()
+
+
+@app.before_request
+def start_trace():
+  # The request continues the trace of its caller, if it names one.
+  route = request.url_rule.rule if request.url_rule else request.path
+  span = tracing.tracer.start(
+    '{} {}'.format(request.method, route),
+    remote=tracing.parse_headers(request.headers), method=request.method,
+    route=route)
+  g.trace = (span, tracing.activate(span))
+
+
+@app.after_request
+def trace_status(response):
+  if 'trace' in g:
+    g.trace[0].set('status', response.status_code)
+  return response
+
+
+@app.teardown_request
+def end_trace(error):
+  if 'trace' not in g:
+    return
+  span, token = g.pop('trace')
+  if error is not None:
+    span.fail(str(error))
+  tracing.deactivate(token)
+  span.end()
+
 
 @app.route('/', methods=['GET', 'POST'])
 def home():
-  url, local_filename, remote_basename, error  = None, None, None, None
+  url, job = None, None
   if request.method == 'POST':
     session['_url'] = request.form['url']
+    session['_mirror'] = bool(request.form.get('mirror'))
+    session['_include'] = request.form.get('include', '').split()
+    session['_expand'] = bool(request.form.get('expand'))
 
     return redirect(url_for('signin'))
 
   if session.get('_url'):
     # Fetch the OAuth credentials that will be used to obtain upload access to
     # the Google Drive.
-    credentials = google.oauth2.credentials.\
-      Credentials(**session['credentials'])
+    credentials = load_credentials()
 
-    try:
+    user = session_user()
+
+    if session.pop('_mirror', False):
+      job = start_mirror(session['_url'], credentials.token, user,
+                         session.pop('_include', None))
+      session['_url'] = None
+      return render_template('index.html', job=job)
+
+    if session.pop('_expand', False):
+      job = start_expand(session['_url'], credentials.token, user)
+      session['_url'] = None
+      return render_template('index.html', job=job)
+
+    if store is not None:
+      # Whichever instance claims the job needs the credentials too.
+      store.save_credentials(user, workerm.credentials_to_dict(credentials))
       url = urlm.Url(session['_url'], credentials.token)
-      local_filename, remote_basename = url.drive_it()
+      job = store.enqueue(user, url.url, size=url.expected_size())
+      session['_url'] = None
+      return render_template('index.html', job=job)
+
+    dedup = None
+    if DEDUP is not None:
+      dedup = dedupm.DedupIndex.for_user(
+        user, DEDUP or dedupm.DEFAULT_DIRECTORY)
+
+    # The transfer runs in the background; the page follows it through
+    # the '/progress/<id>' event stream.
+    cancel = cancellation.CancelToken(
+      DEADLINE, {phase: seconds for phase, seconds in PHASE_DEADLINES.items()
+                 if seconds is not None})
+
+    try:
+      url = urlm.Url(session['_url'], credentials.token, dedup=dedup,
+                     progress=progressm.registry.create(owner=user),
+                     cancel=cancel)
+      transfer = scheduler.submit(user, url.drive_it,
+                                  size=url.expected_size())
     except RuntimeError as e:
       flash(str(e), 'notification')
     else:
-      msg = 'Success! File "{}" is in your Drive now.'
-      flash(msg.format(remote_basename), 'notification')
+      job = url.progress.id
+      with jobs_lock:
+        jobs[job] = (transfer, cancel)
+      transfer.add_done_callback(functools.partial(report, url))
     finally:
       session['_url'] = None
 
-  return render_template('index.html')
+  return render_template('index.html', job=job)
+
+
+def report(url, transfer):
+  """Publish the outcome of the TRANSFER of URL to its listeners."""
+  with jobs_lock:
+    jobs.pop(url.progress.id, None)
+
+  # The download is not needed any more, whatever became of it.
+  try:
+    os.remove(url.filename)
+  except (RuntimeError, OSError):
+    pass
+
+  try:
+    local_filename, remote_basename = transfer.result()
+  except concurrent.futures.CancelledError:
+    url.progress.fail('Transfer cancelled')
+  except RuntimeError as e:
+    url.progress.fail(str(e))
+  except Exception:
+    logging.exception('Transfer of %s failed', url.url)
+    url.progress.fail('Unexpected error')
+  else:
+    if url.reused:
+      msg = 'File "{}" was already in your Drive.'
+    else:
+      msg = 'Success! File "{}" is in your Drive now.'
+    url.progress.finish(msg.format(remote_basename))
+
+
+def start_mirror(index_url, token, user, include=None):
+  """Start mirroring INDEX_URL for USER.  Return the job id."""
+  cancel = cancellation.CancelToken(DEADLINE)
+  mirror = mirrorm.Mirror(
+    index_url, token, manifest=mirrorm.Manifest.for_user(user, index_url),
+    include=include, submit=functools.partial(scheduler.submit, user),
+    progress=progressm.registry.create(owner=user), cancel=cancel)
+
+  return start_batch(mirror.run, mirror.progress, cancel, index_url)
+
+
+def start_expand(archive_url, token, user):
+  """Start expanding the archive at ARCHIVE_URL for USER.
+
+  Returns the job id."""
+  cancel = cancellation.CancelToken(DEADLINE)
+  expand = expandm.Expand(
+    archive_url, token, workers=EXPAND_WORKERS,
+    progress=progressm.registry.create(owner=user), cancel=cancel)
+  return start_batch(expand.run, expand.progress, cancel, archive_url)
+
+
+def start_batch(run, progress, cancel, url):
+  """Run RUN, the mirror or expansion of URL, in the background."""
+  job = progress.id
+  with jobs_lock:
+    transfer = batches.submit(tracing.bind(run))
+    jobs[job] = (transfer, cancel)
+  transfer.add_done_callback(functools.partial(report_batch, progress, url))
+  return job
+
+
+def report_batch(progress, url, transfer):
+  """Publish the outcome of the TRANSFER of the files of URL."""
+  with jobs_lock:
+    jobs.pop(progress.id, None)
+
+  try:
+    result = transfer.result()
+  except concurrent.futures.CancelledError:
+    progress.fail('Transfer cancelled')
+  except RuntimeError as e:
+    progress.fail(str(e))
+  except Exception:
+    logging.exception('Transfer of the files of %s failed', url)
+    progress.fail('Unexpected error')
+  else:
+    progress.finish(result.summary())
+
+
+def job_snapshot(id):
+  """Return the progress of the stored job ID, or None."""
+  job = store.get(id)
+  return None if job is None else job.snapshot()
+
+
+@app.route('/progress/<id>')
+def progress_events(id):
+  # Mirrors run in-process even with a store.
+  job = store.get(id) if store is not None else None
+  if job is not None:
+    if job.user != session_user():
+      abort(404)
+    events = progressm.poll_events(functools.partial(job_snapshot, id))
+  else:
+    transfer = progressm.registry.get(id)
+    if transfer is None or transfer.owner != session_user():
+      abort(404)
+    events = transfer.events()
+
+  return Response(events, mimetype='text/event-stream',
+                  headers={'Cache-Control': 'no-cache',
+                           'X-Accel-Buffering': 'no'})
+
+
+@app.route('/jobs/<id>/cancel', methods=['POST'])
+def cancel_job(id):
+  job = store.get(id) if store is not None else None
+  if job is not None:
+    if job.user != session_user():
+      abort(404)
+    store.request_cancel(id)
+    return '', 204
+
+  transfer = progressm.registry.get(id)
+  if transfer is None or transfer.owner != session_user():
+    abort(404)
+
+  with jobs_lock:
+    job = jobs.get(id)
+  if job is not None:
+    future, cancel = job
+    # A queued transfer never starts; a running one stops at its next
+    # check, releasing its connection, temporary file and upload session.
+    future.cancel()
+    cancel.cancel()
+
+  return '', 204
+
+
+@app.route('/stats/scheduler')
+def scheduler_stats():
+  return scheduler.stats()
+
+
+@app.route('/stats/ratelimit')
+def ratelimit_stats():
+  return ratelimit.limiter.stats()
+
+
+@app.route('/stats/origins')
+def origin_stats():
+  return origins.pool.stats()
+
+
+@app.route('/_ah/warmup')
+def warmup():
+  # App Engine sends this before routing users to a new instance: pay
+  # for the slow imports and the secrets file here instead.
+  import google.oauth2.credentials
+  import google_auth_oauthlib.flow
+  try:
+    client_config()
+  except OSError as e:
+    logging.warning('Could not load client secrets: %s', e)
+
+  return '', 200
 
 
 @app.route('/signin')
@@ -65,13 +364,12 @@ def signin():
     return redirect('authorize')
 
   # Load credentials from the session.
-  credentials = google.oauth2.\
-    credentials.Credentials(**session['credentials'])
+  credentials = load_credentials()
 
   # Save credentials back to session in case access token was refreshed.
   # ACTION ITEM: In a production app, you likely want to save these
   #              credentials in a persistent database instead.
-  session['credentials'] = credentials_to_dict(credentials)
+  session['credentials'] = workerm.credentials_to_dict(credentials)
 
   return redirect(url_for('home'))
 
@@ -80,8 +378,7 @@ def signin():
 def authorize():
   # Create flow instance to manage the OAuth 2.0 Authorization Grant Flow
   # steps.
-  flow = google_auth_oauthlib.flow.Flow.from_client_secrets_file(
-      CLIENT_SECRETS_FILE, scopes=SCOPES)
+  flow = make_flow()
 
   # The URI created here must exactly match one of the authorized
   # redirect URIs for the OAuth 2.0 client, which you configured in
@@ -108,8 +405,7 @@ def oauth2callback():
   # verified in the authorization server response.
   state = session['state']
 
-  flow = google_auth_oauthlib.flow.Flow.from_client_secrets_file(
-      CLIENT_SECRETS_FILE, scopes=SCOPES, state=state)
+  flow = make_flow(state=state)
   flow.redirect_uri = url_for('oauth2callback', _external=True)
 
   # Use the authorization server's response to fetch the OAuth 2.0 tokens.
@@ -120,7 +416,9 @@ def oauth2callback():
   # ACTION ITEM: In a production app, you likely want to save these
   #              credentials in a persistent database instead.
   credentials = flow.credentials
-  session['credentials'] = credentials_to_dict(credentials)
+  session['credentials'] = workerm.credentials_to_dict(credentials)
+  # Fetched once: it keys the user's jobs, dedup index and fair share.
+  session['user'] = user_key(credentials)
 
   return redirect(url_for('home'))
 
@@ -131,8 +429,7 @@ def revoke():
     return ('You need to <a href="/authorize">authorize</a> before ' +
             'testing the code to revoke credentials.')
 
-  credentials = google.oauth2.credentials.Credentials(
-    **session['credentials'])
+  credentials = load_credentials()
 
   revoke = requests.post('https://oauth2.googleapis.com/revoke',
       params={'token': credentials.token},
@@ -170,15 +467,58 @@ def signout():
 def clear_credentials():
   if 'credentials' in session:
     del session['credentials']
+  session.pop('user', None)
+
 
+@functools.lru_cache(maxsize=None)
+def client_config():
+  """Return the parsed CLIENT_SECRETS_FILE, reading it only once."""
+  with open(CLIENT_SECRETS_FILE) as f:
+    return json.load(f)
+
+
+def make_flow(state=None):
+  """Return a flow for the OAuth 2.0 Authorization Grant, with STATE."""
+  import google_auth_oauthlib.flow
+  return google_auth_oauthlib.flow.Flow.from_client_config(
+    client_config(), scopes=SCOPES, state=state)
+
+
+def load_credentials():
+  """Return the OAuth credentials stored in the session."""
+  return workerm.credentials_from_dict(session['credentials'])
+
+
+def session_user():
+  """Return the key of the user signed in this session, or None."""
+  if 'credentials' not in session:
+    return None
+  if 'user' not in session:
+    session['user'] = user_key(load_credentials())
+  return session['user']
+
+
+def user_key(credentials):
+  """Return an opaque key identifying the owner of CREDENTIALS.
+
+  It is derived from the user's Drive identity, which stays the same
+  across sign-ins, unlike the tokens: Google sends no refresh token
+  when the user authorizes the app again.  Raises RuntimeError if
+  Drive cannot tell who the user is."""
+  try:
+    response = ratelimit.send(
+      transportm.default().get, urlm.API_ROOT + '/drive/v3/about',
+      credentials.token, timeout=urlm.API_TIMEOUT,
+      params={'fields': 'user/permissionId'},
+      headers={'Authorization': 'Bearer ' + credentials.token})
+    permission_id = response.json()['user']['permissionId']
+  except transportm.ERRORS + (ValueError, KeyError, TypeError) as e:
+    msg = 'Could not identify the user: {}'.format(e)
+    logging.error(msg)
+    raise RuntimeError(msg) from e
+  return hashlib.sha256(
+    '{}:{}'.format(credentials.client_id, permission_id).encode()).hexdigest()
 
-def credentials_to_dict(credentials):
-  return {'token': credentials.token,
-          'refresh_token': credentials.refresh_token,
-          'token_uri': credentials.token_uri,
-          'client_id': credentials.client_id,
-          'client_secret': credentials.client_secret,
-          'scopes': credentials.scopes}
 
 def print_index_table():
   return ('<table>' +
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""Batched follow-up operations on the metadata of Drive files.
+
+Once files are uploaded they may still need moving into a folder, a
+description or properties, sharing, or, for replaced copies, deleting.
+One request per file and operation makes these dominate the time spent
+on batches of small files, so a ‘Batch’ collects the operations of
+many files and sends them through Drive’s multipart batch endpoint,
+up to BATCH_SIZE calls per request.
+
+Every call of a batch succeeds or fails on its own.  Calls answered
+with a rate-limit or server error are sent again in a later batch,
+with backoff; others fail for good.  Either way the outcome is in the
+‘Operation’:
+
+    batch = Batch(token)
+    batch.add(update(file_id, description='From ' + url))
+    batch.add(share(file_id, 'someone@example.com'))
+    failed = batch.flush()
+
+See https://developers.google.com/drive/api/guides/performance#batch"""
+
+import email.parser
+import email.policy
+import json
+import logging as log
+import threading
+import time
+import urllib.parse
+import uuid
+
+import ratelimit
+import transport as transportm
+import url as urlm
+
+
+BATCH_PATH = '/batch/drive/v3'
+FILES_PATH = '/drive/v3/files'
+
+# The most calls Drive takes in one batch.
+BATCH_SIZE = 100
+
+# Times a call is sent again after a temporary error.
+MAX_RETRIES = 5
+
+# Statuses of temporary errors, besides rate limiting.
+RETRY_STATUSES = (500, 502, 503, 504)
+
+
+class Operation:
+    """One API call on the metadata of a file, and what became of it.
+
+    Once its batch is sent, ‘status’ is the HTTP status of the call,
+    ‘result’ the resource it answered with and ‘error’, if it failed,
+    a description of the error."""
+
+    def __init__(self, method, path, params=None, body=None):
+        self.method = method
+        self.path = path
+        self.params = params or {}
+        self.body = body
+        self.status = None
+        self.result = None
+        self.error = None
+        self.attempts = 0
+
+
+    def __repr__(self):
+        return '<Operation {} {}>'.format(self.method, self.path)
+
+
+    @property
+    def ok(self):
+        return self.status is not None and 200 <= self.status < 300
+
+
+    def http_request(self):
+        """Return the call as the HTTP request of a batch part."""
+
+        target = self.path
+        if self.params:
+            target += '?' + urllib.parse.urlencode(self.params)
+        lines = ['{} {} HTTP/1.1'.format(self.method, target)]
+        body = ''
+        if self.body is not None:
+            body = json.dumps(self.body)
+            lines.append('Content-Type: application/json; charset=UTF-8')
+        return '\r\n'.join(lines) + '\r\n\r\n' + body
+
+
+def move(file_id, folder_id, previous=None):
+    """Put FILE_ID into FOLDER_ID, out of the PREVIOUS folders if given."""
+
+    params = {'addParents': folder_id}
+    if previous:
+        params['removeParents'] = ','.join(previous)
+    return Operation('PATCH', '{}/{}'.format(FILES_PATH, file_id), params)
+
+
+def update(file_id, **metadata):
+    """Set METADATA of FILE_ID, e.g. description or properties."""
+
+    return Operation('PATCH', '{}/{}'.format(FILES_PATH, file_id),
+                     body=metadata)
+
+
+def share(file_id, email=None, role='reader', kind=None, notify=False):
+    """Give ROLE on FILE_ID to EMAIL, or to anyone with the link.
+
+    KIND is the type of the grantee, by default ‘user’ with an EMAIL
+    and ‘anyone’ without.  NOTIFY is whether Drive emails the user."""
+
+    body = {'role': role, 'type': kind or ('user' if email else 'anyone')}
+    params = {}
+    if email is not None:
+        body['emailAddress'] = email
+        params['sendNotificationEmail'] = 'true' if notify else 'false'
+    return Operation('POST', '{}/{}/permissions'.format(FILES_PATH, file_id),
+                     params, body)
+
+
+def delete(file_id):
+    """Delete FILE_ID for good."""
+
+    return Operation('DELETE', '{}/{}'.format(FILES_PATH, file_id))
+
+
+class _Answer:
+    """One call’s part of a batch response, with the attributes of a
+    response that ‘ratelimit.throttle_reason’ looks at."""
+
+    def __init__(self, status_code, headers, body):
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+
+
+    def json(self):
+        return json.loads(self.body)
+
+
+def _parse_part(payload):
+    """Return the ‘_Answer’ in PAYLOAD, the HTTP response of a part."""
+
+    head, _, body = payload.replace(b'\r\n', b'\n').partition(b'\n\n')
+    status_line, *header_lines = head.decode('latin-1').split('\n')
+    headers = {}
+    for line in header_lines:
+        name, _, value = line.partition(':')
+        headers[name.strip()] = value.strip()
+    return _Answer(int(status_line.split()[1]), headers, body)
+
+
+def parse_response(content_type, content):
+    """Return the answers in a batch response, by Content-ID."""
+
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + content)
+    if not message.is_multipart():
+        raise ValueError('Not a multipart response')
+
+    answers = {}
+    for part in message.iter_parts():
+        content_id = (part['Content-ID'] or '').strip('<> ')
+        # Drive answers for ‘item’ with ‘response-item’.
+        if content_id.startswith('response-'):
+            content_id = content_id[len('response-'):]
+        answers[content_id] = _parse_part(part.get_payload(decode=True))
+    return answers
+
+
+class Batch:
+    """Operations collected from many files, sent BATCH_SIZE at a time.
+
+    It may be fed from many threads at once."""
+
+    def __init__(self, token, transport=None, batch_size=BATCH_SIZE,
+                 max_retries=MAX_RETRIES):
+        """TOKEN authorizes the calls; TRANSPORT is how the API is
+        spoken to (see ‘transport’), the process-wide default if not
+        given.  BATCH_SIZE calls at most are sent in one request."""
+
+        self.token = token
+        self.transport = transport if transport is not None \
+            else transportm.default()
+        self.batch_size = min(batch_size, BATCH_SIZE)
+        self.max_retries = max_retries
+        self.sent = 0
+        self._pending = []
+        self._failed = []
+        self._lock = threading.Lock()
+
+
+    def add(self, operation):
+        """Queue OPERATION; send a batch if there is a full one.
+
+        Returns OPERATION."""
+
+        with self._lock:
+            self._pending.append(operation)
+            group = None
+            if len(self._pending) >= self.batch_size:
+                group = self._pending[:self.batch_size]
+                del self._pending[:self.batch_size]
+        if group is not None:
+            self._run(group)
+        return operation
+
+
+    def flush(self):
+        """Send the operations still queued.  Return those that failed
+        since the last flush."""
+
+        while True:
+            with self._lock:
+                group = self._pending[:self.batch_size]
+                del self._pending[:self.batch_size]
+            if not group:
+                break
+            self._run(group)
+
+        with self._lock:
+            failed, self._failed = self._failed, []
+        return failed
+
+
+    def _run(self, group):
+        """Send GROUP, and again the calls of it that may succeed later."""
+
+        calls = group
+        for attempt in range(self.max_retries + 1):
+            retry = self._send(group)
+            if not retry:
+                break
+            if attempt == self.max_retries:
+                for operation in retry:
+                    log.error('{} failed: {}'.format(operation,
+                                                     operation.error))
+                break
+            time.sleep(ratelimit.backoff(attempt))
+            group = retry
+
+        with self._lock:
+            self._failed += [operation for operation in calls
+                             if not operation.ok]
+
+
+    def _send(self, group):
+        """Send GROUP in one batch.  Return the calls to send again."""
+
+        boundary = 'batch_' + uuid.uuid4().hex
+        parts = []
+        for i, operation in enumerate(group):
+            operation.attempts += 1
+            parts.append('--{}\r\n'
+                         'Content-Type: application/http\r\n'
+                         'Content-ID: <item{}>\r\n\r\n'
+                         '{}\r\n'.format(boundary, i,
+                                         operation.http_request()))
+        body = ''.join(parts) + '--{}--\r\n'.format(boundary)
+
+        # Sent once: ‘_run’ is the only layer that retries, so a batch
+        # refused as a whole is not also retried by ‘ratelimit.send’.
+        try:
+            with ratelimit.limiter.slot(self.token) as report:
+                response = self.transport.post(
+                    urlm.API_ROOT + BATCH_PATH,
+                    headers={'Authorization': 'Bearer ' + self.token,
+                             'Content-Type':
+                             'multipart/mixed; boundary=' + boundary},
+                    data=body.encode(), timeout=urlm.API_TIMEOUT)
+                report.append(response)
+            self.sent += 1
+        except transportm.ERRORS as e:
+            return self._fail_all(group, None,
+                                  'Batch not sent: {}'.format(e), True)
+
+        status = response.status_code
+        if status != 200:
+            retry = status in RETRY_STATUSES \
+                or ratelimit.throttle_reason(response) is not None
+            return self._fail_all(group, status,
+                                  'Batch answered {}'.format(status), retry)
+
+        try:
+            answers = parse_response(response.headers.get('Content-Type', ''),
+                                     response.content)
+        except (ValueError, IndexError) as e:
+            return self._fail_all(group, None,
+                                  'Unreadable batch answer: {}'.format(e),
+                                  True)
+
+        retry = []
+        for i, operation in enumerate(group):
+            answer = answers.get('item{}'.format(i))
+            if answer is None:
+                operation.error = 'No answer in the batch'
+                retry.append(operation)
+                continue
+
+            operation.status = answer.status_code
+            if operation.ok:
+                operation.error = None
+                try:
+                    operation.result = answer.json() if answer.body else None
+                except ValueError:
+                    operation.result = None
+                continue
+
+            operation.error = _error_message(answer)
+            if answer.status_code in RETRY_STATUSES \
+               or ratelimit.throttle_reason(answer) is not None:
+                retry.append(operation)
+            else:
+                log.error('{} failed: {}'.format(operation, operation.error))
+        return retry
+
+
+    @staticmethod
+    def _fail_all(group, status, error, retry):
+        """Record that all of GROUP failed.  Return the calls to retry."""
+
+        for operation in group:
+            operation.status = status
+            operation.error = error
+        if retry:
+            return group
+        log.error('{} calls failed: {}'.format(len(group), error))
+        return []
+
+
+def _error_message(answer):
+    try:
+        return '{} {}'.format(answer.status_code,
+                              answer.json()['error']['message'])
+    except (ValueError, KeyError, TypeError):
+        return str(answer.status_code)
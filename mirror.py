@@ -0,0 +1,554 @@
+# -*- coding: utf-8 -*-
+"""Mirroring of a whole directory listing into Drive.
+
+‘crawl’ discovers the files under an index URL: an HTML directory
+listing (e.g. an Apache autoindex page, followed into subdirectories),
+a sitemap or sitemap index, or an FTP directory.  ‘Mirror’ recreates
+the directory structure as Drive folders and transfers the files
+concurrently through ‘url.Url’.  A per-user ‘Manifest’ remembers what
+was mirrored, so that running the same mirror again only transfers the
+files that are new or changed at the origin.  Changes to the metadata
+of the transferred files, e.g. removing the copies they replace, are
+sent together at the end, through ‘metadata.Batch’."""
+
+import concurrent.futures
+import fnmatch
+import hashlib
+import html.parser
+import json
+import logging as log
+import os
+import posixpath
+import tempfile
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+import xml.etree.ElementTree as ET
+
+import url as urlm
+import cancellation
+import folders
+import metadata
+import origins
+import tracing
+import transport as transportm
+
+
+# Where the per-user manifests are kept by default.
+DEFAULT_DIRECTORY = os.path.join(tempfile.gettempdir(), 'driveet-mirror')
+
+# Bounds of a crawl: index pages fetched, and subdirectory levels.
+MAX_PAGES = 1000
+MAX_DEPTH = 10
+
+# Largest index page read, in bytes.
+MAX_PAGE_SIZE = 16 * 1024 * 1024
+
+# Seconds allowed for fetching an index page or probing a file.
+TIMEOUT = 30
+
+
+class Entry:
+    """A file found by ‘crawl’.
+
+    PATH is relative to the index, with ‘/’ separators and no
+    percent-encoding.  SIZE, ETAG and MODIFIED are None when unknown."""
+
+    def __init__(self, url, path, size=None, etag=None, modified=None):
+        self.url = url
+        self.path = path
+        self.size = size
+        self.etag = etag
+        self.modified = modified
+
+
+    def __repr__(self):
+        return 'Entry({!r}, {!r})'.format(self.url, self.path)
+
+
+class _LinkParser(html.parser.HTMLParser):
+
+    def __init__(self):
+        super().__init__()
+        self.links = []
+
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            href = dict(attrs).get('href')
+            if href:
+                self.links.append(href)
+
+
+def _root(index_url):
+    """Return the directory URL that INDEX_URL lists."""
+
+    if urllib.parse.urlparse(index_url).path.endswith('/'):
+        return index_url
+    return urllib.parse.urljoin(index_url, '.')
+
+
+def _relative(url, root):
+    """Return the path of URL below ROOT, or None if it is not below."""
+
+    if not url.startswith(root) or url == root:
+        return None
+    return urllib.parse.unquote(url[len(root):])
+
+
+def _fetch(url):
+    """Return the final URL, content type and body of the page at URL."""
+
+    try:
+        with origins.urlopen(url, timeout=TIMEOUT) as response:
+            body = response.read(MAX_PAGE_SIZE + 1)
+            content_type = response.headers.get('Content-Type') or ''
+            final_url = response.url or url
+    except (ValueError, urllib.error.URLError, OSError) as e:
+        msg = 'Problems accessing index {}: {}'.format(url, e)
+        log.error(msg)
+        raise RuntimeError(msg) from e
+
+    if len(body) > MAX_PAGE_SIZE:
+        msg = 'Index {} is too large'.format(url)
+        log.error(msg)
+        raise RuntimeError(msg)
+
+    return final_url, content_type, body
+
+
+def _sitemap(body):
+    """Parse BODY as a sitemap.
+
+    Returns (whether it is a sitemap index, the URLs it lists), or None
+    if it is not a sitemap."""
+
+    try:
+        tree = ET.fromstring(body)
+    except ET.ParseError:
+        return None
+
+    tag = tree.tag.rsplit('}', 1)[-1]
+    if tag not in ('urlset', 'sitemapindex'):
+        return None
+
+    urls = [loc.text.strip() for loc in tree.iter()
+            if loc.tag.rsplit('}', 1)[-1] == 'loc' and loc.text]
+    return tag == 'sitemapindex', urls
+
+
+def _ftp_listing(page, body):
+    """Yield (URL, is a directory, size, modified) listed in BODY."""
+
+    for line in body.decode('utf-8', 'replace').splitlines():
+        # drwxr-xr-x 2 owner group 4096 Jan 1 12:00 name
+        fields = line.split(None, 8)
+        if len(fields) == 9:
+            name = fields[8]
+            is_dir = fields[0].startswith('d')
+            size = None if is_dir or not fields[4].isdigit() \
+                else int(fields[4])
+            modified = ' '.join(fields[5:8])
+        else:
+            name, is_dir, size, modified = line.strip(), False, None, None
+
+        if not name or name in ('.', '..'):
+            continue
+        href = urllib.parse.quote(name) + ('/' if is_dir else '')
+        yield urllib.parse.urljoin(page, href), is_dir, size, modified
+
+
+def crawl(index_url, max_depth=MAX_DEPTH, max_pages=MAX_PAGES, cancel=None):
+    """Yield an ‘Entry’ for every file listed under INDEX_URL.
+
+    Subdirectories are followed down to MAX_DEPTH levels, and at most
+    MAX_PAGES pages are fetched.  Only links below the directory of
+    INDEX_URL are considered, so parent directories and sort links of
+    listings are left out.  CANCEL, a ‘cancellation.CancelToken’, is
+    checked between pages.
+
+    Raises RuntimeError if INDEX_URL cannot be fetched."""
+
+    root = _root(index_url)
+    pending = [(index_url, 0)]
+    pages = set()
+    files = set()
+    while pending and len(pages) < max_pages:
+        if cancel is not None:
+            cancel.check()
+
+        page, depth = pending.pop(0)
+        if page in pages:
+            continue
+        pages.add(page)
+
+        try:
+            final_url, content_type, body = _fetch(page)
+        except RuntimeError:
+            if page == index_url:
+                raise
+            continue
+
+        # Sitemaps may list URLs anywhere; listings only count below
+        # the index.
+        anywhere = False
+        found = []
+        if urllib.parse.urlparse(final_url).scheme == 'ftp':
+            for url, is_dir, size, modified in _ftp_listing(final_url, body):
+                found.append((url, is_dir, size, modified))
+        else:
+            sitemap = None
+            if 'xml' in content_type or body.lstrip().startswith(b'<?xml'):
+                sitemap = _sitemap(body)
+            if sitemap is not None:
+                anywhere = True
+                is_index, urls = sitemap
+                for url in urls:
+                    found.append((url, is_index, None, None))
+            else:
+                parser = _LinkParser()
+                parser.feed(body.decode('utf-8', 'replace'))
+                for href in parser.links:
+                    url = urllib.parse.urljoin(final_url, href)
+                    url = urllib.parse.urldefrag(url)[0]
+                    # Query strings are the sort orders of listings.
+                    if '?' in url:
+                        continue
+                    found.append((url, url.endswith('/'), None, None))
+
+        for url, follow, size, modified in found:
+            path = _relative(url, root)
+            if path is None and not anywhere:
+                continue
+            if follow:
+                if depth < max_depth:
+                    pending.append((url, depth + 1))
+                continue
+            if path is None:
+                path = posixpath.basename(
+                    urllib.parse.unquote(urllib.parse.urlparse(url).path))
+            if path and url not in files:
+                files.add(url)
+                yield Entry(url, path, size=size, modified=modified)
+
+
+def probe(entry):
+    """Fill in the size and validators of ENTRY with a HEAD request.
+
+    Only HTTP(S) URLs are probed; problems leave ENTRY as it was."""
+
+    if urllib.parse.urlparse(entry.url).scheme not in ('http', 'https'):
+        return entry
+
+    try:
+        request = urllib.request.Request(entry.url, method='HEAD')
+        with origins.urlopen(request, timeout=TIMEOUT) as response:
+            headers = response.headers
+    except Exception:
+        return entry
+
+    length = headers.get('Content-Length')
+    if length is not None and length.isdigit():
+        entry.size = int(length)
+    entry.etag = headers.get('ETag') or entry.etag
+    entry.modified = headers.get('Last-Modified') or entry.modified
+    return entry
+
+
+class Manifest:
+    """Persistent record of what a mirror transferred.
+
+    Maps the paths of the mirrored files to their origin validators and
+    Drive file ids, and the paths of the folders to their Drive ids."""
+
+    def __init__(self, path):
+        """Keep the manifest in the JSON file at PATH."""
+
+        self.path = path
+        self._lock = threading.Lock()
+        self._data = None
+
+
+    @classmethod
+    def for_user(cls, user_key, index_url, directory=DEFAULT_DIRECTORY):
+        """Return the manifest of the mirror of INDEX_URL by USER_KEY."""
+
+        os.makedirs(directory, exist_ok=True)
+        key = '{}\n{}'.format(user_key, index_url)
+        name = hashlib.sha256(key.encode()).hexdigest() + '.json'
+        return cls(os.path.join(directory, name))
+
+
+    def _load(self):
+        if self._data is None:
+            try:
+                with open(self.path) as f:
+                    self._data = json.load(f)
+            except FileNotFoundError:
+                self._data = {}
+            except ValueError:
+                log.error('Corrupt mirror manifest {}, starting over'
+                          .format(self.path))
+                self._data = {}
+            self._data.setdefault('files', {})
+            self._data.setdefault('folders', {})
+
+        return self._data
+
+
+    def _save(self):
+        # Write to a temporary file first so that a crash never leaves
+        # a truncated manifest behind.
+        directory = os.path.dirname(self.path) or '.'
+        with tempfile.NamedTemporaryFile('w', dir=directory,
+                                         delete=False) as f:
+            json.dump(self._data, f)
+        os.replace(f.name, self.path)
+
+
+    def file(self, path):
+        """Return the record of the file at PATH, or None."""
+
+        with self._lock:
+            return self._load()['files'].get(path)
+
+
+    def set_file(self, path, record):
+        with self._lock:
+            self._load()['files'][path] = record
+            self._save()
+
+
+    def folders(self):
+        """Return the Drive ids of the folders, by path."""
+
+        with self._lock:
+            return dict(self._load()['folders'])
+
+
+    def set_folder(self, path, folder_id):
+        with self._lock:
+            self._load()['folders'][path] = folder_id
+            self._save()
+
+
+def unchanged(entry, record):
+    """Tell if ENTRY is the same as when RECORD was made.
+
+    The ETag decides when there is one; otherwise both the modification
+    time and the size must match.  Files without validators always
+    count as changed."""
+
+    if record is None or record.get('file_id') is None:
+        return False
+    if entry.etag is not None:
+        return entry.etag == record.get('etag')
+    return (entry.modified is not None
+            and entry.modified == record.get('modified')
+            and entry.size == record.get('size'))
+
+
+class MirrorResult:
+    """Outcome of a ‘Mirror.run()’: paths by what happened to them."""
+
+    def __init__(self):
+        self.transferred = []
+        self.unchanged = []
+        self.failed = []
+
+
+    def summary(self):
+        msg = 'Mirrored {} files: {} transferred, {} unchanged'.format(
+            len(self.transferred) + len(self.unchanged),
+            len(self.transferred), len(self.unchanged))
+        if self.failed:
+            msg += ', {} failed'.format(len(self.failed))
+        return msg + '.'
+
+
+class Mirror:
+    """Mirror of an index URL into a Drive folder."""
+
+    def __init__(self, index_url, token, manifest=None, include=None,
+                 exclude=None, min_size=None, max_size=None,
+                 folder_name=None, workers=4, submit=None, progress=None,
+                 cancel=None, max_depth=MAX_DEPTH, transport=None,
+                 follow_up=None):
+        """Mirror INDEX_URL with TOKEN.
+
+        MANIFEST, a ‘Manifest’, makes re-runs incremental.  INCLUDE and
+        EXCLUDE are lists of glob patterns, matched against the paths
+        and the names of the files.  Files smaller than MIN_SIZE or
+        larger than MAX_SIZE bytes are left out; files of unknown size
+        are kept.  FOLDER_NAME is the name of the top folder in Drive,
+        by default the last component of the index directory.
+
+        Files are transferred by SUBMIT(fn, size=...), which returns a
+        future, e.g. a bound ‘scheduler.FairScheduler.submit’; by
+        default WORKERS threads of the mirror’s own.  PROGRESS, if
+        given, counts the files done, and CANCEL stops the mirror.
+
+        FOLLOW_UP(entry, file_id), if given, returns the
+        ‘metadata.Operation’s to apply to each file transferred, e.g.
+        sharing it; they are sent in batches."""
+
+        self.index_url = index_url
+        self.token = token
+        self.manifest = manifest
+        self.include = include or []
+        self.exclude = exclude or []
+        self.min_size = min_size
+        self.max_size = max_size
+        self.folder_name = folder_name
+        self.workers = workers
+        self.submit = submit
+        self.progress = progress
+        self.cancel = cancel
+        self.max_depth = max_depth
+        self.transport = transport if transport is not None \
+            else transportm.default()
+        self.follow_up = follow_up
+        self.batch = metadata.Batch(token, transport=self.transport)
+        self.folders = folders.FolderTree(
+            token, self._top_name(),
+            known=manifest.folders() if manifest is not None else None,
+            on_create=manifest.set_folder if manifest is not None else None,
+            transport=self.transport)
+
+
+    def _matches(self, path, patterns):
+        name = posixpath.basename(path)
+        return any(fnmatch.fnmatchcase(path, pattern)
+                   or fnmatch.fnmatchcase(name, pattern)
+                   for pattern in patterns)
+
+
+    def wanted(self, entry):
+        """Tell if ENTRY passes the filters of this mirror."""
+
+        if self.include and not self._matches(entry.path, self.include):
+            return False
+        if self._matches(entry.path, self.exclude):
+            return False
+        if entry.size is not None:
+            if self.min_size is not None and entry.size < self.min_size:
+                return False
+            if self.max_size is not None and entry.size > self.max_size:
+                return False
+        return True
+
+
+    def _top_name(self):
+        if self.folder_name:
+            return self.folder_name
+        parsed = urllib.parse.urlparse(_root(self.index_url))
+        name = posixpath.basename(parsed.path.rstrip('/'))
+        return urllib.parse.unquote(name) or parsed.hostname or 'mirror'
+
+
+    def _transfer(self, entry):
+        """Mirror ENTRY.  Return whether it had to be transferred."""
+
+        if self.cancel is not None:
+            self.cancel.check()
+
+        record = None
+        if self.manifest is not None:
+            record = self.manifest.file(entry.path)
+            if unchanged(entry, record) \
+               and folders.exists(record['file_id'], self.token,
+                                  self.transport, self.cancel):
+                return False
+
+        parent = self.folders.get(posixpath.dirname(entry.path))
+
+        # Each file gets a token of its own, for its phases; cancelling
+        # the mirror cancels them all.
+        cancel = cancellation.CancelToken(
+            None if self.cancel is None else self.cancel.remaining())
+        forget = lambda: None
+        if self.cancel is not None:
+            forget = self.cancel.on_cancel(cancel.cancel)
+        try:
+            url = urlm.Url(entry.url, self.token, cancel=cancel,
+                           transport=self.transport,
+                           name=posixpath.basename(entry.path),
+                           parents=[parent])
+            filename, _ = url.drive_it()
+            os.remove(filename)
+        finally:
+            forget()
+
+        if self.follow_up is not None:
+            for operation in self.follow_up(entry, url.file_id):
+                self.batch.add(operation)
+
+        if self.manifest is not None:
+            # The previous copy of a changed file is replaced.
+            old_id = record and record.get('file_id')
+            if old_id and old_id != url.file_id:
+                self.batch.add(metadata.delete(old_id))
+            self.manifest.set_file(entry.path, {
+                'url': entry.url,
+                'size': entry.size,
+                'etag': entry.etag,
+                'modified': entry.modified,
+                'file_id': url.file_id})
+
+        return True
+
+
+    @tracing.traced('mirror')
+    def run(self):
+        """Crawl, filter and transfer.  Return a ‘MirrorResult’.
+
+        Files that fail are reported in the result.  Raises
+        RuntimeError if the index cannot be read, and
+        ‘cancellation.Cancelled’ if the mirror was cancelled."""
+
+        result = MirrorResult()
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+            entries = list(crawl(self.index_url, self.max_depth,
+                                 cancel=self.cancel))
+            entries = [entry for entry in pool.map(probe, entries)
+                       if self.wanted(entry)]
+
+            if self.progress is not None:
+                self.progress.start('mirror', len(entries))
+
+            submit = self.submit or \
+                (lambda fn, *args, size=None:
+                 pool.submit(tracing.bind(fn), *args))
+            futures = {submit(self._transfer, entry, size=entry.size): entry
+                       for entry in entries}
+
+            done = 0
+            for future in concurrent.futures.as_completed(futures):
+                entry = futures[future]
+                try:
+                    transferred = future.result()
+                except (concurrent.futures.CancelledError,
+                        cancellation.Cancelled):
+                    for other in futures:
+                        other.cancel()
+                except RuntimeError as e:
+                    result.failed.append((entry.path, str(e)))
+                except Exception:
+                    log.exception('Mirroring {} failed'.format(entry.url))
+                    result.failed.append((entry.path, 'Unexpected error'))
+                else:
+                    (result.transferred if transferred
+                     else result.unchanged).append(entry.path)
+
+                done += 1
+                if self.progress is not None:
+                    self.progress.update(done)
+
+        # Calls that fail are logged; the files are mirrored anyway.
+        self.batch.flush()
+
+        if self.cancel is not None:
+            self.cancel.check()
+
+        return result
@@ -0,0 +1,474 @@
+# -*- coding: utf-8 -*-
+"""Kept-alive connections to origin servers, and cached DNS answers.
+
+‘urllib.request.urlopen’ looks the host up, connects and, for HTTPS,
+negotiates TLS again for every URL, which dominates the time spent on
+batches of small files from one host (mirrors, ranged reads of
+archives).  ‘urlopen’ here answers the same way but takes the
+connection from a per-host pool, and puts it back once the response
+is read; no more than PER_HOST connections to a host are in use at
+once.  Host names are resolved through a cache whose entries last
+DNS_TTL seconds: ‘socket.getaddrinfo’ does not tell the TTL of the
+records, so it is a setting.
+
+One pool, ‘pool’, is shared by all ‘url.Url’ instances of the
+process.  URLs that are not HTTP(S), and every URL when a proxy is
+configured, go through ‘urllib.request.urlopen’ as before."""
+
+import functools
+import http.client
+import os
+import socket
+import ssl
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+
+# Connections to one host that may be in use at once.
+PER_HOST = int(os.environ.get('DRIVEET_ORIGIN_CONNECTIONS', 8))
+
+# Seconds an idle connection is kept; servers close them after a few.
+IDLE_TIMEOUT = 15.0
+
+# Seconds DNS answers, and failures to resolve, are kept.
+DNS_TTL = float(os.environ.get('DRIVEET_DNS_TTL', 60))
+DNS_NEGATIVE_TTL = 5.0
+
+# Bytes of a response left unread that are read anyway, to keep its
+# connection.
+DRAIN = 64 * 1024
+
+MAX_REDIRECTS = 10
+REDIRECTS = (301, 302, 303, 307, 308)
+
+USER_AGENT = 'Python-urllib/' + urllib.request.__version__
+
+
+class DnsCache:
+    """Answers of ‘socket.getaddrinfo’, kept for TTL seconds."""
+
+    def __init__(self, ttl=DNS_TTL, negative_ttl=DNS_NEGATIVE_TTL):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+    def resolve(self, host, port):
+        """Return the addresses of HOST, as ‘socket.getaddrinfo’ does.
+
+        Raises ‘socket.gaierror’ if HOST cannot be resolved."""
+
+        key = (host, port)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                if isinstance(entry[1], Exception):
+                    raise entry[1]
+                return entry[1]
+            self.misses += 1
+
+        try:
+            addresses = socket.getaddrinfo(host, port,
+                                           type=socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            with self._lock:
+                self._entries[key] = (now + self.negative_ttl, e)
+            raise
+
+        with self._lock:
+            self._entries[key] = (now + self.ttl, addresses)
+        return addresses
+
+
+    def forget(self, host, port):
+        with self._lock:
+            self._entries.pop((host, port), None)
+
+
+    def create_connection(self, address, timeout=None, source_address=None):
+        """Connect to ADDRESS, a (host, port), as
+        ‘socket.create_connection’ does, with the cached addresses.
+
+        When none of them answers, they are forgotten: the host may
+        have moved."""
+
+        host, port = address
+        error = None
+        for family, type_, proto, _, sockaddr in self.resolve(host, port):
+            sock = socket.socket(family, type_, proto)
+            try:
+                if timeout is not None:
+                    sock.settimeout(timeout)
+                if source_address:
+                    sock.bind(source_address)
+                sock.connect(sockaddr)
+                return sock
+            except OSError as e:
+                error = e
+                sock.close()
+
+        self.forget(host, port)
+        raise error if error is not None \
+            else OSError('No address for {}'.format(host))
+
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'entries': len(self._entries)}
+
+
+class _Host:
+    """The connections to one host and what became of them."""
+
+    def __init__(self, limit):
+        self.free = limit
+        self.idle = []
+        self.lock = threading.Lock()
+        # Signalled when a slot is freed, or a waiter is cancelled.
+        self.cond = threading.Condition(self.lock)
+        self.in_flight = 0
+        self.requests = 0
+        self.connections = 0
+        self.reused = 0
+        self.stale = 0
+        self.waits = 0
+
+
+class _Response:
+    """An HTTP response whose connection goes back to the pool when
+    it is closed.  It has the attributes of the responses of
+    ‘urllib.request.urlopen’ that the rest of the code uses."""
+
+    def __init__(self, pool, key, connection, response, url, sock=None):
+        self._pool = pool
+        self._key = key
+        self._connection = connection
+        self._response = response
+        # The connection lets go of its socket once it is to be closed
+        # after the response.
+        self._sock = sock
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+
+
+    def read(self, amt=None):
+        return self._response.read(amt)
+
+
+    def readinto(self, buffer):
+        return self._response.readinto(buffer)
+
+
+    def getcode(self):
+        return self.status
+
+
+    def geturl(self):
+        return self.url
+
+
+    def info(self):
+        return self.headers
+
+
+    def abort(self):
+        """Interrupt reads of the response blocked in another thread.
+
+        The connection is not reused."""
+
+        if self._connection is not None and self._sock is not None:
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+    def close(self):
+        if self._connection is None:
+            return
+        # A response read to its end leaves the connection ready for
+        # the next request; otherwise the rest of it is still coming,
+        # and only a little is worth waiting for.
+        response = self._response
+        if not response.isclosed() and not response.will_close \
+           and response.length is not None and response.length <= DRAIN:
+            try:
+                response.read()
+            except (OSError, http.client.HTTPException):
+                pass
+        reusable = response.isclosed() and not response.will_close
+        if not reusable:
+            response.close()
+        self._pool._release(self._key, self._connection, reusable)
+        self._connection = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class OriginPool:
+    """Per-host pools of kept-alive HTTP(S) connections."""
+
+    def __init__(self, per_host=PER_HOST, dns=None,
+                 idle_timeout=IDLE_TIMEOUT, ssl_context=None):
+        self.per_host = per_host
+        self.dns = dns if dns is not None else DnsCache()
+        self.idle_timeout = idle_timeout
+        # Loading the CA certificates takes a while: they are only
+        # loaded for the first HTTPS connection.
+        self._ssl_context = ssl_context
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+
+    @property
+    def ssl_context(self):
+        with self._lock:
+            if self._ssl_context is None:
+                self._ssl_context = ssl.create_default_context()
+            return self._ssl_context
+
+
+    def _host(self, key):
+        with self._lock:
+            host = self._hosts.get(key)
+            if host is None:
+                host = self._hosts[key] = _Host(self.per_host)
+            return host
+
+
+    def _acquire(self, key, timeout, cancel=None):
+        """Take a connection to KEY, a (scheme, host, port).
+
+        Returns it and whether it was used before.  Waits up to
+        TIMEOUT seconds for one of the host’s slots; CANCEL, a
+        ‘cancellation.CancelToken’, cuts the wait short, raising
+        ‘cancellation.Cancelled’."""
+
+        host = self._host(key)
+        forget = lambda: None
+        if cancel is not None:
+            forget = cancel.on_cancel(functools.partial(self._wake, host))
+        try:
+            self._take_slot(host, key, timeout, cancel)
+        finally:
+            forget()
+
+        now = time.monotonic()
+        with host.lock:
+            while host.idle:
+                connection, since = host.idle.pop()
+                if now - since < self.idle_timeout:
+                    return connection, True
+                connection.close()
+
+        scheme, hostname, port = key
+        if scheme == 'https':
+            connection = http.client.HTTPSConnection(
+                hostname, port, context=self.ssl_context)
+        else:
+            connection = http.client.HTTPConnection(hostname, port)
+        connection._create_connection = self.dns.create_connection
+        with host.lock:
+            host.connections += 1
+        return connection, False
+
+
+    def _take_slot(self, host, key, timeout, cancel):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with host.cond:
+            if not host.free:
+                host.waits += 1
+            while not host.free:
+                if cancel is not None:
+                    cancel.check()
+                wait = None
+                if deadline is not None:
+                    wait = deadline - time.monotonic()
+                    if wait <= 0:
+                        raise urllib.error.URLError(
+                            'No free connection to {}'.format(key[1]))
+                if cancel is not None and cancel.remaining() is not None:
+                    wait = cancel.remaining() if wait is None \
+                        else min(wait, cancel.remaining())
+                host.cond.wait(wait)
+            host.free -= 1
+            host.in_flight += 1
+
+
+    def _wake(self, host):
+        with host.cond:
+            host.cond.notify_all()
+
+
+    def _release(self, key, connection, reusable):
+        host = self._host(key)
+        with host.cond:
+            host.in_flight -= 1
+            if reusable:
+                host.idle.append((connection, time.monotonic()))
+            host.free += 1
+            host.cond.notify()
+        if not reusable:
+            connection.close()
+
+
+    def _request(self, method, url, headers, timeout, cancel=None):
+        """Send one request for URL.  Return its ‘_Response’."""
+
+        parts = urllib.parse.urlsplit(url)
+        if not parts.hostname:
+            raise urllib.error.URLError('no host given')
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        key = (parts.scheme, parts.hostname, port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        host = self._host(key)
+        with host.lock:
+            host.requests += 1
+
+        # A kept-alive connection may have been closed by the server
+        # meanwhile; that is only known once it is used again.
+        while True:
+            connection, reused = self._acquire(key, timeout, cancel)
+            try:
+                connection.timeout = timeout
+                if connection.sock is not None:
+                    connection.sock.settimeout(timeout)
+                connection.request(method, path, headers=headers)
+                sock = connection.sock
+                response = connection.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionError) as e:
+                self._release(key, connection, False)
+                if not reused:
+                    raise urllib.error.URLError(e) from e
+                with host.lock:
+                    host.stale += 1
+                continue
+            except (OSError, http.client.HTTPException) as e:
+                self._release(key, connection, False)
+                if isinstance(e, (socket.timeout, urllib.error.URLError)):
+                    raise
+                raise urllib.error.URLError(e) from e
+            except BaseException:
+                self._release(key, connection, False)
+                raise
+
+            if reused:
+                with host.lock:
+                    host.reused += 1
+            return _Response(self, key, connection, response, url, sock)
+
+
+    def urlopen(self, request, timeout=None, cancel=None):
+        """Open REQUEST, a URL or a ‘urllib.request.Request’ without a
+        body, following redirects.
+
+        Raises ‘urllib.error.HTTPError’ for error statuses and
+        ‘urllib.error.URLError’ when the server cannot be reached, as
+        ‘urllib.request.urlopen’ does.  CANCEL stops the wait for a
+        free connection, as in ‘_acquire’."""
+
+        if isinstance(request, str):
+            request = urllib.request.Request(request)
+        method = request.get_method()
+        headers = {'User-Agent': USER_AGENT}
+        headers.update(request.header_items())
+        url = request.full_url
+
+        for _ in range(MAX_REDIRECTS + 1):
+            response = self._request(method, url, headers, timeout, cancel)
+            location = response.headers.get('Location')
+            if response.status in REDIRECTS and location:
+                response.read()
+                response.close()
+                url = urllib.parse.urljoin(url, location)
+                if response.status == 303:
+                    method = 'GET' if method != 'HEAD' else method
+                continue
+
+            if response.status >= 400:
+                response.close()
+                raise urllib.error.HTTPError(url, response.status,
+                                             response.reason,
+                                             response.headers, None)
+            return response
+
+        raise urllib.error.HTTPError(url, response.status,
+                                     'Too many redirects',
+                                     response.headers, None)
+
+
+    def stats(self):
+        """Return, by host, the requests sent and the connections used."""
+
+        with self._lock:
+            hosts = dict(self._hosts)
+
+        def describe(host):
+            with host.lock:
+                return {'requests': host.requests,
+                        'connections': host.connections,
+                        'reused': host.reused,
+                        'reuse_ratio': round(host.reused / host.requests, 3)
+                        if host.requests else 0.0,
+                        'stale': host.stale,
+                        'waits': host.waits,
+                        'in_flight': host.in_flight,
+                        'idle': len(host.idle)}
+
+        return {'hosts': {'{}://{}:{}'.format(*key): describe(host)
+                          for key, host in hosts.items()},
+                'dns': self.dns.stats()}
+
+
+    def close(self):
+        """Close the idle connections."""
+
+        with self._lock:
+            hosts = list(self._hosts.values())
+        for host in hosts:
+            with host.lock:
+                idle, host.idle = host.idle, []
+            for connection, _ in idle:
+                connection.close()
+
+
+pool = OriginPool()
+
+
+def urlopen(request, timeout=None, cancel=None):
+    """Open REQUEST, a URL or a ‘urllib.request.Request’, through
+    ‘pool’ if it is an HTTP(S) one without a body or a proxy.
+
+    CANCEL, a ‘cancellation.CancelToken’, stops the wait for a free
+    connection of the pool."""
+
+    url = request if isinstance(request, str) else request.full_url
+    parts = urllib.parse.urlsplit(url)
+    proxied = urllib.request.getproxies().get(parts.scheme) \
+        and not urllib.request.proxy_bypass(parts.hostname or '')
+    if parts.scheme not in ('http', 'https') or proxied \
+       or getattr(request, 'data', None) is not None:
+        kwargs = {} if timeout is None else {'timeout': timeout}
+        return urllib.request.urlopen(request, **kwargs)
+
+    return pool.urlopen(request, timeout, cancel)
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""Measure the cold start of the web app.
+
+Starts fresh interpreters, as a new App Engine instance would, and
+reports for each of them how long ‘import main’ took, then how long the
+warmup request and the first page took.  The slowest imports, from
+‘python -X importtime’, are listed as well.
+
+    python profile_startup.py --runs 5 --top 15
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+
+# Run in the child interpreter; prints its measurements as JSON.
+CHILD = '''
+import json, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+client = main.app.test_client()
+client.get('/_ah/warmup')
+warmed = time.perf_counter()
+client.get('/')
+served = time.perf_counter()
+print(json.dumps({'import': imported - start,
+                  'warmup': warmed - imported,
+                  'first_request': served - warmed}))
+'''
+
+
+def run_child(env):
+    """Cold-start the app once.  Return the timings, in seconds."""
+
+    result = subprocess.run([sys.executable, '-c', CHILD], env=env,
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def import_profile(env):
+    """Return (cumulative µs, module) of every import of ‘main’."""
+
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                             'import main'],
+                            env=env, capture_output=True, text=True,
+                            check=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line.split('|')
+        imports.append((int(cumulative), module.rstrip()))
+
+    return imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=5,
+                        help='cold starts to measure')
+    parser.add_argument('--top', type=int, default=15,
+                        help='slowest imports to list')
+    args = parser.parse_args()
+
+    env = dict(os.environ, SECRET_KEY=os.environ.get('SECRET_KEY', 'x'))
+    runs = [run_child(env) for _ in range(args.runs)]
+
+    print('Cold start over {} runs (ms):'.format(args.runs))
+    print('{:15} {:>8} {:>8} {:>8}'.format('', 'median', 'min', 'max'))
+    for phase in ('import', 'warmup', 'first_request'):
+        values = [1000 * run[phase] for run in runs]
+        print('{:15} {:>8.1f} {:>8.1f} {:>8.1f}'.format(
+            phase, statistics.median(values), min(values), max(values)))
+
+    print('\nSlowest imports of main (cumulative ms):')
+    for cumulative, module in sorted(import_profile(env),
+                                     reverse=True)[:args.top]:
+        print('{:>8.1f}  {}'.format(cumulative / 1000, module))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""Progress of in-flight transfers.
+
+‘url.Url’ reports the bytes done in each phase (download, upload) to a
+‘Progress’.  Updates are coalesced: the hot loop only pays for a clock
+read, and listeners are woken at most once per PUBLISH_INTERVAL.  The
+web app streams the published snapshots as Server-Sent Events."""
+
+import json
+import threading
+import time
+import uuid
+
+
+# Seconds between two published updates of a transfer.
+PUBLISH_INTERVAL = 0.25
+
+# Weight of the latest measurement in the smoothed rate.
+RATE_SMOOTHING = 0.3
+
+# Seconds a finished transfer remains available to listeners.
+FINISHED_TTL = 10 * 60
+
+# Seconds between keep-alive comments on an idle event stream.
+HEARTBEAT = 15
+
+
+class Progress:
+    """Bytes done, total, rate and ETA of one transfer."""
+
+    def __init__(self, owner=None):
+        self.id = uuid.uuid4().hex
+        self.owner = owner
+        self.state = 'queued'
+        self.phase = None
+        self.done = 0
+        self.total = None
+        self.rate = None
+        self.message = None
+        self.finished_at = None
+        self.version = 0
+        self._cond = threading.Condition()
+        self._next_publish = 0.0
+        self._last = (time.monotonic(), 0)
+
+
+    def start(self, phase, total=None):
+        """Begin PHASE, which is TOTAL bytes long if known."""
+
+        with self._cond:
+            self.state = 'running'
+            self.phase = phase
+            self.done = 0
+            self.total = total
+            self.rate = None
+            self._last = (time.monotonic(), 0)
+            self._publish()
+
+
+    def update(self, done):
+        """Record that DONE bytes of the current phase are complete.
+
+        Cheap enough to be called for every block read or written."""
+
+        self.done = done
+        now = time.monotonic()
+        if now < self._next_publish and done != self.total:
+            return
+
+        with self._cond:
+            then, done_then = self._last
+            if now > then:
+                rate = (done - done_then) / (now - then)
+                self.rate = rate if self.rate is None else \
+                    RATE_SMOOTHING * rate + (1 - RATE_SMOOTHING) * self.rate
+            self._last = (now, done)
+            self._publish()
+
+
+    def finish(self, message=None):
+        """Mark the transfer as successfully complete."""
+
+        self._end('done', message)
+
+
+    def fail(self, message):
+        """Mark the transfer as failed with MESSAGE."""
+
+        self._end('error', message)
+
+
+    def _end(self, state, message):
+        with self._cond:
+            self.state = state
+            self.message = message
+            self.finished_at = time.monotonic()
+            self._publish()
+
+
+    def _publish(self):
+        # Must be called with the lock held.
+        self.version += 1
+        self._next_publish = time.monotonic() + PUBLISH_INTERVAL
+        self._cond.notify_all()
+
+
+    @property
+    def finished(self):
+        return self.state in ('done', 'error')
+
+
+    def snapshot(self):
+        """Return the published state as a dictionary."""
+
+        eta = None
+        if self.rate and self.total is not None:
+            eta = max(0.0, (self.total - self.done) / self.rate)
+
+        return {'id': self.id,
+                'state': self.state,
+                'phase': self.phase,
+                'done': self.done,
+                'total': self.total,
+                'rate': self.rate,
+                'eta': eta,
+                'message': self.message}
+
+
+    def wait(self, version, timeout=None):
+        """Block until there is something newer than VERSION.
+
+        Returns the current version, which is VERSION on timeout."""
+
+        with self._cond:
+            self._cond.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+
+    def events(self, heartbeat=HEARTBEAT):
+        """Generate the Server-Sent Events stream of this transfer.
+
+        One event per published update; the stream ends once the
+        transfer is finished."""
+
+        version = None
+        while True:
+            current = self.wait(version, heartbeat)
+            if current == version:
+                # Keeps proxies from dropping an idle connection.
+                yield ': keep-alive\n\n'
+                continue
+
+            version = current
+            snapshot = self.snapshot()
+            yield 'data: {}\n\n'.format(json.dumps(snapshot))
+            # Not ‘self.finished’: the transfer may have finished since
+            # the snapshot, whose event must not be the last one then.
+            if snapshot['state'] in ('done', 'error'):
+                return
+
+
+def poll_events(fetch, interval=1.0, heartbeat=HEARTBEAT):
+    """Generate Server-Sent Events by polling FETCH every INTERVAL.
+
+    FETCH returns a snapshot dictionary, as ‘Progress.snapshot()’ does,
+    or None if the transfer is gone.  This is for transfers running
+    elsewhere, e.g. in another instance (see ‘store’)."""
+
+    last, quiet = None, 0.0
+    while True:
+        snapshot = fetch()
+        if snapshot is None:
+            return
+        if snapshot != last:
+            last, quiet = snapshot, 0.0
+            yield 'data: {}\n\n'.format(json.dumps(snapshot))
+            if snapshot['state'] in ('done', 'error'):
+                return
+        elif quiet >= heartbeat:
+            quiet = 0.0
+            yield ': keep-alive\n\n'
+
+        time.sleep(interval)
+        quiet += interval
+
+
+class Registry:
+    """Transfers in flight, by id."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._transfers = {}
+
+
+    def create(self, owner=None):
+        """Register and return a new ‘Progress’ owned by OWNER."""
+
+        progress = Progress(owner)
+        now = time.monotonic()
+        with self._lock:
+            # Forget transfers nobody is going to ask about anymore.
+            for key, old in list(self._transfers.items()):
+                if old.finished and now - old.finished_at > FINISHED_TTL:
+                    del self._transfers[key]
+            self._transfers[progress.id] = progress
+
+        return progress
+
+
+    def get(self, id):
+        """Return the ‘Progress’ with ID, or None."""
+
+        with self._lock:
+            return self._transfers.get(id)
+
+
+registry = Registry()
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""Adaptive (AIMD) concurrency limits for Drive API requests.
+
+Drive answers 403 ‘userRateLimitExceeded’ or 429 when it receives too
+many requests at once.  The limiter here keeps the number of requests
+in flight under a per-token and a global limit.  Every successful
+request raises the limits additively (about one more slot per window
+of requests) and every rate-limit answer cuts them multiplicatively,
+so the process settles just under what the API accepts.
+
+One limiter, ‘limiter’, is shared by all ‘url.Url’ instances of the
+process."""
+
+import contextlib
+import hashlib
+import random
+import threading
+import time
+
+import tracing
+
+
+# Reasons in a 403 body that mean “slow down” rather than “forbidden”.
+RATE_LIMIT_REASONS = ('userRateLimitExceeded', 'rateLimitExceeded')
+
+# Retrying a throttled request.
+MAX_RETRIES = 8
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 32.0
+
+
+def throttle_reason(response):
+    """Return why RESPONSE was throttled, or None if it was not.
+
+    The reason is ‘user’ for per-user limits and ‘global’ for limits
+    of the whole project."""
+
+    status = getattr(response, 'status_code', None)
+    if status == 429:
+        return 'global'
+    if status != 403:
+        return None
+
+    try:
+        errors = response.json()['error']['errors']
+        reasons = [error.get('reason') for error in errors]
+    except (ValueError, KeyError, TypeError):
+        return None
+
+    if 'userRateLimitExceeded' in reasons:
+        return 'user'
+    if 'rateLimitExceeded' in reasons:
+        return 'global'
+    return None
+
+
+def backoff(attempt, response=None):
+    """Seconds to wait before retrying for the ATTEMPT-th time.
+
+    Honors the ‘Retry-After’ header of RESPONSE when it is given in
+    seconds, up to BACKOFF_MAX; otherwise uses exponential backoff
+    with jitter."""
+
+    try:
+        return min(BACKOFF_MAX, float(response.headers['Retry-After']))
+    except (AttributeError, KeyError, TypeError, ValueError):
+        pass
+
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+
+def _succeeded(response):
+    status = getattr(response, 'status_code', None)
+    return status == 308 or status in range(200, 300)
+
+
+class _Limit:
+    """One adaptive limit and the requests in flight under it.
+
+    ‘users’ counts the requests holding on to it, waiting for a slot or
+    in flight; a per-token limit is only forgotten once there are
+    none."""
+
+    def __init__(self, initial, key=None):
+        self.key = key
+        self.limit = float(initial)
+        self.in_flight = 0
+        self.users = 0
+        self.last_cut = 0.0
+        self.successes = 0
+        self.throttles = 0
+
+
+class AIMDLimiter:
+    """Per-token and global AIMD concurrency limits."""
+
+    def __init__(self, initial=4, minimum=1, maximum=32,
+                 global_initial=16, global_maximum=128,
+                 increase=1.0, decrease=0.5, cooldown=1.0):
+        """Create the limits.
+
+        INITIAL, MINIMUM and MAXIMUM bound the per-token limits;
+        GLOBAL_INITIAL and GLOBAL_MAXIMUM the global one.  INCREASE is
+        added per window of successful requests and DECREASE multiplies
+        the limit on a rate-limit answer, at most once per COOLDOWN
+        seconds, since the requests of one burst are throttled
+        together."""
+
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.global_maximum = global_maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self._global = _Limit(global_initial)
+        self._tokens = {}
+        self._cond = threading.Condition()
+
+
+    @staticmethod
+    def _key(token):
+        # Tokens are secrets; only a digest is kept and reported.
+        return hashlib.sha256(token.encode()).hexdigest()[:16]
+
+
+    def _has_room(self, limit):
+        return limit.in_flight < max(self.minimum, int(limit.limit))
+
+
+    def acquire(self, token, cancel=None):
+        """Block until a request for TOKEN may be sent.
+
+        Returns the per-token limit, to be given back to ‘release’.
+        Raises ‘cancellation.Cancelled’ if CANCEL, a
+        ‘cancellation.CancelToken’, is cancelled or its deadline passes
+        meanwhile."""
+
+        key = self._key(token)
+        forget = lambda: None
+        if cancel is not None:
+            forget = cancel.on_cancel(self._wake)
+        try:
+            with self._cond:
+                per_token = self._tokens.get(key)
+                if per_token is None:
+                    per_token = self._tokens[key] = _Limit(self.initial, key)
+                per_token.users += 1
+                try:
+                    while not (self._has_room(per_token)
+                               and self._has_room(self._global)):
+                        if cancel is not None:
+                            cancel.check()
+                        self._cond.wait(None if cancel is None
+                                        else cancel.remaining())
+                    if cancel is not None:
+                        cancel.check()
+                except BaseException:
+                    per_token.users -= 1
+                    self._forget_idle(per_token)
+                    raise
+                per_token.in_flight += 1
+                self._global.in_flight += 1
+                return per_token
+        finally:
+            forget()
+
+
+    def _wake(self):
+        with self._cond:
+            self._cond.notify_all()
+
+
+    def _grow(self, limit, maximum):
+        limit.successes += 1
+        limit.limit = min(maximum,
+                          limit.limit + self.increase / limit.limit)
+
+
+    def _cut(self, limit, now):
+        limit.throttles += 1
+        if now - limit.last_cut >= self.cooldown:
+            limit.limit = max(self.minimum, limit.limit * self.decrease)
+            limit.last_cut = now
+
+
+    def _forget_idle(self, per_token):
+        # Forget tokens that are unused and back to normal.
+        if not per_token.users and per_token.limit >= self.initial \
+           and self._tokens.get(per_token.key) is per_token:
+            del self._tokens[per_token.key]
+
+
+    def release(self, per_token, response=None):
+        """Give back the slot taken with PER_TOKEN, the limit returned
+        by ‘acquire’, and adapt to its RESPONSE."""
+
+        reason = throttle_reason(response)
+        with self._cond:
+            per_token.in_flight -= 1
+            per_token.users -= 1
+            self._global.in_flight -= 1
+
+            now = time.monotonic()
+            if reason is None:
+                # Only answers that went through tell there is room;
+                # errors say nothing about the limits.
+                if _succeeded(response):
+                    self._grow(per_token, self.maximum)
+                    self._grow(self._global, self.global_maximum)
+            else:
+                self._cut(per_token, now)
+                if reason == 'global':
+                    self._cut(self._global, now)
+
+            self._forget_idle(per_token)
+            self._cond.notify_all()
+
+
+    @contextlib.contextmanager
+    def slot(self, token, cancel=None):
+        """Hold a slot for TOKEN while in the ‘with’ block.
+
+        The block reports the response it got through the yielded
+        list, so it can be taken into account:
+
+            with limiter.slot(token) as report:
+                report.append(requests.put(...))
+
+        CANCEL stops the wait for the slot, as in ‘acquire’."""
+
+        per_token = self.acquire(token, cancel)
+        report = []
+        try:
+            yield report
+        finally:
+            self.release(per_token, report[-1] if report else None)
+
+
+    def stats(self):
+        """Return the current limits and requests in flight."""
+
+        def describe(limit):
+            return {'limit': round(limit.limit, 2),
+                    'in_flight': limit.in_flight,
+                    'successes': limit.successes,
+                    'throttles': limit.throttles}
+
+        with self._cond:
+            return {'global': describe(self._global),
+                    'tokens': {key: describe(limit)
+                               for key, limit in self._tokens.items()}}
+
+
+limiter = AIMDLimiter()
+
+
+def _sleep(seconds, cancel):
+    """Wait SECONDS, or until CANCEL is cancelled or its deadline."""
+
+    if cancel is None:
+        time.sleep(seconds)
+        return
+
+    woken = threading.Event()
+    forget = cancel.on_cancel(woken.set)
+    try:
+        remaining = cancel.remaining()
+        woken.wait(seconds if remaining is None
+                   else min(seconds, remaining))
+    finally:
+        forget()
+    cancel.check()
+
+
+def send(method, url, token, cancel=None, **kwargs):
+    """Send METHOD(URL, **KWARGS) within the limits of TOKEN.
+
+    METHOD is e.g. ‘requests.put’.  Throttled requests are retried
+    with backoff, up to MAX_RETRIES times; the last response is
+    returned in any case.  Every attempt is traced as a span.
+
+    CANCEL, a ‘cancellation.CancelToken’, cuts the waits for a slot
+    and between attempts short, raising ‘cancellation.Cancelled’, and
+    its deadline bounds the ‘timeout’ of every attempt."""
+
+    timeout = kwargs.get('timeout')
+    for attempt in range(MAX_RETRIES + 1):
+        if cancel is not None and cancel.remaining() is not None:
+            remaining = cancel.remaining()
+            kwargs['timeout'] = remaining if timeout is None \
+                else min(timeout, remaining)
+        with tracing.span('http ' + getattr(method, '__name__', 'request'),
+                          attempt=attempt) as span:
+            with limiter.slot(token, cancel) as report:
+                response = method(url, **kwargs)
+                report.append(response)
+            reason = throttle_reason(response)
+            span.set('status', getattr(response, 'status_code', None))
+            if reason is not None:
+                span.set('throttled', reason)
+
+        if reason is None or attempt == MAX_RETRIES:
+            return response
+
+        _sleep(backoff(attempt, response), cancel)
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""Fair-share scheduling of transfers across users.
+
+Users are served by weighted fair queuing (start-time fair queuing on
+the expected number of bytes), so a user with many large files cannot
+hold every worker while others wait.  Each user’s own jobs are run
+shortest first, and no user may have more than a fixed number of jobs
+running at once."""
+
+import concurrent.futures
+import heapq
+import itertools
+import logging as log
+import threading
+import time
+
+import tracing
+
+
+# Cost charged to the user’s share for a job whose size is unknown.
+UNKNOWN_SIZE = 64 * 1024 * 1024
+
+
+class _Job:
+    """A queued call and the future that will hold its result."""
+
+    def __init__(self, seq, user, size, fn, args, kwargs):
+        self.seq = seq
+        self.user = user
+        self.size = size
+        self.cost = UNKNOWN_SIZE if size is None else max(size, 1)
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future = concurrent.futures.Future()
+        self.submitted = time.monotonic()
+
+
+    def __lt__(self, other):
+        # Shortest job first, those of unknown size last; ties in
+        # submission order.
+        return (self.size is None, self.cost, self.seq) \
+            < (other.size is None, other.cost, other.seq)
+
+
+class _User:
+    """Scheduling state of one user."""
+
+    def __init__(self, weight):
+        self.weight = weight
+        self.queue = []
+        self.running = 0
+        self.finish = 0.0
+        self.started = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+
+class FairScheduler:
+    """Run submitted jobs on a pool of worker threads, fairly per user."""
+
+    def __init__(self, workers=4, per_user_limit=2, weights=None):
+        """Start WORKERS threads.
+
+        PER_USER_LIMIT caps the number of running jobs of each user.
+        WEIGHTS optionally maps users to their share (default 1)."""
+
+        if workers < 1 or per_user_limit < 1:
+            raise ValueError('workers and per_user_limit must be positive')
+
+        self.per_user_limit = per_user_limit
+        self.weights = dict(weights or {})
+        self._users = {}
+        self._seq = itertools.count()
+        self._vtime = 0.0
+        self._shutdown = False
+        self._cond = threading.Condition()
+        self._threads = [threading.Thread(target=self._work, daemon=True)
+                         for _ in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+
+    def submit(self, user, fn, *args, size=None, **kwargs):
+        """Queue FN(*ARGS, **KWARGS) on behalf of USER.
+
+        SIZE is the expected number of bytes (e.g. the source’s
+        Content-Length), if known.  FN runs in the trace that is
+        current now.  Returns a ‘concurrent.futures.Future’."""
+
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError('Scheduler is shut down')
+
+            state = self._users.get(user)
+            if state is None:
+                state = self._users[user] = \
+                    _User(self.weights.get(user, 1))
+            job = _Job(next(self._seq), user, size, tracing.bind(fn), args,
+                       kwargs)
+            heapq.heappush(state.queue, job)
+            self._cond.notify()
+
+        return job.future
+
+
+    def _next_job(self):
+        """Pop the next job to run, or None if none is eligible.
+
+        Must be called with the lock held."""
+
+        best = None
+        for state in self._users.values():
+            if not state.queue or state.running >= self.per_user_limit:
+                continue
+            start = max(state.finish, self._vtime)
+            if best is None or start < best[0]:
+                best = (start, state)
+
+        if best is None:
+            return None
+
+        start, state = best
+        job = heapq.heappop(state.queue)
+        self._vtime = start
+        state.finish = start + job.cost / state.weight
+        state.running += 1
+
+        wait = time.monotonic() - job.submitted
+        state.started += 1
+        state.total_wait += wait
+        state.max_wait = max(state.max_wait, wait)
+
+        return job
+
+
+    def _work(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    if self._shutdown:
+                        return
+                    self._cond.wait()
+                    job = self._next_job()
+
+            try:
+                if job.future.set_running_or_notify_cancel():
+                    try:
+                        result = job.fn(*job.args, **job.kwargs)
+                    except BaseException as e:
+                        job.future.set_exception(e)
+                    else:
+                        job.future.set_result(result)
+            except:
+                log.exception('Scheduler could not complete a job')
+            finally:
+                with self._cond:
+                    state = self._users[job.user]
+                    state.running -= 1
+                    if not state.queue and not state.running:
+                        # Idle users start afresh when they come back.
+                        del self._users[job.user]
+                    self._cond.notify_all()
+
+
+    def stats(self):
+        """Return per-user queue depth, running jobs and wait times.
+
+        Wait times are in seconds: ‘oldest_wait’ is how long the
+        oldest queued job has been waiting, ‘mean_wait’ and ‘max_wait’
+        cover the jobs already started."""
+
+        now = time.monotonic()
+        with self._cond:
+            return {
+                user: {'queued': len(state.queue),
+                       'running': state.running,
+                       'oldest_wait': max((now - job.submitted
+                                           for job in state.queue),
+                                          default=0.0),
+                       'mean_wait': (state.total_wait / state.started
+                                     if state.started else 0.0),
+                       'max_wait': state.max_wait}
+                for user, state in self._users.items()}
+
+
+    def shutdown(self, wait=True):
+        """Stop accepting jobs; workers exit once the queues drain."""
+
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+
+        if wait:
+            for thread in self._threads:
+                thread.join()
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+"""Shared state for running the app on several instances.
+
+A store keeps the transfer jobs, their resumable upload session URLs
+and the users’ credentials where every instance can reach them.  Any
+instance can enqueue a job; workers (see ‘worker’) claim queued jobs
+under a lease that they renew with heartbeats while the transfer runs.
+When a worker dies its lease expires and another worker picks the job
+up, continuing the upload session if it is still alive.
+
+‘Store’ is the interface; ‘SQLiteStore’ implements it on a local
+SQLite file, which is enough for several processes on one machine.
+Networked stores (Cloud SQL, Firestore, Redis...) implement the same
+methods with the same atomicity."""
+
+import contextlib
+import json
+import sqlite3
+import threading
+import time
+import uuid
+
+
+# Seconds a claimed job stays with its worker without a heartbeat.
+LEASE = 60
+
+# Claims of a job before it is given up on.
+MAX_ATTEMPTS = 3
+
+
+class LeaseLost(RuntimeError):
+    """The job was taken over by another worker."""
+
+
+class Job:
+    """One transfer, as stored."""
+
+    def __init__(self, id, user, url, size=None, state='queued',
+                 worker=None, lease_expires=None, attempts=0,
+                 cancel_requested=False, message=None, progress=None,
+                 upload_url=None, created=None):
+        self.id = id
+        self.user = user
+        self.url = url
+        self.size = size
+        self.state = state
+        self.worker = worker
+        self.lease_expires = lease_expires
+        self.attempts = attempts
+        self.cancel_requested = bool(cancel_requested)
+        self.message = message
+        self.progress = progress or {}
+        self.upload_url = upload_url
+        self.created = created
+
+
+    @property
+    def finished(self):
+        return self.state in ('done', 'error')
+
+
+    def snapshot(self):
+        """Return the job as a ‘progress.Progress.snapshot()’."""
+
+        snapshot = {'phase': None, 'done': 0, 'total': self.size,
+                    'rate': None, 'eta': None}
+        snapshot.update(self.progress)
+        snapshot.update({'id': self.id, 'state': self.state,
+                         'message': self.message})
+        return snapshot
+
+
+class Store:
+    """Interface of the shared state.
+
+    Every method must be atomic with respect to all the instances using
+    the store."""
+
+    def enqueue(self, user, url, size=None):
+        """Queue the transfer of URL for USER.  Return the job id.
+
+        SIZE is the expected number of bytes, if known."""
+
+        raise NotImplementedError
+
+
+    def get(self, job_id):
+        """Return the ‘Job’ with JOB_ID, or None."""
+
+        raise NotImplementedError
+
+
+    def claim(self, worker, lease=LEASE, per_user_limit=None):
+        """Give WORKER the next job to run, for LEASE seconds.
+
+        Candidates are queued jobs and running jobs whose lease expired.
+        Users with fewer running jobs go first, then smaller jobs, then
+        older ones; users already running PER_USER_LIMIT jobs are
+        skipped.  Returns the ‘Job’, or None if there is nothing to
+        do."""
+
+        raise NotImplementedError
+
+
+    def heartbeat(self, job_id, worker, lease=LEASE, progress=None):
+        """Extend the lease of WORKER on JOB_ID and record PROGRESS.
+
+        Returns whether cancelling the job was requested.  Raises
+        ‘LeaseLost’ if the job is no longer WORKER’s."""
+
+        raise NotImplementedError
+
+
+    def finish(self, job_id, worker, state, message=None):
+        """Record the outcome of JOB_ID: STATE is ‘done’ or ‘error’."""
+
+        raise NotImplementedError
+
+
+    def request_cancel(self, job_id):
+        """Ask for JOB_ID to be cancelled.
+
+        A queued job is cancelled at once; a running one by its worker,
+        which looks for such requests every ‘worker.CANCEL_POLL’
+        seconds."""
+
+        raise NotImplementedError
+
+
+    def save_upload_url(self, job_id, upload_url):
+        """Remember the resumable session of JOB_ID."""
+
+        raise NotImplementedError
+
+
+    def save_credentials(self, user, credentials):
+        """Store the CREDENTIALS (a dictionary) of USER."""
+
+        raise NotImplementedError
+
+
+    def load_credentials(self, user):
+        """Return the credentials of USER, or None."""
+
+        raise NotImplementedError
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    user TEXT NOT NULL,
+    url TEXT NOT NULL,
+    size INTEGER,
+    state TEXT NOT NULL,
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    message TEXT,
+    progress TEXT,
+    upload_url TEXT,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, lease_expires);
+CREATE TABLE IF NOT EXISTS credentials (
+    user TEXT PRIMARY KEY,
+    credentials TEXT NOT NULL
+);
+'''
+
+
+class SQLiteStore(Store):
+    """‘Store’ on a SQLite database file.
+
+    Note that credentials are kept in the clear: protect the file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connection().executescript(SCHEMA)
+
+
+    def _connection(self):
+        # SQLite connections cannot be shared between threads.
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30,
+                                 isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute('PRAGMA journal_mode=WAL')
+            self._local.db = db
+        return db
+
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        db = self._connection()
+        # Take the write lock up front so that claims are atomic across
+        # processes.
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except:
+            db.execute('ROLLBACK')
+            raise
+        else:
+            db.execute('COMMIT')
+
+
+    @staticmethod
+    def _job(row):
+        if row is None:
+            return None
+        fields = dict(row)
+        fields['progress'] = json.loads(fields['progress'] or '{}')
+        return Job(**fields)
+
+
+    def enqueue(self, user, url, size=None):
+        job_id = uuid.uuid4().hex
+        with self._transaction() as db:
+            db.execute('INSERT INTO jobs (id, user, url, size, state, created)'
+                       " VALUES (?, ?, ?, ?, 'queued', ?)",
+                       (job_id, user, url, size, time.time()))
+        return job_id
+
+
+    def get(self, job_id):
+        row = self._connection().execute(
+            'SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return self._job(row)
+
+
+    def claim(self, worker, lease=LEASE, per_user_limit=None):
+        now = time.time()
+        with self._transaction() as db:
+            # Jobs whose workers keep dying are given up on.
+            db.execute("UPDATE jobs SET state = 'error',"
+                       " message = 'Transfer failed too many times'"
+                       " WHERE state = 'running' AND lease_expires < ?"
+                       ' AND attempts >= ?', (now, MAX_ATTEMPTS))
+
+            running = ("(SELECT COUNT(*) FROM jobs r WHERE r.user = j.user"
+                       " AND r.state = 'running' AND r.lease_expires >= ?)")
+            row = db.execute(
+                'SELECT j.id FROM jobs j'
+                " WHERE (j.state = 'queued'"
+                "        OR (j.state = 'running' AND j.lease_expires < ?))"
+                ' AND (? IS NULL OR {running} < ?)'
+                ' ORDER BY {running}, j.size IS NULL, j.size, j.created'
+                ' LIMIT 1'.format(running=running),
+                (now, per_user_limit, now, per_user_limit, now)).fetchone()
+            if row is None:
+                return None
+
+            db.execute("UPDATE jobs SET state = 'running', worker = ?,"
+                       ' lease_expires = ?, attempts = attempts + 1'
+                       ' WHERE id = ?', (worker, now + lease, row['id']))
+            return self._job(db.execute('SELECT * FROM jobs WHERE id = ?',
+                                        (row['id'],)).fetchone())
+
+
+    def heartbeat(self, job_id, worker, lease=LEASE, progress=None):
+        with self._transaction() as db:
+            row = db.execute('SELECT worker, state, cancel_requested'
+                             ' FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if row is None or row['worker'] != worker \
+               or row['state'] != 'running':
+                raise LeaseLost('Job {} is not ours anymore'.format(job_id))
+
+            db.execute('UPDATE jobs SET lease_expires = ?,'
+                       ' progress = COALESCE(?, progress) WHERE id = ?',
+                       (time.time() + lease,
+                        None if progress is None else json.dumps(progress),
+                        job_id))
+            return bool(row['cancel_requested'])
+
+
+    def finish(self, job_id, worker, state, message=None):
+        with self._transaction() as db:
+            db.execute('UPDATE jobs SET state = ?, message = ?,'
+                       ' lease_expires = NULL'
+                       " WHERE id = ? AND worker = ? AND state = 'running'",
+                       (state, message, job_id, worker))
+
+
+    def request_cancel(self, job_id):
+        with self._transaction() as db:
+            db.execute("UPDATE jobs SET state = 'error',"
+                       " message = 'Transfer cancelled'"
+                       " WHERE id = ? AND state = 'queued'", (job_id,))
+            db.execute('UPDATE jobs SET cancel_requested = 1 WHERE id = ?',
+                       (job_id,))
+
+
+    def save_upload_url(self, job_id, upload_url):
+        with self._transaction() as db:
+            db.execute('UPDATE jobs SET upload_url = ? WHERE id = ?',
+                       (upload_url, job_id))
+
+
+    def save_credentials(self, user, credentials):
+        with self._transaction() as db:
+            db.execute('INSERT OR REPLACE INTO credentials VALUES (?, ?)',
+                       (user, json.dumps(credentials)))
+
+
+    def load_credentials(self, user):
+        row = self._connection().execute(
+            'SELECT credentials FROM credentials WHERE user = ?',
+            (user,)).fetchone()
+        return None if row is None else json.loads(row['credentials'])
+
+
+def from_url(url):
+    """Return the store described by URL, e.g. ‘sqlite:///path/to.db’."""
+
+    if url.startswith('sqlite://'):
+        return SQLiteStore(url[len('sqlite://'):])
+
+    raise ValueError('Unsupported store: {}'.format(url))
@@ -0,0 +1,214 @@
+import unittest
+from unittest.mock import patch
+import http.server
+import logging
+import os
+import pathlib
+import threading
+import time
+from tempfile import NamedTemporaryFile
+
+import requests
+
+import url as urlm
+import cancellation
+from fake_drive import FakeDrive
+
+
+TEMP_FILE_SIZE = 8 * 1024
+
+
+def setUpModule():
+    """Disable logging while doing these tests."""
+    logging.disable()
+
+
+def tearDownModule():
+    """Re-enable logging after doing these tests."""
+    logging.disable(logging.NOTSET)
+
+
+class TestCancelToken(unittest.TestCase):
+    """Cancellation and deadlines are reported by ‘check()’."""
+
+    def test_cancel(self):
+        token = cancellation.CancelToken()
+        calls = []
+        token.on_cancel(lambda: calls.append(1))
+        token.check()
+
+        token.cancel('Stop')
+        token.cancel('Again')
+        with self.assertRaisesRegex(cancellation.Cancelled, 'Stop'):
+            token.check()
+        self.assertEqual(calls, [1])
+
+
+    def test_deadline(self):
+        with patch('time.monotonic', return_value=100.0):
+            token = cancellation.CancelToken(deadline=10)
+        with patch('time.monotonic', return_value=105.0):
+            token.check()
+            self.assertEqual(token.remaining(), 5)
+        with patch('time.monotonic', return_value=110.0):
+            with self.assertRaises(cancellation.DeadlineExceeded):
+                token.check()
+
+
+    def test_phase_deadline(self):
+        """A phase deadline counts from the start of the phase."""
+
+        token = cancellation.CancelToken(phase_deadlines={'upload': 1})
+        with patch('time.monotonic', return_value=100.0):
+            token.enter_phase('download')
+            self.assertIsNone(token.remaining())
+            token.enter_phase('upload')
+        with patch('time.monotonic', return_value=101.0):
+            with self.assertRaisesRegex(cancellation.DeadlineExceeded,
+                                        'upload'):
+                token.check()
+
+
+class TestCancelledTransfer(unittest.TestCase):
+    """A cancelled transfer leaves nothing behind."""
+
+    def setUp(self):
+        self.drive = FakeDrive().start()
+        self.patcher = patch('url.API_ROOT', self.drive.url)
+        self.patcher.start()
+        with NamedTemporaryFile(delete=False) as f:
+            f.write(os.urandom(TEMP_FILE_SIZE))
+        self.source = f.name
+        self.token = cancellation.CancelToken()
+        self.url_obj = urlm.Url(pathlib.Path(f.name).as_uri(), 'token',
+                                cancel=self.token)
+
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.drive.stop()
+        os.remove(self.source)
+
+
+    def test_cancel_during_download(self):
+        """The partial temporary file is removed."""
+
+        created = []
+        read = urlm.Url._check
+
+        def cancel_later(url_obj):
+            created.append(url_obj._filename)
+            if len(created) == 2:
+                self.token.cancel()
+            read(url_obj)
+
+        with patch('url.COPY_BUFSIZE', 1024),\
+             patch('url.Url._check', cancel_later):
+            with self.assertRaises(cancellation.Cancelled):
+                self.url_obj.drive_it()
+
+        self.assertFalse(os.path.exists(created[-1]))
+        self.assertEqual(self.drive.requests, [])
+
+
+    def test_cancel_during_upload(self):
+        """The session is cancelled and the temporary file removed."""
+
+        self.url_obj.download()
+        filename = self.url_obj.filename
+        put = requests.put
+        sent = []
+
+        def put_then_cancel(*args, **kwargs):
+            sent.append(kwargs['data'])
+            self.token.cancel()
+            return put(*args, **kwargs)
+
+        with patch('requests.put', put_then_cancel):
+            with self.assertRaises(cancellation.Cancelled):
+                self.url_obj._upload(upload_chunk_size=1024)
+
+        self.assertEqual(len(sent), 1)
+        self.assertFalse(os.path.exists(filename))
+        self.assertEqual(self.drive.count('DELETE', '/upload'), 1)
+        self.assertEqual(self.drive._sessions, {})
+        self.assertEqual(self.drive.files, {})
+
+
+    def test_phase_deadline(self):
+        """An expired phase deadline stops the transfer."""
+
+        token = cancellation.CancelToken(phase_deadlines={'upload': 0})
+        url_obj = urlm.Url(pathlib.Path(self.source).as_uri(), 'token',
+                           cancel=token)
+
+        with self.assertRaises(cancellation.DeadlineExceeded):
+            url_obj.drive_it()
+        self.assertEqual(self.drive.files, {})
+
+
+class _StalledHandler(http.server.BaseHTTPRequestHandler):
+    """Sends the start of a body, then nothing until told to stop."""
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def do_GET(self):
+        self.send_response(200)
+        if self.server.length:
+            self.send_header('Content-Length', str(TEMP_FILE_SIZE))
+        self.end_headers()
+        self.wfile.write(b'x' * 1024)
+        self.wfile.flush()
+        self.server.stalled.set()
+        self.server.release.wait(10)
+
+
+class TestStalledOrigin(unittest.TestCase):
+    """Cancelling a download waiting for a stalled origin stops it."""
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                      _StalledHandler)
+        self.server.daemon_threads = True
+        self.server.length = True
+        self.server.stalled = threading.Event()
+        self.server.release = threading.Event()
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+
+
+    def tearDown(self):
+        self.server.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+    def cancel_stalled(self):
+        token = cancellation.CancelToken()
+        url_obj = urlm.Url('http://127.0.0.1:{}/file.bin'.format(
+            self.server.server_address[1]), 'token', cancel=token)
+        threading.Thread(target=lambda: self.server.stalled.wait(5)
+                         and token.cancel(), daemon=True).start()
+
+        start = time.monotonic()
+        with self.assertRaises(cancellation.Cancelled):
+            url_obj.download()
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertIsNone(url_obj._filename)
+
+
+    def test_cancel(self):
+        self.cancel_stalled()
+
+
+    def test_cancel_unknown_length(self):
+        """A body cut off is not taken for a whole one."""
+
+        self.server.length = False
+        self.cancel_stalled()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,207 @@
+import unittest
+from unittest.mock import patch
+import gzip
+import http.server
+import logging
+import os
+import threading
+import zlib
+
+import codings
+import url as urlm
+
+
+TEXT = b''.join(b'%d,row %d,some text that compresses well\n' % (i, i)
+                for i in range(20000))
+
+
+def setUpModule():
+    """Disable logging while doing these tests."""
+    logging.disable()
+
+
+def tearDownModule():
+    """Re-enable logging after doing these tests."""
+    logging.disable(logging.NOTSET)
+
+
+def _raw_deflate(data):
+    compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decode(content_encoding, body, block=1000):
+    decoder = codings.Decoder(content_encoding)
+    data = b''.join(piece for i in range(0, len(body), block)
+                    for piece in decoder.decode(body[i:i + block]))
+    decoder.finish()
+    return data
+
+
+class TestDecoder(unittest.TestCase):
+
+    def test_gzip(self):
+        self.assertEqual(decode('gzip', gzip.compress(TEXT)), TEXT)
+
+
+    def test_gzip_members(self):
+        body = gzip.compress(TEXT[:100]) + gzip.compress(TEXT[100:])
+        self.assertEqual(decode('gzip', body), TEXT)
+
+
+    def test_deflate(self):
+        """Both zlib and raw deflate data are accepted."""
+
+        self.assertEqual(decode('deflate', zlib.compress(TEXT)), TEXT)
+        self.assertEqual(decode('deflate', _raw_deflate(TEXT)), TEXT)
+
+
+    def test_stacked(self):
+        body = gzip.compress(zlib.compress(TEXT))
+        self.assertEqual(decode('deflate, gzip', body), TEXT)
+
+
+    def test_bomb(self):
+        """Small bodies that decode to a lot come out in pieces."""
+
+        body = gzip.compress(gzip.compress(bytes(64 * 1024 * 1024)))
+        self.assertLess(len(body), 100000)
+        decoder = codings.Decoder('gzip, gzip')
+        total = 0
+        for piece in decoder.decode(body):
+            self.assertLessEqual(len(piece), codings.MAX_PIECE)
+            total += len(piece)
+        decoder.finish()
+        self.assertEqual(total, 64 * 1024 * 1024)
+
+
+    def test_too_many(self):
+        with self.assertRaises(RuntimeError):
+            codings.Decoder('gzip, gzip, gzip')
+
+
+    def test_identity(self):
+        self.assertEqual(codings.Decoder('identity').codings, [])
+
+
+    def test_unsupported(self):
+        with self.assertRaises(RuntimeError):
+            codings.Decoder('compress')
+
+
+    def test_truncated(self):
+        with self.assertRaises(RuntimeError):
+            decode('gzip', gzip.compress(TEXT)[:-100])
+
+
+    def test_corrupt(self):
+        with self.assertRaises(RuntimeError):
+            decode('gzip', b'not gzip at all')
+
+
+class TestAcceptEncoding(unittest.TestCase):
+
+    def test_text(self):
+        accept = codings.accept_encoding('http://example.com/data.csv')
+        self.assertIn('gzip', accept)
+        self.assertIn('deflate', accept)
+
+
+    def test_compressed(self):
+        for path in ('a.tar.gz', 'b.ZIP', 'c.mp4'):
+            self.assertIsNone(codings.accept_encoding(
+                'https://example.com/' + path))
+
+
+    def test_not_http(self):
+        self.assertIsNone(codings.accept_encoding('file:///tmp/data.csv'))
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    """Serves TEXT, compressed as asked for or as the server says."""
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def do_GET(self):
+        server = self.server
+        server.accepted.append(self.headers.get('Accept-Encoding'))
+        accept = self.headers.get('Accept-Encoding') or ''
+        body, encoding = TEXT, server.force_encoding
+        if encoding is None and 'gzip' in accept:
+            body, encoding = gzip.compress(TEXT), 'gzip'
+        elif encoding is not None:
+            body = server.body
+
+        self.send_response(200)
+        if encoding is not None:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        server.sent.append(len(body))
+        self.wfile.write(body)
+
+
+class TestDownload(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                      _Handler)
+        self.server.daemon_threads = True
+        self.server.accepted = []
+        self.server.sent = []
+        self.server.force_encoding = None
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.root = 'http://127.0.0.1:{}/'.format(
+            self.server.server_address[1])
+
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+    def download(self, path):
+        url = urlm.Url(self.root + path, 'token')
+        filename, _ = url.download()
+        with open(filename, 'rb') as f:
+            data = f.read()
+        os.remove(filename)
+        return data
+
+
+    def test_compressed(self):
+        """The stored file is the original, fetched in fewer bytes."""
+
+        self.assertEqual(self.download('data.csv'), TEXT)
+        self.assertIn('gzip', self.server.accepted[0])
+        self.assertLess(self.server.sent[0], len(TEXT) / 5)
+
+
+    def test_compressed_file(self):
+        """Compressed files are stored as they are, labelled or not."""
+
+        body = gzip.compress(TEXT)
+        self.server.force_encoding, self.server.body = 'gzip', body
+        self.assertEqual(self.download('data.csv.gz'), body)
+        self.assertEqual(self.server.accepted, ['identity'])
+
+
+    def test_corrupt(self):
+        self.server.force_encoding, self.server.body = 'gzip', b'garbage'
+        url = urlm.Url(self.root + 'data.csv', 'token')
+        with self.assertRaises(RuntimeError):
+            url.download()
+        self.assertIsNone(url._filename)
+
+
+    def test_disabled(self):
+        with patch.dict('codings.CODINGS', clear=True):
+            self.assertEqual(self.download('data.csv'), TEXT)
+        self.assertEqual(self.server.accepted, ['identity'])
+
+
+if __name__ == '__main__':
+    unittest.main()
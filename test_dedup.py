@@ -0,0 +1,185 @@
+import unittest
+from unittest.mock import patch
+import logging
+import hashlib
+import os
+import pathlib
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+
+import requests
+
+import url as urlm
+import dedup as dedupm
+import transport as transportm
+from fake_drive import FakeDrive
+
+
+TEMP_FILE_SIZE = 3 * 1024
+
+
+def setUpModule():
+    """Disable logging while doing these tests."""
+    logging.disable()
+
+
+def tearDownModule():
+    """Re-enable logging after doing these tests."""
+    logging.disable(logging.NOTSET)
+
+
+def temp_file_url(content):
+    """Create a temporary file with CONTENT.  Return its path and URL."""
+
+    with NamedTemporaryFile(delete=False) as f:
+        f.write(content)
+
+    return f.name, pathlib.Path(f.name).as_uri()
+
+
+class TestFingerprint(unittest.TestCase):
+    """(MD5, size) of a file."""
+
+    def test_fingerprint(self):
+        """Matches the digest of the whole content."""
+
+        path, _ = temp_file_url(b'abc' * 1000)
+        with patch('dedup.HASH_BUFSIZE', 7):
+            self.assertEqual(dedupm.fingerprint(path),
+                             (hashlib.md5(b'abc' * 1000).hexdigest(), 3000))
+        os.remove(path)
+
+
+class TestDedup(unittest.TestCase):
+    """Transfers skip the upload when the content is already in Drive."""
+
+    def setUp(self):
+        self.drive = FakeDrive().start()
+        self.patcher = patch('url.API_ROOT', self.drive.url)
+        self.patcher.start()
+        self.directory = TemporaryDirectory()
+        self.index = dedupm.DedupIndex.for_user('user',
+                                                self.directory.name)
+        self.content = os.urandom(TEMP_FILE_SIZE)
+        self.paths = []
+
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.drive.stop()
+        self.directory.cleanup()
+        for path in self.paths:
+            os.remove(path)
+
+
+    def drive_it(self, content, index):
+        path, file_url = temp_file_url(content)
+        self.paths.append(path)
+        url_obj = urlm.Url(file_url, 'token', dedup=index)
+        filename, _ = url_obj.drive_it()
+        self.paths.append(filename)
+        return url_obj
+
+
+    def test_second_transfer_is_not_uploaded(self):
+        """The same bytes are sent only once."""
+
+        first = self.drive_it(self.content, self.index)
+        received = self.drive.bytes_received
+        second = self.drive_it(self.content, self.index)
+
+        self.assertFalse(first.reused)
+        self.assertTrue(second.reused)
+        self.assertEqual(first.file_id, second.file_id)
+        self.assertEqual(received, TEMP_FILE_SIZE)
+        self.assertEqual(self.drive.bytes_received, received)
+        self.assertEqual(self.drive.count('POST', '/upload'), 1)
+
+
+    def test_different_content_is_uploaded(self):
+        """Only identical bytes are deduplicated."""
+
+        self.drive_it(self.content, self.index)
+        other = self.drive_it(self.content[::-1], self.index)
+
+        self.assertFalse(other.reused)
+        self.assertEqual(len(self.drive.files), 2)
+
+
+    def test_index_persists(self):
+        """A fresh index for the same user finds previous uploads."""
+
+        first = self.drive_it(self.content, self.index)
+        index = dedupm.DedupIndex(self.index.path)
+        self.assertEqual(self.drive_it(self.content, index).file_id,
+                         first.file_id)
+
+
+    def test_shared(self):
+        """Concurrent transfers for a user keep all their additions."""
+
+        first = dedupm.DedupIndex.for_user('user', self.directory.name)
+        second = dedupm.DedupIndex.for_user('user', self.directory.name)
+        first.find(('a', 1), 'token')
+        second.find(('b', 2), 'token')
+        first.add(('a', 1), 'file-a')
+        second.add(('b', 2), 'file-b')
+
+        index = dedupm.DedupIndex(first.path)
+        self.assertEqual(index._load(), {'a:1': 'file-a', 'b:2': 'file-b'})
+
+
+    def test_users_are_separated(self):
+        """Another user’s uploads are not reused."""
+
+        self.drive_it(self.content, self.index)
+        index = dedupm.DedupIndex.for_user('other', self.directory.name)
+        self.assertFalse(self.drive_it(self.content, index).reused)
+
+
+    def test_stale_entry_is_dropped(self):
+        """Deleted or trashed files are uploaded again."""
+
+        for change in ('delete', 'trash'):
+            with self.subTest(change=change):
+                first = self.drive_it(self.content, self.index)
+                if change == 'delete':
+                    del self.drive.files[first.file_id]
+                else:
+                    self.drive.files[first.file_id]['trashed'] = True
+
+                second = self.drive_it(self.content, self.index)
+                self.assertFalse(second.reused)
+                self.assertNotEqual(second.file_id, first.file_id)
+                self.assertTrue(self.drive_it(self.content,
+                                              self.index).reused)
+
+                # Start the next case from a clean slate.
+                self.drive.files[second.file_id]['trashed'] = True
+
+
+    def test_check_through_transport(self):
+        """Candidates are checked through the transport, with a timeout."""
+
+        first = self.drive_it(self.content, self.index)
+        fp = dedupm.fingerprint(self.paths[0])
+        transport = transportm.RequestsTransport()
+        with patch.object(transport, 'get', wraps=transport.get) as get:
+            self.assertEqual(self.index.find(fp, 'token', transport),
+                             first.file_id)
+        self.assertEqual(get.call_args.kwargs['timeout'], urlm.API_TIMEOUT)
+
+
+    def test_check_failed(self):
+        """Entries that cannot be checked are kept, but not used."""
+
+        first = self.drive_it(self.content, self.index)
+        fp = dedupm.fingerprint(self.paths[0])
+        transport = transportm.RequestsTransport()
+        with patch.object(transport, 'get',
+                          side_effect=requests.ConnectionError):
+            self.assertIsNone(self.index.find(fp, 'token', transport))
+        self.assertEqual(self.index.find(fp, 'token'), first.file_id)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,254 @@
+import unittest
+from unittest.mock import patch
+import functools
+import http.server
+import io
+import logging
+import os
+import pathlib
+import tarfile
+import tempfile
+import threading
+import zipfile
+
+import expand as expandm
+import cancellation
+import folders
+import url as urlm
+from fake_drive import FakeDrive
+
+
+MEMBERS = {'top.txt': b'top',
+           'empty.txt': b'',
+           'dir/big.bin': os.urandom(3 * urlm.UPLOAD_CHUNK_SIZE // 2),
+           'dir/sub/small.txt': b'small'}
+
+
+def setUpModule():
+    """Disable logging while doing these tests."""
+    logging.disable()
+
+
+def tearDownModule():
+    """Re-enable logging after doing these tests."""
+    logging.disable(logging.NOTSET)
+
+
+class _RangeHandler(http.server.SimpleHTTPRequestHandler):
+    """Serves files, honouring single ranges if the server allows it."""
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            return super().send_head()
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        header = self.headers.get('Range')
+        self.server.ranges.append(header)
+        status, first = 200, 0
+        if header and self.server.accept_ranges:
+            first, last = (int(n) for n in header[6:].split('-'))
+            data = data[first:last + 1]
+            status = 206
+
+        self.send_response(status)
+        if self.server.accept_ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        return io.BytesIO(data)
+
+
+class ExpandTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.drive = FakeDrive().start()
+        self.patcher = patch('url.API_ROOT', self.drive.url)
+        self.patcher.start()
+
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.drive.stop()
+        self.directory.cleanup()
+
+
+    def make_tar(self, name='archive.tar.gz', mode='w:gz', members=MEMBERS):
+        filename = os.path.join(self.directory.name, name)
+        with tarfile.open(filename, mode) as tar:
+            directory = tarfile.TarInfo('dir')
+            directory.type = tarfile.DIRTYPE
+            tar.addfile(directory)
+            for path, data in members.items():
+                info = tarfile.TarInfo(path)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        return filename
+
+
+    def make_zip(self, name='archive.zip'):
+        filename = os.path.join(self.directory.name, name)
+        with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr('dir/', b'')
+            for path, data in MEMBERS.items():
+                archive.writestr(path, data)
+        return filename
+
+
+    def serve(self, accept_ranges=True):
+        handler = functools.partial(_RangeHandler,
+                                    directory=self.directory.name)
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        server.daemon_threads = True
+        server.accept_ranges = accept_ranges
+        server.ranges = []
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server, 'http://127.0.0.1:{}/'.format(
+            server.server_address[1])
+
+
+    def drive_paths(self):
+        """Return the paths of the files in Drive, with their contents."""
+
+        files = self.drive.files
+
+        def path(metadata):
+            parents = metadata.get('parents')
+            if not parents:
+                return metadata['name']
+            return path(files[parents[0]]) + '/' + metadata['name']
+
+        return {path(metadata): self.drive.content[file_id]
+                for file_id, metadata in files.items()
+                if metadata.get('mimeType') != folders.FOLDER_MIME_TYPE}
+
+
+    def expand(self, url, **kwargs):
+        return expandm.Expand(url, 'token', workers=2, **kwargs).run()
+
+
+    def assertExpanded(self, result, top='archive'):
+        self.assertEqual(sorted(result.transferred), sorted(MEMBERS))
+        self.assertEqual(self.drive_paths(),
+                         {top + '/' + path: data
+                          for path, data in MEMBERS.items()})
+
+
+class TestTar(ExpandTestCase):
+
+    def test_tar_gz(self):
+        url = pathlib.Path(self.make_tar()).as_uri()
+        self.assertExpanded(self.expand(url))
+
+
+    def test_tar(self):
+        url = pathlib.Path(self.make_tar('archive.tar', 'w')).as_uri()
+        self.assertExpanded(self.expand(url))
+
+
+    def test_unsafe_names(self):
+        members = dict(MEMBERS, **{'../evil.txt': b'evil'})
+        url = pathlib.Path(self.make_tar(members=members)).as_uri()
+        self.assertExpanded(self.expand(url))
+
+
+    def test_failed_uploads(self):
+        """Failing uploads do not stall the reader."""
+
+        url = pathlib.Path(self.make_tar()).as_uri()
+        with patch('expand.urlm.Url.upload_stream',
+                   side_effect=RuntimeError('Boom')):
+            result = self.expand(url)
+        self.assertEqual(sorted(path for path, _ in result.failed),
+                         sorted(MEMBERS))
+        self.assertIn('failed', result.summary())
+
+
+    def test_deadline(self):
+        """Members being uploaded stop at the expansion’s deadline."""
+
+        deadlines = []
+
+        def upload_stream(url, stream, size):
+            deadlines.append(url.cancel.remaining())
+            raise RuntimeError('Stop here')
+        url = pathlib.Path(self.make_tar()).as_uri()
+        with patch('expand.urlm.Url.upload_stream', autospec=True,
+                   side_effect=upload_stream):
+            self.expand(url, cancel=cancellation.CancelToken(100))
+        self.assertEqual(len(deadlines), len(MEMBERS))
+        self.assertTrue(all(deadline is not None and deadline <= 100
+                            for deadline in deadlines))
+
+
+    def test_corrupt(self):
+        filename = os.path.join(self.directory.name, 'archive.tar')
+        with open(filename, 'wb') as f:
+            f.write(b'not a tar archive' * 100)
+        with self.assertRaises(RuntimeError):
+            self.expand(pathlib.Path(filename).as_uri())
+
+
+    def test_cancel(self):
+        cancel = cancellation.CancelToken()
+        cancel.cancel()
+        with self.assertRaises(cancellation.Cancelled):
+            self.expand(pathlib.Path(self.make_tar()).as_uri(),
+                        cancel=cancel)
+        self.assertEqual(self.drive.count('POST'), 0)
+
+
+class TestZip(ExpandTestCase):
+
+    def test_local(self):
+        url = pathlib.Path(self.make_zip()).as_uri()
+        self.assertExpanded(self.expand(url))
+
+
+    def test_ranged(self):
+        """Remote archives are read in ranges, not downloaded."""
+
+        self.make_zip()
+        server, root = self.serve()
+        self.assertExpanded(self.expand(root + 'archive.zip'))
+        self.assertTrue(server.ranges)
+        self.assertNotIn(None, server.ranges[1:])
+
+
+    def test_no_ranges(self):
+        self.make_zip()
+        server, root = self.serve(accept_ranges=False)
+        self.assertExpanded(self.expand(root + 'archive.zip'))
+
+
+    def test_corrupt(self):
+        filename = os.path.join(self.directory.name, 'archive.zip')
+        with open(filename, 'wb') as f:
+            f.write(b'not a zip archive')
+        with self.assertRaises(RuntimeError):
+            self.expand(pathlib.Path(filename).as_uri())
+
+
+class TestExpand(ExpandTestCase):
+
+    def test_not_an_archive(self):
+        with self.assertRaises(RuntimeError):
+            self.expand('http://example.com/file.txt')
+
+
+    def test_folder_name(self):
+        self.assertEqual(expandm._top_name('http://x/a/b.tar.gz'), 'b')
+        url = pathlib.Path(self.make_zip()).as_uri()
+        self.assertExpanded(self.expand(url, folder_name='Here'), 'Here')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,190 @@
+import unittest
+from unittest.mock import patch
+import concurrent.futures
+import logging
+import os
+from tempfile import NamedTemporaryFile
+
+import main
+import url as urlm
+import progress as progressm
+import cancellation
+from fake_drive import FakeDrive, ABOUT_PATH
+
+
+def setUpModule():
+    """Disable logging while doing these tests."""
+    logging.disable()
+
+
+def tearDownModule():
+    """Re-enable logging after doing these tests."""
+    logging.disable(logging.NOTSET)
+
+
+class TestReport(unittest.TestCase):
+    """Outcomes of in-process transfers."""
+
+    def transfer(self):
+        with NamedTemporaryFile(delete=False) as f:
+            f.write(b'data')
+        url = urlm.Url('http://example.com/file', 'token',
+                       progress=progressm.registry.create(owner='user'))
+        url._filename = f.name
+        return url, concurrent.futures.Future()
+
+
+    def test_success(self):
+        """The download is removed once it is in Drive."""
+
+        url, future = self.transfer()
+        future.set_result((url.filename, 'file'))
+        main.report(url, future)
+
+        self.assertFalse(os.path.exists(url.filename))
+        self.assertEqual(url.progress.state, 'done')
+
+
+    def test_failure(self):
+        """The download is removed when the transfer fails."""
+
+        url, future = self.transfer()
+        future.set_exception(RuntimeError('Boom'))
+        main.report(url, future)
+
+        self.assertFalse(os.path.exists(url.filename))
+        self.assertEqual(url.progress.snapshot()['message'], 'Boom')
+
+
+class RouteTestCase(unittest.TestCase):
+    """Requests to the app, signed in as ‘user’ or as ‘other’."""
+
+    def setUp(self):
+        self.drive = FakeDrive().start()
+        self.addCleanup(self.drive.stop)
+        patchers = [patch.dict(main.app.config, SECRET_KEY='secret'),
+                    patch('url.API_ROOT', self.drive.url)]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = main.app.test_client()
+        self.user = self.sign_in(self.client, 'user')
+        self.other_client = main.app.test_client()
+        self.sign_in(self.other_client, 'other')
+
+
+    @staticmethod
+    def sign_in(client, name):
+        """Sign CLIENT in as NAME.  Return its user key."""
+
+        credentials = {'token': name, 'refresh_token': name,
+                       'token_uri': 'https://oauth2.example.com/token',
+                       'client_id': 'client', 'client_secret': 'secret',
+                       'scopes': main.SCOPES, 'expiry': None}
+        with client.session_transaction() as session:
+            session['credentials'] = credentials
+        return main.user_key(main.workerm.credentials_from_dict(credentials))
+
+
+class TestUserKey(RouteTestCase):
+    """Users are told apart by their Drive identity."""
+
+    def credentials(self, token, refresh_token):
+        return main.workerm.credentials_from_dict({
+            'token': token, 'refresh_token': refresh_token,
+            'token_uri': 'https://oauth2.example.com/token',
+            'client_id': 'client', 'client_secret': 'secret',
+            'scopes': main.SCOPES})
+
+
+    def test_stable(self):
+        """Signing in again, even without a refresh token, keeps the key."""
+
+        self.drive.users = {'first': 'someone', 'again': 'someone',
+                            'other': 'someone else'}
+        key = main.user_key(self.credentials('first', 'refresh'))
+        self.assertEqual(main.user_key(self.credentials('again', None)), key)
+        self.assertNotEqual(main.user_key(self.credentials('other', None)),
+                            key)
+
+
+    def test_unknown(self):
+        """Tokens Drive does not take identify nobody."""
+
+        with patch('url.API_ROOT', self.drive.url + '/nowhere'):
+            with self.assertRaises(RuntimeError):
+                main.user_key(self.credentials('first', 'refresh'))
+
+
+    def test_kept_in_session(self):
+        """The identity is asked for once per session."""
+
+        progress = progressm.registry.create(owner='someone else')
+        asked = self.drive.count('GET', ABOUT_PATH)
+        for _ in range(2):
+            self.client.get('/progress/' + progress.id)
+        self.assertEqual(self.drive.count('GET', ABOUT_PATH), asked + 1)
+
+
+class TestProgressRoute(RouteTestCase):
+    """‘/progress/<id>’ streams a transfer’s progress to its owner."""
+
+    def test_events(self):
+        progress = progressm.registry.create(owner=self.user)
+        progress.start('upload', 10)
+        progress.finish('Done')
+
+        response = self.client.get('/progress/' + progress.id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        events = response.get_data(as_text=True).split('\n\n')
+        self.assertIn('"done"', events[-2])
+
+
+    def test_not_found(self):
+        """Transfers of others and unknown ones are not shown."""
+
+        progress = progressm.registry.create(owner=self.user)
+        self.assertEqual(
+            self.other_client.get('/progress/' + progress.id).status_code,
+            404)
+        self.assertEqual(self.client.get('/progress/unknown').status_code,
+                         404)
+
+
+class TestCancelRoute(RouteTestCase):
+    """‘/jobs/<id>/cancel’ stops a transfer of its owner."""
+
+    def start(self):
+        progress = progressm.registry.create(owner=self.user)
+        future = concurrent.futures.Future()
+        cancel = cancellation.CancelToken()
+        with main.jobs_lock:
+            main.jobs[progress.id] = (future, cancel)
+        self.addCleanup(main.jobs.pop, progress.id, None)
+        return progress.id, future, cancel
+
+
+    def test_cancel(self):
+        job, future, cancel = self.start()
+
+        response = self.client.post('/jobs/{}/cancel'.format(job))
+        self.assertEqual(response.status_code, 204)
+        self.assertTrue(future.cancelled())
+        self.assertTrue(cancel.cancelled)
+
+
+    def test_not_found(self):
+        """Transfers of others and unknown ones are left alone."""
+
+        job, future, cancel = self.start()
+        self.assertEqual(
+            self.other_client.post('/jobs/{}/cancel'.format(job)).status_code,
+            404)
+        self.assertFalse(cancel.cancelled)
+        self.assertEqual(self.client.post('/jobs/unknown/cancel').status_code,
+                         404)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,193 @@
+import unittest
+from unittest.mock import patch
+import logging
+
+import metadata
+from fake_drive import FakeDrive, BATCH_PATH
+
+
+def setUpModule():
+    """Disable logging while doing these tests."""
+    logging.disable()
+
+
+def tearDownModule():
+    """Re-enable logging after doing these tests."""
+    logging.disable(logging.NOTSET)
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.drive = FakeDrive().start()
+        patchers = [patch('url.API_ROOT', self.drive.url),
+                    # No waiting between retries.
+                    patch('ratelimit.backoff', return_value=0)]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.batch = metadata.Batch('token')
+
+
+    def tearDown(self):
+        self.drive.stop()
+
+
+    def add_files(self, count):
+        return [self.drive.add_file(b'data')['id'] for _ in range(count)]
+
+
+    def batches(self):
+        return self.drive.count('POST', BATCH_PATH)
+
+
+    def test_grouping(self):
+        """Calls are sent at most BATCH_SIZE at a time."""
+
+        file_ids = self.add_files(250)
+        for file_id in file_ids:
+            self.batch.add(metadata.update(file_id, description='mirrored'))
+        self.assertEqual(self.batches(), 2)
+
+        self.assertEqual(self.batch.flush(), [])
+        self.assertEqual(self.batches(), 3)
+        self.assertEqual(self.drive.count('PATCH'), 250)
+        self.assertTrue(all(self.drive.files[file_id]['description']
+                            == 'mirrored' for file_id in file_ids))
+
+
+    def test_flush_empty(self):
+        self.assertEqual(self.batch.flush(), [])
+        self.assertEqual(self.batches(), 0)
+
+
+    def test_operations(self):
+        file_id, = self.add_files(1)
+        folder = self.drive.add_file(b'', 'folder')['id']
+        operations = [
+            metadata.move(file_id, folder),
+            metadata.update(file_id, properties={'origin': 'http://o/a'}),
+            metadata.share(file_id, 'someone@example.com', role='writer'),
+            metadata.share(file_id)]
+        for operation in operations:
+            self.batch.add(operation)
+        self.assertEqual(self.batch.flush(), [])
+
+        self.assertEqual(self.drive.files[file_id]['parents'], [folder])
+        self.assertEqual(self.drive.files[file_id]['properties'],
+                         {'origin': 'http://o/a'})
+        self.assertEqual(
+            [(p['type'], p['role'], p.get('emailAddress'))
+             for p in self.drive.permissions[file_id]],
+            [('user', 'writer', 'someone@example.com'),
+             ('anyone', 'reader', None)])
+        self.assertEqual(operations[2].status, 200)
+        self.assertEqual(operations[2].result['role'], 'writer')
+
+        self.batch.add(metadata.delete(file_id))
+        self.assertEqual(self.batch.flush(), [])
+        self.assertNotIn(file_id, self.drive.files)
+
+
+    def test_item_errors(self):
+        """Failed calls do not fail the others of their batch."""
+
+        file_ids = self.add_files(3)
+        operations = [self.batch.add(metadata.update(file_id, starred=True))
+                      for file_id in file_ids]
+        missing = self.batch.add(metadata.delete('missing'))
+
+        self.assertEqual(self.batch.flush(), [missing])
+        self.assertEqual(missing.status, 404)
+        self.assertIn('not found', missing.error)
+        self.assertEqual(missing.attempts, 1)
+        self.assertTrue(all(operation.ok for operation in operations))
+        self.assertEqual(self.batches(), 1)
+
+
+    def test_retry(self):
+        """Throttled calls and server errors are sent again, alone."""
+
+        file_ids = self.add_files(4)
+        self.drive.item_errors = [None, 403, 503, 429]
+        operations = [self.batch.add(metadata.update(file_id, starred=True))
+                      for file_id in file_ids]
+
+        self.assertEqual(self.batch.flush(), [])
+        self.assertEqual([operation.attempts for operation in operations],
+                         [1, 2, 2, 2])
+        self.assertEqual(self.batches(), 2)
+        self.assertEqual(self.drive.count('PATCH'), 7)
+        self.assertTrue(all(self.drive.files[file_id]['starred']
+                            for file_id in file_ids))
+
+
+    def test_retries_exhausted(self):
+        file_id, = self.add_files(1)
+        self.drive.item_errors = [503] * 3
+        batch = metadata.Batch('token', max_retries=2)
+        operation = batch.add(metadata.update(file_id, starred=True))
+
+        self.assertEqual(batch.flush(), [operation])
+        self.assertEqual((operation.status, operation.attempts), (503, 3))
+
+
+    def test_batch_throttled(self):
+        """A batch refused as a whole is sent again."""
+
+        file_id, = self.add_files(1)
+        throttle_reply = self.drive.throttle_reply
+
+        def throttle_once():
+            self.drive.max_in_flight = None
+            return throttle_reply()
+
+        self.drive.max_in_flight = 0
+        operation = self.batch.add(metadata.delete(file_id))
+        with patch.object(self.drive, 'throttle_reply', throttle_once):
+            self.assertEqual(self.batch.flush(), [])
+        self.assertEqual(operation.attempts, 2)
+        self.assertEqual(self.batches(), 2)
+        self.assertNotIn(file_id, self.drive.files)
+
+
+    def test_batch_throttled_for_good(self):
+        """Batches refused as a whole are retried by one layer only."""
+
+        file_id, = self.add_files(1)
+        self.drive.max_in_flight = 0
+        batch = metadata.Batch('token', max_retries=2)
+        operation = batch.add(metadata.delete(file_id))
+
+        self.assertEqual(batch.flush(), [operation])
+        self.assertEqual(operation.attempts, 3)
+        self.assertEqual(self.batches(), 3)
+        self.assertIn(file_id, self.drive.files)
+
+
+    def test_batch_size(self):
+        file_ids = self.add_files(101)
+        batch = metadata.Batch('token', batch_size=200)
+        self.assertEqual(batch.batch_size, metadata.BATCH_SIZE)
+        for file_id in file_ids:
+            batch.add(metadata.update(file_id, starred=True))
+        self.assertEqual(batch.flush(), [])
+        self.assertEqual(self.batches(), 2)
+
+
+    def test_too_large(self):
+        """Batches larger than Drive takes fail as a whole."""
+
+        file_ids = self.add_files(metadata.BATCH_SIZE + 1)
+        self.batch.batch_size = len(file_ids)
+        for file_id in file_ids:
+            self.batch.add(metadata.update(file_id, starred=True))
+        failed = self.batch.flush()
+        self.assertEqual(len(failed), len(file_ids))
+        self.assertEqual({operation.status for operation in failed}, {400})
+        self.assertEqual(self.batches(), 1)
+        self.assertEqual(self.drive.count('PATCH'), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
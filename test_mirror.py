@@ -0,0 +1,266 @@
+import unittest
+from unittest.mock import patch
+import functools
+import http.server
+import logging
+import os
+import tempfile
+import threading
+
+import requests
+
+import mirror as mirrorm
+import folders
+import transport as transportm
+import cancellation
+import metadata
+from fake_drive import FakeDrive, BATCH_PATH
+
+
+def setUpModule():
+    """Disable logging while doing these tests."""
+    logging.disable()
+
+
+def tearDownModule():
+    """Re-enable logging after doing these tests."""
+    logging.disable(logging.NOTSET)
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+class OriginTestCase(unittest.TestCase):
+    """A directory tree served with autoindex listings."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.directory.name, 'pub')
+        self.files = {'a.txt': b'alpha',
+                      'b.pdf': b'bravo' * 100,
+                      'sub/c.txt': b'charlie',
+                      'sub/deeper/d.pdf': b'delta'}
+        for path, data in self.files.items():
+            self.write(path, data)
+
+        handler = functools.partial(_QuietHandler,
+                                    directory=self.directory.name)
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                      handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.index = 'http://127.0.0.1:{}/pub/'.format(
+            self.server.server_address[1])
+
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.directory.cleanup()
+
+
+    def write(self, path, data):
+        filename = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'wb') as f:
+            f.write(data)
+
+
+class TestCrawl(OriginTestCase):
+
+    def paths(self, index):
+        return sorted(entry.path for entry in mirrorm.crawl(index))
+
+
+    def test_autoindex(self):
+        self.assertEqual(self.paths(self.index), sorted(self.files))
+
+
+    def test_max_depth(self):
+        entries = mirrorm.crawl(self.index, max_depth=1)
+        self.assertEqual(sorted(entry.path for entry in entries),
+                         ['a.txt', 'b.pdf', 'sub/c.txt'])
+
+
+    def test_listing_links(self):
+        """Parent directories, sort orders and other sites are skipped."""
+
+        self.write('index.html', b'<a href="?C=N;O=D">Name</a>'
+                   b'<a href="../">Parent Directory</a>'
+                   b'<a href="http://example.com/x.txt">x</a>'
+                   b'<a href="a.txt">a.txt</a>'
+                   b'<a href="sub/">sub/</a>')
+        self.assertEqual(self.paths(self.index),
+                         ['a.txt', 'sub/c.txt', 'sub/deeper/d.pdf'])
+
+
+    def test_sitemap(self):
+        self.write('sitemap.xml', b'<?xml version="1.0"?>'
+                   b'<urlset xmlns="http://www.sitemaps.org/schemas/'
+                   b'sitemap/0.9"><url><loc>' + self.index.encode()
+                   + b'sub/c.txt</loc></url></urlset>')
+        self.assertEqual(self.paths(self.index + 'sitemap.xml'),
+                         ['sub/c.txt'])
+
+
+    def test_unreachable(self):
+        with self.assertRaises(RuntimeError):
+            list(mirrorm.crawl(self.index + 'missing/'))
+
+
+    def test_cancel(self):
+        cancel = cancellation.CancelToken()
+        cancel.cancel()
+        with self.assertRaises(cancellation.Cancelled):
+            list(mirrorm.crawl(self.index, cancel=cancel))
+
+
+class TestMirror(OriginTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.drive = FakeDrive().start()
+        self.patcher = patch('url.API_ROOT', self.drive.url)
+        self.patcher.start()
+        self.manifest = mirrorm.Manifest(
+            os.path.join(self.directory.name, 'manifest.json'))
+
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.drive.stop()
+        super().tearDown()
+
+
+    def mirror(self, **kwargs):
+        return mirrorm.Mirror(self.index, 'token', manifest=self.manifest,
+                              **kwargs).run()
+
+
+    def drive_paths(self):
+        """Return the paths of the files in Drive, with their contents."""
+
+        files = self.drive.files
+
+        def path(metadata):
+            parents = metadata.get('parents')
+            if not parents:
+                return metadata['name']
+            return path(files[parents[0]]) + '/' + metadata['name']
+
+        return {path(metadata): self.drive.content[file_id]
+                for file_id, metadata in files.items()
+                if metadata.get('mimeType') != folders.FOLDER_MIME_TYPE}
+
+
+    def test_mirror(self):
+        result = self.mirror()
+        self.assertEqual(sorted(result.transferred), sorted(self.files))
+        self.assertEqual(self.drive_paths(),
+                         {'pub/' + path: data
+                          for path, data in self.files.items()})
+
+
+    def test_filters(self):
+        result = self.mirror(include=['*.pdf'], max_size=100)
+        self.assertEqual(result.transferred, ['sub/deeper/d.pdf'])
+
+
+    def test_incremental(self):
+        """Re-runs only transfer what changed, replacing the old copy."""
+
+        self.mirror()
+        posts = self.drive.count('POST')
+
+        result = self.mirror()
+        self.assertEqual(result.transferred, [])
+        self.assertEqual(sorted(result.unchanged), sorted(self.files))
+        self.assertEqual(self.drive.count('POST'), posts)
+
+        self.write('a.txt', b'alpha, again')
+        filename = os.path.join(self.root, 'a.txt')
+        os.utime(filename, (os.path.getmtime(filename) + 10,) * 2)
+        result = self.mirror()
+        self.assertEqual(result.transferred, ['a.txt'])
+        self.assertEqual(self.drive_paths()['pub/a.txt'], b'alpha, again')
+        self.assertEqual(len(self.drive_paths()), len(self.files))
+
+
+    def test_follow_up(self):
+        """Follow-up changes and removals of old copies are batched."""
+
+        follow_up = lambda entry, file_id: [
+            metadata.update(file_id, description=entry.url)]
+        self.mirror(follow_up=follow_up)
+        self.assertEqual(self.drive.count('PATCH'), len(self.files))
+        self.assertEqual(self.drive.count('POST', BATCH_PATH), 1)
+        self.assertEqual(
+            sorted(found['description']
+                   for found in self.drive.files.values()
+                   if 'description' in found),
+            sorted(self.index + path for path in self.files))
+
+        self.write('a.txt', b'alpha, again')
+        filename = os.path.join(self.root, 'a.txt')
+        os.utime(filename, (os.path.getmtime(filename) + 10,) * 2)
+        self.mirror()
+        self.assertEqual(self.drive.count('DELETE'), 1)
+        self.assertEqual(self.drive.count('POST', BATCH_PATH), 2)
+
+
+    def test_deleted_in_drive(self):
+        """Files and folders removed from Drive are mirrored again."""
+
+        self.mirror()
+        self.drive.files.clear()
+        self.drive.content.clear()
+
+        result = self.mirror()
+        self.assertEqual(sorted(result.transferred), sorted(self.files))
+        self.assertEqual(len(self.drive_paths()), len(self.files))
+
+
+    def test_check_failed(self):
+        """Unchanged files whose copy cannot be checked fail alone."""
+
+        self.mirror()
+        transport = transportm.RequestsTransport()
+        with patch.object(transport, 'get',
+                          side_effect=requests.ConnectionError) as get:
+            result = self.mirror(transport=transport)
+        self.assertEqual(sorted(path for path, _ in result.failed),
+                         sorted(self.files))
+        self.assertEqual({call.kwargs['timeout'] for call in get.mock_calls},
+                         {folders.urlm.API_TIMEOUT})
+
+
+    def test_deadline(self):
+        """Files being transferred stop at the mirror’s deadline."""
+
+        deadlines = []
+
+        def drive_it(url):
+            deadlines.append(url.cancel.remaining())
+            raise RuntimeError('Stop here')
+        with patch('mirror.urlm.Url.drive_it', autospec=True,
+                   side_effect=drive_it):
+            self.mirror(cancel=cancellation.CancelToken(100))
+        self.assertEqual(len(deadlines), len(self.files))
+        self.assertTrue(all(deadline is not None and deadline <= 100
+                            for deadline in deadlines))
+
+
+    def test_failures(self):
+        with patch('mirror.urlm.Url.drive_it',
+                   side_effect=RuntimeError('Boom')):
+            result = self.mirror()
+        self.assertEqual(len(result.failed), len(self.files))
+        self.assertIn('failed', result.summary())
+
+
+if __name__ == '__main__':
+    unittest.main()
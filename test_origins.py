@@ -0,0 +1,263 @@
+import unittest
+from unittest.mock import patch
+import http.server
+import logging
+import os
+import pathlib
+import socket
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+
+import origins
+import cancellation
+
+
+BODY = b'x' * 1000
+
+
+def setUpModule():
+    """Disable logging while doing these tests."""
+    logging.disable()
+
+
+def tearDownModule():
+    """Re-enable logging after doing these tests."""
+    logging.disable(logging.NOTSET)
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    """Keeps connections alive, unless the server says otherwise."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def _reply(self, status, body=b'', headers=()):
+        self.server.clients.add(self.client_address)
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+        # Hang up without telling, as servers do with idle connections.
+        if self.server.hang_up:
+            self.close_connection = True
+
+
+    def do_GET(self):
+        if self.path == '/redirect':
+            self._reply(302, headers=[('Location', '/file')])
+        elif self.path == '/missing':
+            self._reply(404, b'not found')
+        else:
+            self._reply(200, BODY)
+
+
+    do_HEAD = do_GET
+
+
+class TestPool(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                      _Handler)
+        self.server.daemon_threads = True
+        self.server.clients = set()
+        self.server.hang_up = False
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.root = 'http://127.0.0.1:{}'.format(
+            self.server.server_address[1])
+        self.pool = origins.OriginPool(per_host=2)
+
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+    def get(self, path='/file', method='GET'):
+        request = urllib.request.Request(self.root + path, method=method)
+        with self.pool.urlopen(request, timeout=5) as response:
+            return response.status, response.read(), response.url
+
+
+    def host_stats(self):
+        return self.pool.stats()['hosts']['http://127.0.0.1:{}'.format(
+            self.server.server_address[1])]
+
+
+    def test_reuse(self):
+        for _ in range(5):
+            self.assertEqual(self.get()[:2], (200, BODY))
+
+        stats = self.host_stats()
+        self.assertEqual(len(self.server.clients), 1)
+        self.assertEqual((stats['requests'], stats['connections'],
+                          stats['reused']), (5, 1, 4))
+        self.assertEqual(stats['reuse_ratio'], 0.8)
+        self.assertEqual(stats['idle'], 1)
+
+
+    def test_unread(self):
+        """Responses not read to their end still leave the connection."""
+
+        url = self.root + '/file'
+        for request in (urllib.request.Request(url, method='HEAD'), url):
+            with self.pool.urlopen(request, timeout=5) as response:
+                response.read(10)
+        self.assertEqual(self.host_stats()['connections'], 1)
+
+
+    def test_per_host_limit(self):
+        first = self.pool.urlopen(self.root + '/file', timeout=5)
+        second = self.pool.urlopen(self.root + '/file', timeout=5)
+        with self.assertRaises(urllib.error.URLError):
+            self.pool.urlopen(self.root + '/file', timeout=0.1)
+        self.assertEqual(self.host_stats()['in_flight'], 2)
+
+        first.close()
+        with self.pool.urlopen(self.root + '/file', timeout=5) as third:
+            self.assertEqual(third.read(), BODY)
+        second.close()
+        self.assertEqual(self.host_stats()['waits'], 1)
+
+
+    def test_wait_cancelled(self):
+        """Waiting for a free connection, with no timeout, can be
+        cancelled."""
+
+        held = [self.pool.urlopen(self.root + '/file', timeout=5)
+                for _ in range(2)]
+        cancel = cancellation.CancelToken()
+        raised = []
+
+        def wait():
+            try:
+                self.pool.urlopen(self.root + '/file', cancel=cancel)
+            except cancellation.Cancelled as e:
+                raised.append(e)
+        waiter = threading.Thread(target=wait)
+        waiter.start()
+        waiter.join(0.2)
+        self.assertTrue(waiter.is_alive())
+
+        cancel.cancel()
+        waiter.join(5)
+        self.assertFalse(waiter.is_alive())
+        self.assertEqual(len(raised), 1)
+        for response in held:
+            response.close()
+        self.assertEqual(self.host_stats()['in_flight'], 0)
+
+
+    def test_ssl_context_on_demand(self):
+        """The CA certificates are not loaded for plain HTTP."""
+
+        with patch('ssl.create_default_context') as create:
+            pool = origins.OriginPool()
+            pool.urlopen(self.root + '/file', timeout=5).close()
+            create.assert_not_called()
+            pool.ssl_context
+            create.assert_called_once()
+        pool.close()
+
+
+    def test_stale(self):
+        """A connection the server closed meanwhile is replaced."""
+
+        self.server.hang_up = True
+        for _ in range(3):
+            self.assertEqual(self.get()[:2], (200, BODY))
+        stats = self.host_stats()
+        self.assertEqual(stats['connections'], 3)
+        self.assertGreaterEqual(stats['stale'], 1)
+
+
+    def test_redirect(self):
+        status, body, url = self.get('/redirect')
+        self.assertEqual((status, body), (200, BODY))
+        self.assertEqual(url, self.root + '/file')
+
+
+    def test_error(self):
+        with self.assertRaises(urllib.error.HTTPError) as raised:
+            self.get('/missing')
+        self.assertEqual(raised.exception.code, 404)
+        self.assertEqual(self.host_stats()['in_flight'], 0)
+
+
+    def test_unreachable(self):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        with self.assertRaises(urllib.error.URLError):
+            self.pool.urlopen('http://127.0.0.1:{}/'.format(port), timeout=5)
+
+
+class TestDnsCache(unittest.TestCase):
+
+    def test_cached(self):
+        cache = origins.DnsCache(ttl=60)
+        with patch('socket.getaddrinfo',
+                   wraps=socket.getaddrinfo) as getaddrinfo:
+            first = cache.resolve('localhost', 80)
+            self.assertEqual(cache.resolve('localhost', 80), first)
+        self.assertEqual(getaddrinfo.call_count, 1)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+
+    def test_expired(self):
+        cache = origins.DnsCache(ttl=0)
+        with patch('socket.getaddrinfo',
+                   wraps=socket.getaddrinfo) as getaddrinfo:
+            cache.resolve('localhost', 80)
+            cache.resolve('localhost', 80)
+        self.assertEqual(getaddrinfo.call_count, 2)
+
+
+    def test_failure(self):
+        """Failures are remembered, for a shorter while."""
+
+        cache = origins.DnsCache(negative_ttl=60)
+        error = socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+        with patch('socket.getaddrinfo', side_effect=error) as getaddrinfo:
+            for _ in range(2):
+                with self.assertRaises(socket.gaierror):
+                    cache.resolve('nowhere.invalid', 80)
+        self.assertEqual(getaddrinfo.call_count, 1)
+
+
+    def test_moved(self):
+        """Addresses that do not answer are forgotten."""
+
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        cache = origins.DnsCache()
+        with self.assertRaises(OSError):
+            cache.create_connection(('127.0.0.1', port), timeout=5)
+        self.assertEqual(cache.stats()['entries'], 0)
+
+
+class TestUrlopen(unittest.TestCase):
+
+    def test_file(self):
+        """Other schemes go through ‘urllib’."""
+
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(BODY)
+        self.addCleanup(os.remove, f.name)
+        with origins.urlopen(pathlib.Path(f.name).as_uri()) as response:
+            self.assertEqual(response.read(), BODY)
+
+
+if __name__ == '__main__':
+    unittest.main()
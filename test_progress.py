@@ -0,0 +1,148 @@
+import unittest
+from unittest.mock import patch
+import json
+import logging
+import os
+import pathlib
+import threading
+from tempfile import NamedTemporaryFile
+
+import url as urlm
+import progress as progressm
+
+
+TEMP_FILE_SIZE = 256 * 1024
+
+
+def setUpModule():
+    """Disable logging while doing these tests."""
+    logging.disable()
+
+
+def tearDownModule():
+    """Re-enable logging after doing these tests."""
+    logging.disable(logging.NOTSET)
+
+
+class TestProgress(unittest.TestCase):
+    """Updates are coalesced and carry rate and ETA."""
+
+    def test_updates_are_coalesced(self):
+        """Many updates within the interval publish once."""
+
+        progress = progressm.Progress()
+        progress.start('download', 1000)
+        version = progress.version
+        for done in range(1, 999):
+            progress.update(done)
+
+        self.assertEqual(progress.done, 998)
+        self.assertLessEqual(progress.version - version, 1)
+
+
+    def test_completion_is_published(self):
+        """Reaching the total is never held back."""
+
+        progress = progressm.Progress()
+        progress.start('upload', 10)
+        progress.update(1)
+        version = progress.version
+        progress.update(10)
+
+        self.assertEqual(progress.version, version + 1)
+        self.assertEqual(progress.snapshot()['eta'], 0)
+
+
+    def test_rate_and_eta(self):
+        """Rate in bytes per second and the matching ETA."""
+
+        progress = progressm.Progress()
+        with patch('time.monotonic', return_value=100.0):
+            progress.start('download', 3000)
+        with patch('time.monotonic', return_value=101.0):
+            progress.update(1000)
+        snapshot = progress.snapshot()
+
+        self.assertEqual(snapshot['rate'], 1000)
+        self.assertEqual(snapshot['eta'], 2)
+
+
+    def test_events(self):
+        """The event stream follows the transfer until it ends."""
+
+        progress = progressm.Progress()
+        events = []
+
+        def listen():
+            for event in progress.events(heartbeat=0.01):
+                events.append(event)
+
+        listener = threading.Thread(target=listen)
+        listener.start()
+        progress.start('download', 10)
+        progress.update(10)
+        progress.finish('Done')
+        listener.join(5)
+
+        self.assertFalse(listener.is_alive())
+        data = [json.loads(event[len('data: '):])
+                for event in events if event.startswith('data: ')]
+        self.assertEqual(data[-1]['state'], 'done')
+        self.assertEqual(data[-1]['message'], 'Done')
+        self.assertTrue(all(event.endswith('\n\n') for event in events))
+
+
+    def test_finish_after_snapshot(self):
+        """Finishing while an event is being sent still ends in its event."""
+
+        progress = progressm.Progress()
+        progress.start('upload', 10)
+        events = progress.events()
+        next(events)
+
+        progress.update(10)
+        snapshot = progress.snapshot
+        def finish_meanwhile():
+            taken = snapshot()
+            progress.finish('Done')
+            return taken
+        with patch.object(progress, 'snapshot', finish_meanwhile):
+            self.assertIn('"running"', next(events))
+
+        self.assertIn('"done"', next(events))
+
+
+class TestRegistry(unittest.TestCase):
+    """Transfers are found by id."""
+
+    def test_create_and_get(self):
+        registry = progressm.Registry()
+        progress = registry.create(owner='user')
+
+        self.assertIs(registry.get(progress.id), progress)
+        self.assertEqual(progress.owner, 'user')
+        self.assertIsNone(registry.get('nope'))
+
+
+class TestUrlProgress(unittest.TestCase):
+    """‘Url’ reports the download to its progress."""
+
+    def test_download_progress(self):
+        with NamedTemporaryFile(delete=False) as f:
+            f.write(os.urandom(TEMP_FILE_SIZE))
+
+        progress = progressm.Progress()
+        url_obj = urlm.Url(pathlib.Path(f.name).as_uri(), str(),
+                           progress=progress)
+        url_obj.download()
+
+        self.assertEqual(progress.phase, 'download')
+        self.assertEqual(progress.total, TEMP_FILE_SIZE)
+        self.assertEqual(progress.done, TEMP_FILE_SIZE)
+
+        os.remove(f.name)
+        os.remove(url_obj.filename)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,254 @@
+import unittest
+from unittest.mock import patch, MagicMock
+import logging
+import os
+import pathlib
+import threading
+from tempfile import NamedTemporaryFile
+
+import url as urlm
+import cancellation
+import ratelimit
+from fake_drive import FakeDrive
+
+
+TEMP_FILE_SIZE = 4 * 1024
+
+
+def setUpModule():
+    """Disable logging while doing these tests."""
+    logging.disable()
+
+
+def tearDownModule():
+    """Re-enable logging after doing these tests."""
+    logging.disable(logging.NOTSET)
+
+
+def response(status, reason=None, headers=None):
+    """Mock an API response with STATUS and an error REASON."""
+
+    mock = MagicMock(status_code=status, headers=headers or {})
+    errors = [{'reason': reason}] if reason else []
+    mock.json.return_value = {'error': {'code': status, 'errors': errors}}
+    return mock
+
+
+class TestThrottleReason(unittest.TestCase):
+    """Rate-limit answers are told apart from the others."""
+
+    def test_throttle_reason(self):
+        for status, reason, expected in (
+                (200, None, None),
+                (308, None, None),
+                (403, 'insufficientPermissions', None),
+                (403, 'userRateLimitExceeded', 'user'),
+                (403, 'rateLimitExceeded', 'global'),
+                (429, None, 'global'),
+                (500, None, None)):
+            with self.subTest(status=status, reason=reason):
+                self.assertEqual(
+                    ratelimit.throttle_reason(response(status, reason)),
+                    expected)
+
+
+    def test_backoff_honors_retry_after(self):
+        self.assertEqual(
+            ratelimit.backoff(5, response(429, headers={'Retry-After': '3'})),
+            3.0)
+        self.assertLessEqual(ratelimit.backoff(100), ratelimit.BACKOFF_MAX)
+
+
+    def test_retry_after_capped(self):
+        """Long ‘Retry-After’ waits are cut to BACKOFF_MAX."""
+
+        self.assertEqual(
+            ratelimit.backoff(0, response(429,
+                                          headers={'Retry-After': '3600'})),
+            ratelimit.BACKOFF_MAX)
+
+
+class TestAIMDLimiter(unittest.TestCase):
+    """Limits grow additively and shrink multiplicatively."""
+
+    def setUp(self):
+        self.limiter = ratelimit.AIMDLimiter(initial=4, global_initial=8,
+                                             cooldown=0)
+
+
+    def limit(self, which='token'):
+        stats = self.limiter.stats()
+        if which == 'global':
+            return stats['global']['limit']
+        return next(iter(stats['tokens'].values()))['limit']
+
+
+    def test_additive_increase(self):
+        """About one more slot per window of successes."""
+
+        for _ in range(4):
+            with self.limiter.slot('t') as report:
+                report.append(response(200))
+        self.assertEqual(self.limiter.stats()['tokens'], {})
+        self.assertAlmostEqual(self.limiter.stats()['global']['limit'],
+                               8.5, places=1)
+
+
+    def test_errors_do_not_grow(self):
+        """Error answers leave the limits as they are."""
+
+        for status in (500, 503, 404):
+            with self.limiter.slot('t') as report:
+                report.append(response(status))
+        self.assertEqual(self.limit('global'), 8)
+
+
+    def test_multiplicative_decrease(self):
+        """A user rate limit cuts the token limit only."""
+
+        with self.limiter.slot('t') as report:
+            report.append(response(403, 'userRateLimitExceeded'))
+        self.assertEqual(self.limit(), 2)
+        self.assertEqual(self.limit('global'), 8)
+
+        with self.limiter.slot('t') as report:
+            report.append(response(429))
+        self.assertEqual(self.limit(), 1)
+        self.assertEqual(self.limit('global'), 4)
+
+
+    def test_cooldown(self):
+        """One burst of rate-limit answers cuts the limit once."""
+
+        self.limiter.cooldown = 60
+        for _ in range(3):
+            with self.limiter.slot('t') as report:
+                report.append(response(403, 'userRateLimitExceeded'))
+        self.assertEqual(self.limit(), 2)
+
+
+    def test_acquire_blocks_at_limit(self):
+        """No more requests than the limit are in flight."""
+
+        slots = [self.limiter.acquire('t') for _ in range(4)]
+        waiter = threading.Thread(target=self.limiter.acquire, args=('t',))
+        waiter.start()
+        waiter.join(0.05)
+        self.assertTrue(waiter.is_alive())
+
+        self.limiter.release(slots[0])
+        waiter.join(1)
+        self.assertFalse(waiter.is_alive())
+
+
+    def test_waiting_for_global(self):
+        """A token waiting for a global slot is not forgotten meanwhile."""
+
+        limiter = ratelimit.AIMDLimiter(global_initial=1)
+        held = limiter.acquire('t')
+        slots = []
+        waiter = threading.Thread(
+            target=lambda: slots.append(limiter.acquire('t')))
+        waiter.start()
+        waiter.join(0.05)
+        self.assertTrue(waiter.is_alive())
+
+        limiter.release(held)
+        waiter.join(1)
+        limiter.release(slots[0])
+        stats = limiter.stats()
+        self.assertEqual(stats['global']['in_flight'], 0)
+        self.assertEqual(stats['tokens'], {})
+
+
+    def test_acquire_cancelled(self):
+        """Waiting for a slot ends with the transfer."""
+
+        held = [self.limiter.acquire('t') for _ in range(4)]
+        cancel = cancellation.CancelToken()
+        threading.Timer(0.05, cancel.cancel).start()
+        with self.assertRaises(cancellation.Cancelled):
+            self.limiter.acquire('t', cancel)
+
+        for slot in held:
+            self.limiter.release(slot)
+        self.assertEqual(self.limiter.stats()['tokens'], {})
+
+
+    def test_acquire_deadline(self):
+        """Waiting for a slot ends at the transfer’s deadline."""
+
+        for _ in range(4):
+            self.limiter.acquire('t')
+        with self.assertRaises(cancellation.DeadlineExceeded):
+            self.limiter.acquire('t', cancellation.CancelToken(deadline=0.05))
+
+
+class TestSend(unittest.TestCase):
+    """Retries stay within the transfer’s cancellation."""
+
+    def test_backoff_cancelled(self):
+        """Waiting to retry ends with the transfer."""
+
+        throttled = MagicMock(return_value=response(
+            429, headers={'Retry-After': '60'}))
+        cancel = cancellation.CancelToken()
+        threading.Timer(0.05, cancel.cancel).start()
+        with self.assertRaises(cancellation.Cancelled):
+            ratelimit.send(throttled, 'http://drive', 't', cancel=cancel)
+        self.assertEqual(throttled.call_count, 1)
+
+
+    def test_deadline(self):
+        """Attempts get no more time than the transfer has left."""
+
+        ok = MagicMock(return_value=response(200))
+        ratelimit.send(ok, 'http://drive', 't', timeout=30,
+                       cancel=cancellation.CancelToken(deadline=5))
+        self.assertLessEqual(ok.call_args.kwargs['timeout'], 5)
+
+
+class TestThrottledUploads(unittest.TestCase):
+    """Uploads complete against a throttling server."""
+
+    def test_uploads_adapt(self):
+        drive = FakeDrive(latency=0.01, max_in_flight=2).start()
+        limiter = ratelimit.AIMDLimiter(initial=8, global_initial=16,
+                                        cooldown=0)
+        contents = [os.urandom(TEMP_FILE_SIZE) for _ in range(6)]
+        errors = []
+
+        def transfer(content):
+            with NamedTemporaryFile(delete=False) as f:
+                f.write(content)
+            try:
+                url_obj = urlm.Url(pathlib.Path(f.name).as_uri(), 'token')
+                url_obj.download()
+                url_obj._upload(upload_chunk_size=1024)
+                self.assertEqual(drive.content[url_obj.file_id], content)
+                os.remove(url_obj.filename)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                os.remove(f.name)
+
+        with patch('url.API_ROOT', drive.url),\
+             patch('ratelimit.limiter', limiter),\
+             patch('ratelimit.BACKOFF_BASE', 0.01):
+            threads = [threading.Thread(target=transfer, args=(content,))
+                       for content in contents]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        drive.stop()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(drive.files), len(contents))
+        self.assertGreater(drive.throttled, 0)
+        tokens = limiter.stats()['tokens']
+        self.assertLess(next(iter(tokens.values()))['limit'], 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+import unittest
+import logging
+import threading
+import time
+
+import scheduler as schedulerm
+
+
+def setUpModule():
+    """Disable logging while doing these tests."""
+    logging.disable()
+
+
+def tearDownModule():
+    """Re-enable logging after doing these tests."""
+    logging.disable(logging.NOTSET)
+
+
+class TestFairScheduler(unittest.TestCase):
+    """Jobs are run fairly across users and shortest first per user."""
+
+    def setUp(self):
+        # A single worker makes the dispatch order observable.  It is
+        # kept busy by a blocking job until everything is queued.
+        self.scheduler = schedulerm.FairScheduler(workers=1,
+                                                  per_user_limit=1)
+        self.gate = threading.Event()
+        self.order = []
+        self.scheduler.submit('blocker', self.gate.wait)
+
+
+    def tearDown(self):
+        self.gate.set()
+        self.scheduler.shutdown()
+
+
+    def job(self, name):
+        return lambda: self.order.append(name)
+
+
+    def run_all(self, futures):
+        self.gate.set()
+        for future in futures:
+            future.result(timeout=5)
+
+
+    def test_users_take_turns(self):
+        """A user with a long queue does not delay the others."""
+
+        futures = [self.scheduler.submit('a', self.job('a{}'.format(i)),
+                                         size=100)
+                   for i in range(5)]
+        futures.append(self.scheduler.submit('b', self.job('b0'),
+                                             size=100))
+        self.run_all(futures)
+
+        self.assertLess(self.order.index('b0'), 2)
+
+
+    def test_weights(self):
+        """A user with twice the weight gets twice the turns."""
+
+        self.scheduler.weights['heavy'] = 2
+        futures = []
+        for i in range(6):
+            for user in ('heavy', 'light'):
+                futures.append(self.scheduler.submit(
+                    user, self.job(user), size=100))
+        self.run_all(futures)
+
+        self.assertEqual(self.order[:6].count('heavy'), 4)
+
+
+    def test_shortest_first(self):
+        """Each user’s jobs run by expected size, unknown sizes last."""
+
+        futures = [self.scheduler.submit('a', self.job(size), size=size)
+                   for size in (300, None, 100, 200)]
+        self.run_all(futures)
+
+        self.assertEqual(self.order, [100, 200, 300, None])
+
+
+    def test_unknown_after_large(self):
+        """Unknown sizes run after known ones larger than UNKNOWN_SIZE."""
+
+        large = 2 * schedulerm.UNKNOWN_SIZE
+        futures = [self.scheduler.submit('a', self.job(size), size=size)
+                   for size in (None, large)]
+        self.run_all(futures)
+
+        self.assertEqual(self.order, [large, None])
+
+
+    def test_result_and_exception(self):
+        """Futures carry results and errors of the jobs."""
+
+        ok = self.scheduler.submit('a', lambda x: x * 2, 21)
+        ko = self.scheduler.submit('a', lambda: 1 / 0)
+        self.gate.set()
+
+        self.assertEqual(ok.result(timeout=5), 42)
+        with self.assertRaises(ZeroDivisionError):
+            ko.result(timeout=5)
+
+
+    def test_stats(self):
+        """Queue depth and waits are reported per user."""
+
+        self.scheduler.submit('a', self.job('a'))
+        self.scheduler.submit('a', self.job('a'))
+        time.sleep(0.01)
+        stats = self.scheduler.stats()
+
+        self.assertEqual(stats['a']['queued'], 2)
+        self.assertEqual(stats['a']['running'], 0)
+        self.assertGreater(stats['a']['oldest_wait'], 0)
+        self.assertEqual(stats['blocker']['running'], 1)
+
+
+class TestPerUserLimit(unittest.TestCase):
+    """No user runs more than the allowed number of jobs at once."""
+
+    def test_per_user_limit(self):
+        scheduler = schedulerm.FairScheduler(workers=4, per_user_limit=2)
+        lock = threading.Lock()
+        running = {'now': 0, 'max': 0}
+
+        def job():
+            with lock:
+                running['now'] += 1
+                running['max'] = max(running['max'], running['now'])
+            time.sleep(0.01)
+            with lock:
+                running['now'] -= 1
+
+        futures = [scheduler.submit('a', job) for _ in range(10)]
+        for future in futures:
+            future.result(timeout=5)
+        scheduler.shutdown()
+
+        self.assertEqual(running['max'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,290 @@
+import unittest
+from unittest.mock import patch
+import datetime
+import logging
+import os
+import pathlib
+import tempfile
+import threading
+import time
+
+import requests
+
+import store as storem
+import worker as workerm
+from fake_drive import FakeDrive, UPLOAD_PATH
+
+
+TEMP_FILE_SIZE = 1024 * 1024
+
+
+def setUpModule():
+    """Disable logging while doing these tests."""
+    logging.disable()
+
+
+def tearDownModule():
+    """Re-enable logging after doing these tests."""
+    logging.disable(logging.NOTSET)
+
+
+class StoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = storem.SQLiteStore(
+            os.path.join(self.directory.name, 'jobs.db'))
+
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+
+class TestSQLiteStore(StoreTestCase):
+    """Jobs are claimed under leases, one worker at a time."""
+
+    def test_lifecycle(self):
+        job_id = self.store.enqueue('alice', 'http://example.com/a', 10)
+        self.assertEqual(self.store.get(job_id).state, 'queued')
+
+        job = self.store.claim('w1')
+        self.assertEqual((job.id, job.state, job.worker, job.attempts),
+                         (job_id, 'running', 'w1', 1))
+        self.assertIsNone(self.store.claim('w2'))
+
+        self.assertFalse(self.store.heartbeat(job_id, 'w1',
+                                              progress={'done': 5}))
+        self.assertEqual(self.store.get(job_id).snapshot()['done'], 5)
+
+        self.store.finish(job_id, 'w1', 'done', 'Yay')
+        job = self.store.get(job_id)
+        self.assertTrue(job.finished)
+        self.assertEqual(job.snapshot()['message'], 'Yay')
+
+
+    def test_expired_lease(self):
+        """An expired lease is taken over; the old worker learns it."""
+
+        job_id = self.store.enqueue('alice', 'http://example.com/a')
+        self.store.claim('w1', lease=0)
+        time.sleep(0.01)
+
+        job = self.store.claim('w2')
+        self.assertEqual((job.id, job.attempts), (job_id, 2))
+        with self.assertRaises(storem.LeaseLost):
+            self.store.heartbeat(job_id, 'w1')
+
+        # The late worker cannot overwrite the outcome either.
+        self.store.finish(job_id, 'w1', 'error', 'Too late')
+        self.assertEqual(self.store.get(job_id).state, 'running')
+
+
+    def test_too_many_attempts(self):
+        job_id = self.store.enqueue('alice', 'http://example.com/a')
+        for attempt in range(storem.MAX_ATTEMPTS):
+            self.store.claim('w{}'.format(attempt), lease=0)
+            time.sleep(0.01)
+
+        self.assertIsNone(self.store.claim('w'))
+        self.assertEqual(self.store.get(job_id).state, 'error')
+
+
+    def test_claim_order(self):
+        """Idle users first, then smaller jobs, then unknown sizes."""
+
+        big = self.store.enqueue('alice', 'http://example.com/big', 100)
+        unknown = self.store.enqueue('alice', 'http://example.com/unknown')
+        small = self.store.enqueue('alice', 'http://example.com/small', 1)
+        bob = self.store.enqueue('bob', 'http://example.com/bob', 1000)
+
+        order = [self.store.claim('w').id for _ in range(4)]
+        self.assertEqual(order, [small, bob, big, unknown])
+
+
+    def test_per_user_limit(self):
+        self.store.enqueue('alice', 'http://example.com/a')
+        self.store.enqueue('alice', 'http://example.com/b')
+
+        self.assertIsNotNone(self.store.claim('w1', per_user_limit=1))
+        self.assertIsNone(self.store.claim('w2', per_user_limit=1))
+
+
+    def test_cancel(self):
+        queued = self.store.enqueue('alice', 'http://example.com/a')
+        running = self.store.enqueue('alice', 'http://example.com/b')
+        self.store.request_cancel(queued)
+        self.assertEqual(self.store.get(queued).state, 'error')
+
+        self.store.claim('w')
+        self.store.request_cancel(running)
+        self.assertTrue(self.store.heartbeat(running, 'w'))
+
+
+    def test_credentials(self):
+        self.assertIsNone(self.store.load_credentials('alice'))
+        self.store.save_credentials('alice', {'token': 't'})
+        self.assertEqual(self.store.load_credentials('alice'),
+                         {'token': 't'})
+
+
+class TestWorker(StoreTestCase):
+    """Workers run the stored jobs against the Drive."""
+
+    def setUp(self):
+        super().setUp()
+        self.drive = FakeDrive().start()
+        self.patcher = patch('url.API_ROOT', self.drive.url)
+        self.patcher.start()
+
+        self.data = os.urandom(TEMP_FILE_SIZE)
+        self.source = os.path.join(self.directory.name, 'source.bin')
+        with open(self.source, 'wb') as f:
+            f.write(self.data)
+        self.store.save_credentials('alice', {'token': 'token'})
+        self.worker = workerm.Worker(self.store, 'w')
+
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.drive.stop()
+        super().tearDown()
+
+
+    def test_run(self):
+        """A queued job is claimed once and uploads its file."""
+
+        job_id = self.store.enqueue('alice',
+                                    pathlib.Path(self.source).as_uri())
+        self.assertTrue(self.worker.run_once())
+        self.assertFalse(self.worker.run_once())
+
+        job = self.store.get(job_id)
+        self.assertEqual(job.state, 'done', job.message)
+        self.assertIsNotNone(job.upload_url)
+        self.assertEqual(list(self.drive.content.values()), [self.data])
+
+
+    def test_no_credentials(self):
+        """Jobs of users without stored credentials fail untried."""
+
+        job_id = self.store.enqueue('bob', pathlib.Path(self.source).as_uri())
+        self.worker.run_once()
+        self.assertEqual(self.store.get(job_id).state, 'error')
+        self.assertEqual(self.drive.count('POST'), 0)
+
+
+    def expired(self):
+        self.store.save_credentials('alice', {
+            'token': 'old', 'refresh_token': 'refresh',
+            'token_uri': 'https://oauth2.example.com/token',
+            'client_id': 'id', 'client_secret': 'secret', 'scopes': None,
+            'expiry': (datetime.datetime.utcnow()
+                       - datetime.timedelta(hours=1)).isoformat()})
+        return self.store.enqueue('alice',
+                                  pathlib.Path(self.source).as_uri())
+
+
+    def test_refresh(self):
+        """Expired access tokens are refreshed, and saved, first."""
+
+        def refresh(credentials, request):
+            credentials.token = 'new'
+            credentials.expiry = datetime.datetime.utcnow() \
+                + datetime.timedelta(hours=1)
+
+        job_id = self.expired()
+        tokens = []
+        real_url = workerm.urlm.Url
+
+        def url(source, token, **kwargs):
+            tokens.append(token)
+            return real_url(source, token, **kwargs)
+        with patch('google.oauth2.credentials.Credentials.refresh',
+                   autospec=True, side_effect=refresh), \
+                patch('worker.urlm.Url', url):
+            self.worker.run_once()
+
+        self.assertEqual(self.store.get(job_id).state, 'done')
+        self.assertEqual(tokens, ['new'])
+        stored = self.store.load_credentials('alice')
+        self.assertEqual(stored['token'], 'new')
+        self.assertEqual(stored['refresh_token'], 'refresh')
+        self.assertFalse(workerm.credentials_from_dict(stored).expired)
+
+
+    def test_refresh_failed(self):
+        """Revoked credentials fail the job before any upload."""
+
+        import google.auth.exceptions
+        job_id = self.expired()
+        with patch('google.oauth2.credentials.Credentials.refresh',
+                   side_effect=google.auth.exceptions.RefreshError(
+                       'invalid_grant')):
+            self.worker.run_once()
+        self.assertEqual(self.store.get(job_id).state, 'error')
+        self.assertEqual(self.drive.count('POST'), 0)
+        self.assertEqual(self.store.load_credentials('alice')['token'], 'old')
+
+
+    def test_cancel_running(self):
+        """A running job stops soon after it is asked to, not at the
+        next heartbeat."""
+
+        job_id = self.store.enqueue('alice',
+                                    pathlib.Path(self.source).as_uri())
+        started = threading.Event()
+
+        class Url:
+            reused = False
+
+            def __init__(self, source, token, cancel, **kwargs):
+                self.cancel = cancel
+
+            def drive_it(self):
+                stopped = threading.Event()
+                self.cancel.on_cancel(stopped.set)
+                started.set()
+                stopped.wait(30)
+                self.cancel.check()
+
+        with patch('worker.urlm.Url', Url), \
+                patch('worker.CANCEL_POLL', 0.05):
+            run = threading.Thread(target=self.worker.run_once)
+            run.start()
+            self.assertTrue(started.wait(5))
+            begun = time.monotonic()
+            self.store.request_cancel(job_id)
+            run.join(10)
+
+        self.assertLess(time.monotonic() - begun, 5)
+        job = self.store.get(job_id)
+        self.assertEqual(job.state, 'error')
+        self.assertIn('cancel', job.message.lower())
+
+
+    def test_resume(self):
+        """A job taken over continues the upload session it left."""
+
+        response = requests.post(self.drive.url + UPLOAD_PATH,
+                                 json={'name': 'source.bin'})
+        upload_url = response.headers['Location']
+        half = TEMP_FILE_SIZE // 2
+        requests.put(upload_url, data=self.data[:half], headers={
+            'Content-Range': 'bytes 0-{}/{}'.format(half - 1,
+                                                    TEMP_FILE_SIZE)})
+
+        job_id = self.store.enqueue('alice',
+                                    pathlib.Path(self.source).as_uri())
+        self.store.claim('dead', lease=0)
+        self.store.save_upload_url(job_id, upload_url)
+        time.sleep(0.01)
+        self.worker.run_once()
+
+        self.assertEqual(self.store.get(job_id).state, 'done')
+        self.assertEqual(self.drive.bytes_received, TEMP_FILE_SIZE)
+        self.assertEqual(self.drive.count('POST', UPLOAD_PATH), 1)
+        self.assertEqual(list(self.drive.content.values()), [self.data])
+
+
+if __name__ == '__main__':
+    unittest.main()
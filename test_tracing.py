@@ -0,0 +1,296 @@
+import unittest
+from unittest.mock import patch, Mock
+import http.server
+import json
+import logging
+import os
+import pathlib
+import tempfile
+import threading
+
+import tracing
+import ratelimit
+import url as urlm
+from fake_drive import FakeDrive
+
+
+TRACE_ID = '4bf92f3577b34da6a3ce929d0e0e4736'
+SPAN_ID = '00f067aa0ba902b7'
+
+
+def setUpModule():
+    """Disable logging while doing these tests."""
+    logging.disable()
+
+
+def tearDownModule():
+    """Re-enable logging after doing these tests."""
+    logging.disable(logging.NOTSET)
+
+
+class _Collected:
+    """Exporter keeping the records of the spans in a list."""
+
+    def __init__(self):
+        self.records = []
+
+
+    def export(self, record):
+        self.records.append(record)
+
+
+    def named(self, name):
+        return [r for r in self.records if r['name'] == name]
+
+
+class TracingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.collected = _Collected()
+        self.patcher = patch.multiple(tracing.tracer,
+                                      exporter=self.collected, sample=1.0)
+        self.patcher.start()
+
+
+    def tearDown(self):
+        self.patcher.stop()
+
+
+class TestSpans(TracingTestCase):
+
+    def test_nesting(self):
+        with tracing.span('parent', bytes=1) as parent:
+            with tracing.span('child') as child:
+                child.set('offset', 2)
+
+        child, parent = self.collected.records
+        self.assertEqual(child['trace_id'], parent['trace_id'])
+        self.assertEqual(child['parent_id'], parent['span_id'])
+        self.assertIsNone(parent['parent_id'])
+        self.assertEqual(parent['attributes'], {'bytes': 1})
+        self.assertEqual(child['attributes'], {'offset': 2})
+        self.assertIsNone(tracing.current())
+
+
+    def test_failure(self):
+        with self.assertRaises(RuntimeError):
+            with tracing.span('failing'):
+                raise RuntimeError('Boom')
+
+        record, = self.collected.records
+        self.assertEqual(record['status'], 'error')
+        self.assertIn('Boom', record['error'])
+
+
+    def test_unsampled(self):
+        """Nothing of an unsampled trace is exported."""
+
+        tracing.tracer.sample = 0.0
+        with tracing.span('root') as root:
+            with tracing.span('child') as child:
+                child.set('bytes', 1)
+
+        self.assertFalse(root.recording)
+        self.assertFalse(child.recording)
+        self.assertEqual(self.collected.records, [])
+
+
+    def test_not_configured(self):
+        tracing.tracer.exporter = None
+        with tracing.span('root') as root:
+            self.assertIs(root, tracing.UNSAMPLED)
+
+
+    def test_remote_parent(self):
+        """The caller’s decision overrides the sampling probability."""
+
+        tracing.tracer.sample = 0.0
+        span = tracing.tracer.start('request', remote=(TRACE_ID, SPAN_ID,
+                                                       True))
+        span.end()
+
+        record, = self.collected.records
+        self.assertEqual(record['trace_id'], TRACE_ID)
+        self.assertEqual(record['parent_id'], SPAN_ID)
+
+        tracing.tracer.sample = 1.0
+        self.assertIs(tracing.tracer.start('request',
+                                           remote=(TRACE_ID, SPAN_ID, False)),
+                      tracing.UNSAMPLED)
+
+
+    def test_bind(self):
+        """Work handed over to another thread stays in the trace."""
+
+        def child():
+            with tracing.span('child') as span:
+                return span.trace_id
+
+        with tracing.span('parent'):
+            function = tracing.bind(child)
+        thread_trace = []
+        thread = threading.Thread(target=lambda: thread_trace.append(
+            function()))
+        thread.start()
+        thread.join()
+
+        self.assertEqual(thread_trace, [self.collected.records[0]['trace_id']])
+
+
+    def test_traced(self):
+        @tracing.traced('work')
+        def work():
+            tracing.current().set('bytes', 3)
+            return 'done'
+
+        self.assertEqual(work(), 'done')
+        self.assertEqual(self.collected.named('work')[0]['attributes'],
+                         {'bytes': 3})
+
+
+class TestHeaders(unittest.TestCase):
+
+    def test_traceparent(self):
+        headers = {'traceparent': '00-{}-{}-01'.format(TRACE_ID, SPAN_ID)}
+        self.assertEqual(tracing.parse_headers(headers),
+                         (TRACE_ID, SPAN_ID, True))
+
+        headers = {'traceparent': '00-{}-{}-00'.format(TRACE_ID, SPAN_ID)}
+        self.assertEqual(tracing.parse_headers(headers)[2], False)
+
+
+    def test_cloud_trace_context(self):
+        headers = {'X-Cloud-Trace-Context': TRACE_ID.upper() + '/1;o=1'}
+        self.assertEqual(tracing.parse_headers(headers),
+                         (TRACE_ID, '0000000000000001', True))
+
+        headers = {'X-Cloud-Trace-Context': TRACE_ID}
+        self.assertEqual(tracing.parse_headers(headers),
+                         (TRACE_ID, None, None))
+
+
+    def test_invalid(self):
+        for headers in ({}, {'traceparent': 'nonsense'},
+                        {'traceparent': '00-{}-{}-01'.format('0' * 32,
+                                                             SPAN_ID)}):
+            self.assertIsNone(tracing.parse_headers(headers))
+
+
+class TestExporters(unittest.TestCase):
+
+    def setUp(self):
+        self.tracer = tracing.Tracer()
+
+
+    def test_json_lines(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'spans.jsonl')
+            self.tracer.exporter = tracing.exporter_from_url(path)
+            for name in ('one', 'two'):
+                self.tracer.start(name, bytes=1).end()
+
+            with open(path) as f:
+                records = [json.loads(line) for line in f]
+
+        self.assertEqual([r['name'] for r in records], ['one', 'two'])
+        self.assertEqual(records[0]['attributes'], {'bytes': 1})
+
+
+    def test_otlp(self):
+        received = []
+
+        class Collector(http.server.BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                received.append((self.path, json.loads(body)))
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+        server = http.server.HTTPServer(('127.0.0.1', 0), Collector)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        exporter = tracing.exporter_from_url(
+            'http://127.0.0.1:{}'.format(server.server_address[1]))
+        exporter.interval = 0.05
+        self.tracer.exporter = exporter
+        parent = self.tracer.start('parent')
+        child = self.tracer.start('child', parent=parent, offset=5)
+        child.fail('Boom')
+        child.end()
+        parent.end()
+        self.assertTrue(exporter.flush(5))
+
+        spans = [span for path, body in received
+                 for span in body['resourceSpans'][0]['scopeSpans'][0]['spans']]
+        self.assertEqual(received[0][0], '/v1/traces')
+        child, parent = spans
+        self.assertEqual(child['parentSpanId'], parent['spanId'])
+        self.assertEqual(child['attributes'],
+                         [{'key': 'offset', 'value': {'intValue': '5'}}])
+        self.assertEqual(child['status'], {'code': 2, 'message': 'Boom'})
+
+
+class TestRetries(TracingTestCase):
+
+    def test_attempts(self):
+        """Every attempt of a throttled request has its span."""
+
+        throttled = Mock(status_code=429, headers={'Retry-After': '0'})
+        method = Mock(side_effect=[throttled, Mock(status_code=200)],
+                      __name__='put')
+        with tracing.span('chunk'):
+            ratelimit.send(method, 'http://example.com', 'token')
+
+        attempts = self.collected.named('http put')
+        self.assertEqual([a['attributes'] for a in attempts],
+                         [{'attempt': 0, 'status': 429, 'throttled': 'global'},
+                          {'attempt': 1, 'status': 200}])
+        chunk, = self.collected.named('chunk')
+        self.assertTrue(all(a['parent_id'] == chunk['span_id']
+                            for a in attempts))
+
+
+class TestTransfer(TracingTestCase):
+    """A transfer is traced from the download to each chunk."""
+
+    def test_drive_it(self):
+        size = 3 * urlm.UPLOAD_CHUNK_SIZE // 2
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(os.urandom(size))
+        self.addCleanup(os.remove, f.name)
+
+        with FakeDrive() as drive, patch('url.API_ROOT', drive.url):
+            url = urlm.Url(pathlib.Path(f.name).as_uri(), 'token')
+            url.drive_it()
+        os.remove(url.filename)
+
+        root, = self.collected.named('drive_it')
+        download, = self.collected.named('download')
+        upload, = self.collected.named('upload')
+        session, = self.collected.named('create_session')
+        chunks = self.collected.named('chunk')
+
+        self.assertEqual(download['parent_id'], root['span_id'])
+        self.assertEqual(download['attributes']['bytes'], size)
+        self.assertEqual(upload['parent_id'], root['span_id'])
+        self.assertEqual(session['parent_id'], upload['span_id'])
+        self.assertEqual(session['attributes']['status'], 200)
+        self.assertEqual([(c['attributes']['offset'], c['attributes']['bytes'],
+                           c['attributes']['status']) for c in chunks],
+                         [(0, urlm.UPLOAD_CHUNK_SIZE, 308),
+                          (urlm.UPLOAD_CHUNK_SIZE,
+                           size - urlm.UPLOAD_CHUNK_SIZE, 200)])
+        self.assertTrue(all(c['parent_id'] == upload['span_id']
+                            for c in chunks))
+        self.assertEqual({r['trace_id'] for r in self.collected.records},
+                         {root['trace_id']})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import unittest
+from unittest.mock import patch
+import logging
+import os
+import pathlib
+import threading
+from tempfile import NamedTemporaryFile
+
+import url as urlm
+import transport as transportm
+from fake_drive import FakeDrive, StandInServer
+
+
+TEMP_FILE_SIZE = 64 * 1024
+UPLOADS = 6
+
+
+def setUpModule():
+    """Disable logging while doing these tests."""
+    logging.disable()
+
+
+def tearDownModule():
+    """Re-enable logging after doing these tests."""
+    logging.disable(logging.NOTSET)
+
+
+class TestTransports(unittest.TestCase):
+    """Uploads work over both transports; HTTP/2 shares connections."""
+
+    def setUp(self):
+        self.drive = FakeDrive()
+        self.server = StandInServer(self.drive).start()
+        self.patcher = patch('url.API_ROOT', self.server.url)
+        self.patcher.start()
+
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.server.stop()
+
+
+    def upload_concurrently(self, transport):
+        contents = [os.urandom(TEMP_FILE_SIZE) for _ in range(UPLOADS)]
+        errors = []
+
+        def transfer(i, content):
+            with NamedTemporaryFile(delete=False) as f:
+                f.write(content)
+            try:
+                url_obj = urlm.Url(pathlib.Path(f.name).as_uri(),
+                                   'token{}'.format(i), transport=transport)
+                url_obj.download()
+                url_obj._upload(upload_chunk_size=16 * 1024)
+                self.assertEqual(self.drive.content[url_obj.file_id],
+                                 content)
+                os.remove(url_obj.filename)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                os.remove(f.name)
+
+        threads = [threading.Thread(target=transfer, args=args)
+                   for args in enumerate(contents)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(self.drive.files), UPLOADS)
+
+
+    def test_http11(self):
+        """‘requests’ opens a connection per request."""
+
+        self.upload_concurrently(transportm.RequestsTransport())
+
+        # One session creation and four chunks per upload.
+        self.assertEqual(len(self.server.connections), UPLOADS * 5)
+        self.assertEqual({p for p, _ in self.server.connections},
+                         {'http/1.1'})
+
+
+    @unittest.skipIf(not transportm.http2_available(),
+                     'needs httpx[http2]')
+    def test_http2(self):
+        """HTTP/2 multiplexes everything over a few connections."""
+
+        transport = transportm.Http2Transport(connections=2, http1=False)
+        self.upload_concurrently(transport)
+        transport.close()
+
+        self.assertLessEqual(len(self.server.connections), 2)
+        self.assertEqual({p for p, _ in self.server.connections}, {'h2'})
+
+
+if __name__ == '__main__':
+    unittest.main()
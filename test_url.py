@@ -2,6 +2,7 @@ import unittest
 import unittest.mock
 from unittest.mock import patch
 import url as urlm
+import origins
 import itertools
 import random
 import string
@@ -11,8 +12,14 @@ import os
 import os.path
 from tempfile import NamedTemporaryFile, gettempdir
 import filecmp
+import io
 import urllib
 import requests
+import gzip
+import http.server
+import socket
+import threading
+import time
 
 
 RANDOM_STRING_LEN=64
@@ -249,6 +256,34 @@ class TestAtrr_basename(unittest.TestCase):
                         self.url_obj._basename
 
 
+class TestExpectedSize(unittest.TestCase):
+    """Size announced by the server."""
+
+    def test_expected_size(self):
+        """Content-Length when present, None otherwise or on errors."""
+
+        f_remote = random_temp_file()
+        url_obj = urlm.Url('file://' + f_remote, str())
+        self.assertEqual(url_obj.expected_size(), TEMP_FILE_SIZE)
+        os.remove(f_remote)
+
+        self.assertIsNone(url_obj.expected_size())
+        self.assertIsNone(urlm.Url(random_string(), str()).expected_size())
+
+
+    def test_silent_origin(self):
+        """An origin that does not answer is given up on quickly."""
+
+        with socket.socket() as listener:
+            listener.bind(('127.0.0.1', 0))
+            listener.listen()
+            url_obj = urlm.Url('http://127.0.0.1:{}/file'.format(
+                listener.getsockname()[1]), str())
+            started = time.monotonic()
+            self.assertIsNone(url_obj.expected_size(timeout=0.2))
+            self.assertLess(time.monotonic() - started, 5)
+
+
 class TestDownload(unittest.TestCase):
     """Correctly obtains and persists URL’s file."""
 
@@ -405,6 +440,26 @@ class Test_Upload(unittest.TestCase):
                     os.remove(uploaded.name)
 
 
+    def test_chunk_errors(self):
+        """Chunks answered other than with 200, 201 or 308 fail."""
+
+        for status in (404, 503):
+            with self.subTest(status=status):
+                answer = requests.models.Response()
+                answer.status_code = status
+                transport = unittest.mock.Mock()
+                transport.put.return_value = answer
+                url_obj = urlm.Url(random_string(), random_string(),
+                                   transport=transport)
+                url_obj._filename = random_temp_file()
+                with patch('url.Url._get_upload_url',
+                           return_value=random_string()):
+                    with self.assertRaises(RuntimeError):
+                        url_obj._upload(upload_chunk_size=1)
+                self.assertEqual(transport.put.call_count, 1)
+                os.remove(url_obj._filename)
+
+
 class TestGet_Chunk(unittest.TestCase):
     """Correctly chunk file."""
 
@@ -445,5 +500,186 @@ class TestGet_Chunk(unittest.TestCase):
         os.remove(copy.name)
 
 
+    def test_get_chunk_stream(self):
+        """Streams can be re-read from within the last chunk only."""
+
+        stream = urlm._StreamReader(io.BytesIO(bytes(range(100))))
+        self.assertEqual(urlm.get_chunk(stream, 0, 10), bytes(range(10)))
+        # The API acknowledged part of the chunk only.
+        self.assertEqual(urlm.get_chunk(stream, 5, 10), bytes(range(5, 15)))
+        # Resuming further on skips what was already sent.
+        self.assertEqual(urlm.get_chunk(stream, 90, 20),
+                         bytes(range(90, 100)))
+        with self.assertRaises(RuntimeError):
+            urlm.get_chunk(stream, 0, 10)
+
+
+class _FlakyHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the server’s DATA, hanging up after as many bytes as the
+    next of its DROPS."""
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(self.headers)
+        body, first = server.body, 0
+        header = self.headers.get('Range')
+        fresh = self.headers.get('If-Range') == server.etag
+        if header and server.ranges and fresh:
+            first = int(header[len('bytes='):].rstrip('-'))
+
+        self.send_response(206 if first else 200)
+        if server.etag is not None:
+            self.send_header('ETag', server.etag)
+        if server.encoding is not None:
+            self.send_header('Content-Encoding', server.encoding)
+        if first:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                first, len(body) - 1, len(body)))
+        self.send_header('Content-Length', str(len(body) - first))
+        self.end_headers()
+
+        drop = server.drops.pop(0) if server.drops else None
+        self.wfile.write(body[first:drop])
+        if drop is not None:
+            self.close_connection = True
+
+
+class TestResume(unittest.TestCase):
+    """Interrupted downloads go on where they stopped."""
+
+    DATA = os.urandom(256 * 1024)
+
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                      _FlakyHandler)
+        self.server.daemon_threads = True
+        self.server.body = self.DATA
+        self.server.etag = '"v1"'
+        self.server.encoding = None
+        self.server.ranges = True
+        self.server.drops = []
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.url = 'http://127.0.0.1:{}/file.bin'.format(
+            self.server.server_address[1])
+        self.patcher = patch('url.DOWNLOAD_BACKOFF', 0)
+        self.patcher.start()
+
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+    def download(self):
+        url_obj = urlm.Url(self.url, 'token')
+        filename, _ = url_obj.download()
+        with open(filename, 'rb') as f:
+            data = f.read()
+        os.remove(filename)
+        return data
+
+
+    def test_resume(self):
+        self.server.drops = [100000, 200000]
+        self.assertEqual(self.download(), self.DATA)
+
+        ranges = [(r.get('Range'), r.get('If-Range'))
+                  for r in self.server.requests]
+        self.assertEqual(ranges, [(None, None),
+                                  ('bytes=100000-', '"v1"'),
+                                  ('bytes=200000-', '"v1"')])
+
+
+    def test_ranges_ignored(self):
+        """The whole file sent again replaces what was received."""
+
+        self.server.ranges = False
+        self.server.drops = [100000]
+        self.assertEqual(self.download(), self.DATA)
+        self.assertEqual(len(self.server.requests), 2)
+
+
+    def test_changed(self):
+        """A file that changed meanwhile is fetched again in full."""
+
+        self.server.drops = [100000]
+        url_obj = urlm.Url(self.url, 'token')
+        real_urlopen = origins.urlopen
+
+        def urlopen(request, **kwargs):
+            # The file changes once the first connection dropped.
+            if self.server.requests:
+                self.server.etag = '"v2"'
+                self.server.body = self.DATA[::-1]
+            return real_urlopen(request, **kwargs)
+        with patch('origins.urlopen', urlopen):
+            filename, _ = url_obj.download()
+        with open(filename, 'rb') as f:
+            self.assertEqual(f.read(), self.DATA[::-1])
+        os.remove(filename)
+        self.assertEqual(self.server.requests[1].get('If-Range'), '"v1"')
+
+
+    def test_no_etag(self):
+        """Without a validator, nothing is asked for but the whole file."""
+
+        self.server.etag = None
+        self.server.drops = [100000]
+        self.assertEqual(self.download(), self.DATA)
+        self.assertNotIn('Range', self.server.requests[1])
+
+
+    def test_compressed(self):
+        """Ranges of a compressed body continue its decoding."""
+
+        text = b'some text that compresses\n' * 20000
+        self.server.body = gzip.compress(text)
+        self.server.encoding = 'gzip'
+        self.url = self.url.replace('file.bin', 'file.txt')
+        self.server.drops = [len(self.server.body) // 2]
+        self.assertEqual(self.download(), text)
+        self.assertEqual(len(self.server.requests), 2)
+
+
+    def test_encoding_changed(self):
+        """A range in another content coding is not appended."""
+
+        text = b'some text that compresses\n' * 20000
+        self.server.body = gzip.compress(text)
+        self.server.encoding = 'gzip'
+        self.url = self.url.replace('file.bin', 'file.txt')
+        self.server.drops = [len(self.server.body) // 2]
+        real_urlopen = origins.urlopen
+
+        def urlopen(request, **kwargs):
+            # The origin stops compressing once the connection dropped.
+            if self.server.requests:
+                self.server.body, self.server.encoding = text, None
+            return real_urlopen(request, **kwargs)
+        with patch('origins.urlopen', urlopen):
+            self.assertEqual(self.download(), text)
+
+        ranges = [r.get('Range') for r in self.server.requests]
+        self.assertEqual(ranges, [None, 'bytes={}-'.format(
+            len(gzip.compress(text)) // 2), None])
+
+
+    def test_attempts(self):
+        self.server.drops = [1000 * n for n in range(1, 10)]
+        url_obj = urlm.Url(self.url, 'token')
+        with self.assertRaises(RuntimeError):
+            url_obj.download()
+        self.assertEqual(len(self.server.requests), urlm.DOWNLOAD_ATTEMPTS)
+        self.assertIsNone(url_obj._filename)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+"""Tracing of transfers, as spans with parent/child relations.
+
+A span times one operation (a request to the app, a download, a chunk
+PUT...) and carries attributes such as bytes, status, offset and
+attempt.  Spans opened while another one is current become its
+children, within the same trace; the trace of a request to the app
+continues the one named by its ‘traceparent’ (W3C) or
+‘X-Cloud-Trace-Context’ header, if any.
+
+Whether a trace is recorded is decided once, at its root: by the
+caller’s sampled flag, or else with probability SAMPLE.  Spans of
+unsampled traces cost next to nothing.  Finished spans go to an
+exporter: a JSON-lines file or an OTLP/HTTP collector (JSON encoding),
+e.g. configured with ‘configure(exporter_from_url(...), sample)’.
+
+Work handed over to other threads keeps its trace if wrapped with
+‘bind’."""
+
+import contextlib
+import contextvars
+import functools
+import json
+import logging as log
+import os
+import queue
+import random
+import re
+import threading
+import time
+
+import requests
+
+
+# Seconds and spans between two batches sent to an OTLP collector.
+OTLP_INTERVAL = 2.0
+OTLP_BATCH = 512
+
+SERVICE_NAME = 'driveet'
+
+_current = contextvars.ContextVar('span', default=None)
+
+
+class Span:
+    """A recorded operation."""
+
+    recording = True
+
+    def __init__(self, name, trace_id, parent_id=None, attributes=None,
+                 tracer=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = '{:016x}'.format(random.getrandbits(64))
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.status = 'ok'
+        self.error = None
+        self.start = time.time_ns()
+        self.end_time = None
+        self._tracer = tracer
+
+
+    def set(self, key, value):
+        """Set the attribute KEY to VALUE."""
+
+        self.attributes[key] = value
+
+
+    def fail(self, message):
+        """Mark the operation as failed with MESSAGE."""
+
+        self.status = 'error'
+        self.error = message
+
+
+    def end(self):
+        """Finish the span and hand it to the exporter."""
+
+        if self.end_time is not None:
+            return
+        self.end_time = time.time_ns()
+        if self._tracer is not None:
+            self._tracer.export(self)
+
+
+    def record(self):
+        """Return the span as a JSON-serializable dictionary."""
+
+        return {'trace_id': self.trace_id,
+                'span_id': self.span_id,
+                'parent_id': self.parent_id,
+                'name': self.name,
+                'start': self.start,
+                'end': self.end_time,
+                'duration_ms': (self.end_time - self.start) / 1e6,
+                'attributes': self.attributes,
+                'status': self.status,
+                'error': self.error}
+
+
+class _Unsampled:
+    """Stands for the spans of an unsampled trace."""
+
+    recording = False
+    trace_id = None
+    span_id = None
+
+    def set(self, key, value):
+        pass
+
+
+    def fail(self, message):
+        pass
+
+
+    def end(self):
+        pass
+
+
+UNSAMPLED = _Unsampled()
+
+
+class Tracer:
+    """Creates spans and hands the finished ones to an exporter."""
+
+    def __init__(self, exporter=None, sample=1.0):
+        self.exporter = exporter
+        self.sample = sample
+
+
+    def start(self, name, parent=None, remote=None, **attributes):
+        """Start and return a span named NAME.
+
+        PARENT is the span it belongs to, by default the current one.
+        REMOTE is a (trace id, span id, sampled) of a caller in another
+        process, for a span with no local parent."""
+
+        parent = parent if parent is not None else _current.get()
+        if parent is not None:
+            if not parent.recording:
+                return UNSAMPLED
+            return Span(name, parent.trace_id, parent.span_id, attributes,
+                        self)
+
+        if self.exporter is None:
+            return UNSAMPLED
+
+        trace_id, parent_id, sampled = remote or (None, None, None)
+        if sampled is None:
+            sampled = random.random() < self.sample
+        if not sampled:
+            return UNSAMPLED
+        return Span(name, trace_id or '{:032x}'.format(random.getrandbits(128)),
+                    parent_id, attributes, self)
+
+
+    def export(self, span):
+        try:
+            self.exporter.export(span.record())
+        except Exception:
+            log.exception('Could not export span {}'.format(span.name))
+
+
+tracer = Tracer()
+
+
+def configure(exporter, sample=1.0):
+    """Send the sampled spans to EXPORTER, sampling traces with SAMPLE."""
+
+    tracer.exporter = exporter
+    tracer.sample = sample
+
+
+def current():
+    """Return the current span, or None."""
+
+    return _current.get()
+
+
+def activate(span):
+    """Make SPAN the current one.  Return the token to ‘deactivate’ it."""
+
+    return _current.set(span)
+
+
+def deactivate(token):
+    _current.reset(token)
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """Run the body of the ‘with’ in a child span of the current one.
+
+    An exception escaping the body marks the span as failed."""
+
+    current_span = tracer.start(name, **attributes)
+    token = _current.set(current_span)
+    try:
+        yield current_span
+    except BaseException as e:
+        current_span.fail('{}: {}'.format(type(e).__name__, e))
+        raise
+    finally:
+        _current.reset(token)
+        current_span.end()
+
+
+def traced(name):
+    """Decorate a function so that each call runs in a span named NAME.
+
+    The function can reach its span through ‘current’."""
+
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def bind(function):
+    """Return FUNCTION, to be run in the trace that is current now."""
+
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(function, *args, **kwargs)
+
+
+def parse_headers(headers):
+    """Return the (trace id, span id, sampled) in HEADERS, or None.
+
+    SAMPLED is None when the caller did not decide."""
+
+    traceparent = headers.get('traceparent', '')
+    match = re.fullmatch(r'[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})'
+                         r'-([0-9a-f]{2})', traceparent.strip())
+    if match and set(match.group(1)) != {'0'}:
+        return (match.group(1), match.group(2),
+                bool(int(match.group(3), 16) & 1))
+
+    # TRACE_ID/SPAN_ID;o=OPTIONS, the span id being decimal.
+    cloud = headers.get('X-Cloud-Trace-Context', '')
+    match = re.fullmatch(r'([0-9a-fA-F]{32})(?:/(\d+))?(?:;o=([01]))?',
+                         cloud.strip())
+    if match:
+        span_id = '{:016x}'.format(int(match.group(2)) % 2 ** 64) \
+            if match.group(2) else None
+        sampled = None if match.group(3) is None else match.group(3) == '1'
+        return match.group(1).lower(), span_id, sampled
+
+    return None
+
+
+class JsonLinesExporter:
+    """Appends every span to a file, one JSON object per line."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+
+    def export(self, record):
+        line = json.dumps(record) + '\n'
+        with self._lock, open(self.path, 'a') as f:
+            f.write(line)
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def otlp_span(record):
+    """Return RECORD (see ‘Span.record’) in the OTLP JSON encoding."""
+
+    otlp = {'traceId': record['trace_id'],
+            'spanId': record['span_id'],
+            'name': record['name'],
+            'kind': 1,
+            'startTimeUnixNano': str(record['start']),
+            'endTimeUnixNano': str(record['end']),
+            'attributes': [{'key': key, 'value': _otlp_value(value)}
+                           for key, value in record['attributes'].items()
+                           if value is not None],
+            'status': {'code': 2 if record['status'] == 'error' else 1}}
+    if record['parent_id']:
+        otlp['parentSpanId'] = record['parent_id']
+    if record['error']:
+        otlp['status']['message'] = record['error']
+    return otlp
+
+
+class OTLPExporter:
+    """Sends spans to an OTLP/HTTP collector, in batches.
+
+    ENDPOINT is the root URL of the collector, e.g.
+    ‘http://localhost:4318’."""
+
+    def __init__(self, endpoint, interval=OTLP_INTERVAL, batch=OTLP_BATCH):
+        self.url = endpoint.rstrip('/') + '/v1/traces'
+        self.interval = interval
+        self.batch = batch
+        self._queue = queue.Queue()
+        self._pending = 0
+        self._flushed = threading.Condition()
+        threading.Thread(target=self._run, daemon=True).start()
+
+
+    def export(self, record):
+        with self._flushed:
+            self._pending += 1
+        self._queue.put(record)
+
+
+    def _take(self):
+        records = []
+        deadline = time.monotonic() + self.interval
+        while len(records) < self.batch:
+            try:
+                records.append(self._queue.get(
+                    timeout=max(0.0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        return records
+
+
+    def _run(self):
+        while True:
+            records = self._take()
+            if records:
+                self.send(records)
+                with self._flushed:
+                    self._pending -= len(records)
+                    self._flushed.notify_all()
+
+
+    def send(self, records):
+        body = {'resourceSpans': [{
+            'resource': {'attributes': [
+                {'key': 'service.name',
+                 'value': {'stringValue': SERVICE_NAME}}]},
+            'scopeSpans': [{'scope': {'name': SERVICE_NAME},
+                            'spans': [otlp_span(r) for r in records]}]}]}
+        try:
+            response = requests.post(self.url, json=body, timeout=10)
+            if response.status_code >= 400:
+                log.error('Collector refused {} spans: {}'.format(
+                    len(records), response.status_code))
+        except requests.RequestException as e:
+            log.error('Could not send spans: {}'.format(e))
+
+
+    def flush(self, timeout=None):
+        """Wait until the spans exported so far are sent."""
+
+        with self._flushed:
+            return self._flushed.wait_for(lambda: not self._pending,
+                                          timeout)
+
+
+def exporter_from_url(url):
+    """Return the exporter for URL: an OTLP collector’s ‘http(s)://’
+    root, or the path of a JSON-lines file."""
+
+    if url.startswith(('http://', 'https://')):
+        return OTLPExporter(url)
+    return JsonLinesExporter(os.path.expanduser(url))
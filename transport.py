@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""HTTP transports for Drive API traffic.
+
+‘url.Url’ sends its session-creation POSTs and chunk PUTs through a
+transport.  The default one uses ‘requests’ (HTTP/1.1, one connection
+per request).  ‘Http2Transport’ uses ‘httpx’ with HTTP/2, so many
+upload sessions share a few multiplexed connections; it needs the
+optional ‘httpx[http2]’ package and is enabled with DRIVEET_HTTP2=1."""
+
+import importlib.util
+import os
+import threading
+
+import requests
+
+
+# Whether the default transport should be HTTP/2.
+HTTP2 = os.environ.get('DRIVEET_HTTP2') == '1'
+
+# Connections to the API kept by the HTTP/2 transport.
+HTTP2_CONNECTIONS = int(os.environ.get('DRIVEET_HTTP2_CONNECTIONS', 2))
+
+# Network errors any transport may raise.  ‘httpx’ errors are added
+# when it is first imported; it is slow to import, so that only
+# happens if an HTTP/2 transport is created.
+ERRORS = (requests.exceptions.RequestException,)
+
+
+def http2_available():
+    """Tell whether the optional HTTP/2 dependencies are installed."""
+
+    return all(importlib.util.find_spec(name) is not None
+               for name in ('httpx', 'h2'))
+
+
+class RequestsTransport:
+    """HTTP/1.1 through ‘requests’."""
+
+    name = 'http/1.1'
+
+    def get(self, url, **kwargs):
+        return requests.get(url, **kwargs)
+
+
+    def post(self, url, **kwargs):
+        return requests.post(url, **kwargs)
+
+
+    def put(self, url, **kwargs):
+        return requests.put(url, **kwargs)
+
+
+    def delete(self, url, **kwargs):
+        return requests.delete(url, **kwargs)
+
+
+class Http2Transport:
+    """HTTP/2 through a shared ‘httpx.Client’.
+
+    The client is safe to use from many threads; concurrent requests
+    become streams of the same connections."""
+
+    name = 'h2'
+
+    def __init__(self, connections=HTTP2_CONNECTIONS, verify=True,
+                 http1=True):
+        """Keep at most CONNECTIONS connections per host.
+
+        VERIFY is passed on to ‘httpx’ (e.g. a CA bundle path).  With
+        HTTP1 false, plain-text URLs are spoken HTTP/2 with prior
+        knowledge, as needed for local stand-in servers."""
+
+        global ERRORS
+
+        if not http2_available():
+            raise RuntimeError('HTTP/2 transport needs httpx[http2]')
+
+        import httpx
+        if httpx.HTTPError not in ERRORS:
+            ERRORS += (httpx.HTTPError,)
+
+        self.client = httpx.Client(
+            http1=http1, http2=True, verify=verify,
+            limits=httpx.Limits(max_connections=connections,
+                                max_keepalive_connections=connections))
+
+
+    def _send(self, method, url, data=None, timeout=None, **kwargs):
+        # ‘requests’ takes raw bodies as ‘data’; ‘httpx’ as ‘content’.
+        if data is not None:
+            kwargs['content'] = data
+        return self.client.request(method, url, timeout=timeout, **kwargs)
+
+
+    def get(self, url, **kwargs):
+        return self._send('GET', url, **kwargs)
+
+
+    def post(self, url, **kwargs):
+        return self._send('POST', url, **kwargs)
+
+
+    def put(self, url, **kwargs):
+        return self._send('PUT', url, **kwargs)
+
+
+    def delete(self, url, **kwargs):
+        return self._send('DELETE', url, **kwargs)
+
+
+    def close(self):
+        self.client.close()
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def default():
+    """Return the transport shared by the whole process."""
+
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = Http2Transport() if HTTP2 else RequestsTransport()
+
+    return _default
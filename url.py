@@ -5,11 +5,19 @@ import urllib.parse
 import urllib.error
 import os
 import tempfile
-import shutil
 import logging as log
 import sys
-import requests
 import json
+import re
+import time
+import http.client
+
+import ratelimit
+import cancellation
+import codings
+import origins
+import tracing
+import transport as transportm
 
 
 error_msg = 'Error: {}'
@@ -19,6 +27,28 @@ error_msg = 'Error: {}'
 # https://developers.google.com/drive/api/v3/manage-uploads#uploading
 UPLOAD_CHUNK_SIZE = 2 * 256 * 1024
 
+# Root of the Google APIs.  It can be pointed somewhere else, e.g. a
+# local stand-in server, through the environment.
+API_ROOT = os.environ.get('DRIVEET_API_ROOT', 'https://www.googleapis.com')
+
+# Size of the blocks read from the source while downloading.
+COPY_BUFSIZE = 64 * 1024
+
+# Seconds allowed for cancelling an upload session.
+CANCEL_TIMEOUT = 10
+
+# Seconds allowed for a call on the metadata of a file.
+API_TIMEOUT = 30
+
+# Seconds the origin has to answer the HEAD request of ‘expected_size’.
+PROBE_TIMEOUT = 5
+
+# Connections to the origin a download may use: when one drops, the
+# download goes on over another one, after a pause of DOWNLOAD_BACKOFF
+# seconds, doubled every time.
+DOWNLOAD_ATTEMPTS = 5
+DOWNLOAD_BACKOFF = 0.5
+
 
 def get_chunk(f, first_byte, chunk_size=UPLOAD_CHUNK_SIZE):
     """Return contiguous bytes from a file."""
@@ -40,8 +70,132 @@ def _get_upload_headers(first_byte, file_size, chunk_size):
     return {'Content-Range': content_range}
 
 
+def _content_length(response):
+    """Return the Content-Length of RESPONSE as an integer, or None."""
+
+    try:
+        return int(response.headers['Content-Length'])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+class _StreamReader:
+    """Seekable view of a stream, as ‘get_chunk’ expects.
+
+    Only the last chunk read is kept, so that the API can ask for part
+    of it again; seeking further back raises RuntimeError."""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._start = 0
+        self._buffer = b''
+        self._position = 0
+
+
+    def seek(self, position):
+        if position < self._start:
+            raise RuntimeError('Cannot go back to byte {} of the stream'
+                               .format(position))
+        self._position = position
+
+
+    def read(self, size):
+        end = self._start + len(self._buffer)
+        while end < self._position:
+            # Skip what the API already has, e.g. when resuming.
+            skipped = self._stream.read(min(self._position - end,
+                                            COPY_BUFSIZE))
+            if not skipped:
+                break
+            end += len(skipped)
+
+        offset = self._position - self._start
+        data = bytearray(self._buffer[offset:offset + size]
+                         if 0 <= offset < len(self._buffer) else b'')
+        while len(data) < size:
+            block = self._stream.read(size - len(data))
+            if not block:
+                break
+            data += block
+
+        self._start, self._buffer = self._position, bytes(data)
+        self._position += len(data)
+        return self._buffer
+
+
+    def close(self):
+        pass
+
+
+def _validator(response):
+    """Return the strong ETag of RESPONSE, or None.
+
+    Weak ETags cannot be used in ‘If-Range’."""
+
+    etag = response.headers.get('ETag')
+    if not isinstance(etag, str) or etag.startswith('W/'):
+        return None
+
+    return etag
+
+
+def _resumes(response, offset, encoding):
+    """Tell whether RESPONSE is the rest of a body from byte OFFSET on,
+    with the Content-Encoding ENCODING."""
+
+    if getattr(response, 'status', None) != 206 \
+       or response.headers.get('Content-Encoding') != encoding:
+        return False
+
+    match = re.match(r'bytes (\d+)-',
+                     response.headers.get('Content-Range', ''))
+    return match is not None and int(match.group(1)) == offset
+
+
+def _whole(response):
+    """Tell whether RESPONSE has the body from its first byte on."""
+
+    if getattr(response, 'status', None) != 206:
+        return True
+    return re.match(r'bytes 0-',
+                    response.headers.get('Content-Range', '')) is not None
+
+
+def _trace_dns(url):
+    """Resolve the host of URL within a span, to time the lookup.
+
+    The answer is cached (see ‘origins’), so the download does not
+    look the host up again."""
+
+    parts = urllib.parse.urlsplit(url)
+    if not parts.hostname:
+        return
+
+    with tracing.span('dns', host=parts.hostname) as span:
+        try:
+            port = parts.port or (443 if parts.scheme == 'https' else 80)
+            span.set('addresses',
+                     len(origins.pool.dns.resolve(parts.hostname, port)))
+        except (OSError, ValueError) as e:
+            span.fail(str(e))
+
+
 def get_last_uploaded_byte(request):
-    """Return last uploade byte.."""
+    """Return last uploade byte..
+
+    Only a 308 answer tells it; the API omits its ‘Range’ header when
+    nothing has been received yet, in which case -1 is returned.  Any
+    other answer raises RuntimeError."""
+
+    status = getattr(request, 'status_code')
+    if status != 308:
+        msg = 'Problems uploading chunk: {} {}'.format(
+            status, getattr(request, 'text', ''))
+        log.error(msg)
+        raise RuntimeError(msg)
+
+    if 'Range' not in request.headers:
+        return -1
 
     return int(request.headers['Range'].split('-')[-1])
 
@@ -53,17 +207,53 @@ class Url:
     __urlpath = None
     __basename = None
     _filename = None
+    file_id = None
+    reused = False
+
+
+    def __init__(self, url, token, dedup=None, progress=None, cancel=None,
+                 transport=None, upload_url=None, on_upload_url=None,
+                 name=None, parents=None):
+        """Use URL and TOKEN for the new instantiated object.
+
+        DEDUP, if given, is a ‘dedup.DedupIndex’ used to skip the upload
+        when the same content is already in the user’s Drive.
+
+        PROGRESS, if given, is a ‘progress.Progress’ that is kept up to
+        date with the bytes transferred.
+
+        CANCEL, if given, is a ‘cancellation.CancelToken’ that can stop
+        the transfer.
+
+        TRANSPORT is how the API is spoken to (see ‘transport’); the
+        process-wide default is used if not given.
 
+        UPLOAD_URL is a resumable upload session to continue, e.g. one
+        started by another worker.  ON_UPLOAD_URL, if given, is called
+        with the URL of every session this object starts.
 
-    def __init__(self, url, token):
-        """Use URL and TOKEN for the new instantiated object."""
+        NAME is the name of the file in Drive, by default the one in
+        the URL.  PARENTS is a list of the ids of the Drive folders to
+        put it in (the root folder if not given)."""
 
-        for param, name in ((url, 'URL'), (token, 'Token')):
+        for param in (url, token):
             if type(param) is not str:
                 raise TypeError('{} must be a string'.format(param))
 
         self.url = url
         self.token = token
+        self.dedup = dedup
+        self.progress = progress
+        self.cancel = cancel
+        self.transport = transport if transport is not None \
+            else transportm.default()
+        self.upload_url = upload_url
+        self.on_upload_url = on_upload_url
+        self.parents = parents
+        # The response being read, for ‘_hang_up’.
+        self._live = None
+        if name is not None:
+            self.__basename = name
 
 
     @property
@@ -153,40 +343,261 @@ class Url:
         return self._filename
 
 
+    def expected_size(self, timeout=PROBE_TIMEOUT):
+        """Return the size announced by the server for URL, or None.
+
+        Uses a HEAD request, so nothing is downloaded.  Any problem,
+        including no answer within TIMEOUT seconds, is reported as an
+        unknown size."""
+
+        try:
+            request = urllib.request.Request(self.url, method='HEAD')
+            with origins.urlopen(request, timeout=timeout) as response:
+                length = response.headers.get('Content-Length')
+            return int(length) if length is not None else None
+        except Exception:
+            return None
+
+
+    def _enter_phase(self, phase):
+        """Start PHASE of the transfer, unless it must stop."""
+
+        if self.cancel is not None:
+            self.cancel.enter_phase(phase)
+            self.cancel.check()
+
+
+    def _check(self):
+        """Raise ‘cancellation.Cancelled’ if the transfer must stop."""
+
+        if self.cancel is not None:
+            self.cancel.check()
+
+
+    def _timeout(self):
+        """Seconds that network operations may block for, or None."""
+
+        return None if self.cancel is None else self.cancel.remaining()
+
+
+    def _stop_if_cancelled(self):
+        """Clean up and raise ‘cancellation.Cancelled’ if stopping.
+
+        Meant for error handlers: a socket timing out at a deadline
+        surfaces as an ordinary network error."""
+
+        if self.cancel is not None and self.cancel.cancelled:
+            self._discard()
+            self.cancel.check()
+
+
+    def _discard(self):
+        """Remove the local copy of the file, if there is one."""
+
+        if self._filename is not None:
+            try:
+                os.remove(self._filename)
+            except OSError:
+                pass
+            self._filename = None
+
+
+    @tracing.traced('download')
     def download(self):
         """Fetch file from URL and persist it locally as a temporary file.
 
         Returns the temporary filename and the original filename on the
-        server.
+        server.  The server may send the file compressed (see
+        ‘codings’); what is stored is the file as it is on the server.
 
         Raises RuntimeError if the URL is malformed or if there were
-        problems accessing it."""
-
+        problems accessing it, and ‘cancellation.Cancelled’ if the
+        transfer was cancelled, in which case nothing is left behind."""
+
+        span = tracing.current()
+        span.set('url', self.url)
+        # Reads from a stalled origin would not see the cancellation.
+        forget = lambda: None
+        if self.cancel is not None:
+            forget = self.cancel.on_cancel(self._hang_up)
         try:
-            with urllib.request.urlopen(self.url) as response:
-                with tempfile.NamedTemporaryFile(delete=False) as temp_f:
-                    shutil.copyfileobj(response, temp_f)
-                    self._filename = temp_f.name
-
-                # Set property in the appropriate context, while we
-                # still have access to the data.
-                self._responseurl = response.url
+            self._enter_phase('download')
+            if span.recording:
+                _trace_dns(self.url)
+
+            with tempfile.NamedTemporaryFile(delete=False) as temp_f:
+                self._filename = temp_f.name
+                self._fetch(temp_f, span)
+        except cancellation.Cancelled:
+            self._discard()
+            raise
+        except RuntimeError as e:
+            # The body could not be decoded, or the download was
+            # interrupted too often: what was stored is useless.
+            self._discard()
+            log.error(str(e))
+            raise
         except ValueError as e:
             msg = 'Malformed or invalid URL'
             log.error(msg)
             raise RuntimeError(msg) from e
         except urllib.error.URLError as e:
+            self._stop_if_cancelled()
             msg = 'Problems accessing URL: {}'.format(str(e))
             log.error(msg)
             raise RuntimeError(msg) from e
         except:
+            self._stop_if_cancelled()
             msg = 'Unexpected error: {}'.format(sys.exc_info()[0])
             log.error(msg)
             raise
         else:
             return self.filename, self._basename
+        finally:
+            forget()
+
 
+    def _hang_up(self):
+        """Interrupt the download if it is waiting for the origin."""
+
+        response = self._live
+        if response is None:
+            return
+        try:
+            getattr(response, 'abort', response.close)()
+        except Exception:
+            pass
+
+
+    def _fetch(self, temp_f, span):
+        """Copy the file at URL into TEMP_F, decoding it if need be.
+
+        When the connection to the origin drops, the copy goes on from
+        the last byte received over a new connection (‘Range’), if the
+        server can tell that the file did not change meanwhile
+        (‘If-Range’ with its ETag); when the server sends the whole
+        file instead, the copy starts over.  Any other part of the file,
+        e.g. in another content coding, is of no use: the whole file is
+        asked for again.  Up to DOWNLOAD_ATTEMPTS connections are used.
+        SPAN is the span of the download."""
+
+        accept_encoding = codings.accept_encoding(self.url)
+        resumable = urllib.parse.urlsplit(self.url).scheme \
+            in ('http', 'https')
+        # Bytes of the body received, and bytes of the file written.
+        received = written = 0
+        decoder = encoding = validator = total = None
+        restarts = resumes = 0
+        for attempt in range(DOWNLOAD_ATTEMPTS):
+            headers = {}
+            if accept_encoding is not None:
+                headers['Accept-Encoding'] = accept_encoding
+            if received and validator is not None:
+                headers['Range'] = 'bytes={}-'.format(received)
+                headers['If-Range'] = validator
+
+            kwargs = {}
+            if self._timeout() is not None:
+                kwargs['timeout'] = self._timeout()
+
+            request = self.url
+            if headers:
+                request = urllib.request.Request(self.url, headers=headers)
 
+            try:
+                with origins.urlopen(request, cancel=self.cancel,
+                                     **kwargs) as response:
+                    self._live = response
+                    if 'Range' in headers \
+                       and _resumes(response, received, encoding):
+                        resumes += 1
+                    elif not _whole(response):
+                        if attempt == DOWNLOAD_ATTEMPTS - 1:
+                            raise RuntimeError(
+                                'Download of {} answered with parts that '
+                                'do not fit'.format(self.url))
+                        # Without a validator, no range is asked for.
+                        validator = None
+                        continue
+                    else:
+                        # The first connection, or the whole file again.
+                        if received:
+                            restarts += 1
+                            temp_f.seek(0)
+                            temp_f.truncate()
+                        received = written = 0
+                        span.set('status', getattr(response, 'status', None))
+                        # Only what was asked for is decoded: some
+                        # servers label compressed files with their
+                        # compression.
+                        decoder = None if accept_encoding is None \
+                            else codings.decoder(response)
+                        if resumable:
+                            encoding = response.headers.get(
+                                'Content-Encoding')
+                            validator = _validator(response)
+                        total = _content_length(response)
+                        if self.progress is not None:
+                            # Progress is counted in bytes received.
+                            self.progress.start('download', total)
+
+                        # Set property in the appropriate context, while
+                        # we still have access to the data.
+                        self._responseurl = response.url
+
+                    while True:
+                        self._check()
+                        block = response.read(COPY_BUFSIZE)
+                        if not block:
+                            break
+                        received += len(block)
+                        pieces = (block,) if decoder is None \
+                            else decoder.decode(block)
+                        for piece in pieces:
+                            temp_f.write(piece)
+                            written += len(piece)
+                        if self.progress is not None:
+                            self.progress.update(received)
+                    # A response cut off by ‘_hang_up’ ends early.
+                    self._check()
+                self._live = None
+
+                # A connection closed early looks like the end of the
+                # body, but for its length.
+                if total is not None and received < total:
+                    raise http.client.IncompleteRead(b'', total - received)
+            except (OSError, http.client.HTTPException) as e:
+                self._live = None
+                self._stop_if_cancelled()
+                # Failing to connect at all is not an interruption.
+                if not (resumable and received):
+                    raise
+                if attempt == DOWNLOAD_ATTEMPTS - 1:
+                    raise RuntimeError(
+                        'Download interrupted at byte {} after {} attempts: '
+                        '{}'.format(received, DOWNLOAD_ATTEMPTS, e)) from e
+
+                delay = DOWNLOAD_BACKOFF * 2 ** attempt
+                if self._timeout() is not None:
+                    delay = min(delay, self._timeout())
+                time.sleep(delay)
+                self._check()
+                continue
+
+            if decoder is not None:
+                decoder.finish()
+            break
+
+        span.set('bytes', written)
+        if decoder is not None:
+            span.set('encoding', ', '.join(decoder.codings))
+            span.set('wire_bytes', received)
+        if resumes or restarts:
+            span.set('resumes', resumes)
+            span.set('restarts', restarts)
+
+
+    @tracing.traced('create_session')
     def _get_upload_url(self):
         """Fetch POST address from API."""
 
@@ -198,15 +609,21 @@ class Url:
         headers = {'Authorization': 'Bearer ' + self.token,
                              'Content-Type': 'application/json'}
         params = {'name': self._basename}
+        if self.parents:
+            params['parents'] = list(self.parents)
 
         # Send the initial request, obtaining:
         # status code: “200 OK” when it succeeds
         # location: when it succeeds, this is the URL to be used for the upload.
-        request = requests.post(
-            'https://www.googleapis.com/upload/drive/v3/files?uploadType=resumable',
+        request = ratelimit.send(
+            self.transport.post,
+            API_ROOT + '/upload/drive/v3/files?uploadType=resumable',
+            self.token,
             headers=headers,
-            data=json.dumps(params))
+            data=json.dumps(params),
+            timeout=self._timeout(), cancel=self.cancel)
 
+        tracing.current().set('status', getattr(request, 'status_code'))
         if getattr(request, 'status_code') == 200:
             upload_url = request.headers['Location']
         else:
@@ -216,40 +633,137 @@ class Url:
         return upload_url
 
 
-    def _upload(self, upload_chunk_size=UPLOAD_CHUNK_SIZE):
-        """Upload the file to Google Drive using the OAuth token."""
+    def _cancel_session(self, upload_url):
+        """Tell the API to drop the resumable session at UPLOAD_URL."""
 
         try:
-            upload_url = self._get_upload_url()
+            self.transport.delete(upload_url, timeout=CANCEL_TIMEOUT)
+        except transportm.ERRORS as e:
+            log.error('Could not cancel upload session: {}'.format(e))
 
-            # It will be done multiple HTTP requests.
-            f = open(self.filename, 'rb')
+
+    @tracing.traced('resume')
+    def _resume(self, upload_url, file_size):
+        """Ask the API how much of FILE_SIZE bytes UPLOAD_URL has.
+
+        Returns the first byte still to be sent, or None if the session
+        is no longer valid."""
+
+        request = ratelimit.send(
+            self.transport.put, upload_url, self.token,
+            headers={'Content-Range': 'bytes */{}'.format(file_size)},
+            timeout=self._timeout(), cancel=self.cancel)
+        status = getattr(request, 'status_code')
+        tracing.current().set('status', status)
+
+        if status in (200, 201):
+            # Everything was already received.
+            try:
+                self.file_id = request.json().get('id')
+            except ValueError:
+                pass
+            return file_size
+        if status == 308:
+            return get_last_uploaded_byte(request) + 1
+
+        return None
+
+
+    @tracing.traced('upload')
+    def _upload(self, upload_chunk_size=UPLOAD_CHUNK_SIZE, stream=None,
+                size=None):
+        """Upload the file to Google Drive using the OAuth token.
+
+        STREAM, if given, is read for the SIZE bytes to upload instead
+        of the downloaded file.  It is read once, from start to end, and
+        no more than a chunk of it is kept in memory.
+
+        Raises ‘cancellation.Cancelled’ if the transfer was cancelled,
+        in which case the upload session and the local file are
+        discarded."""
+
+        upload_url = None
+        try:
+            self._enter_phase('upload')
+            file_size = os.path.getsize(self.filename) if stream is None \
+                else size
+            tracing.current().set('bytes', file_size)
+
+            # Continue the given session if it is still alive, or
+            # start a new one.
             first_byte = 0
-            file_size = os.path.getsize(self.filename)
+            if self.upload_url is not None:
+                first_byte = self._resume(self.upload_url, file_size)
+                if first_byte is not None:
+                    upload_url = self.upload_url
+            if upload_url is None:
+                first_byte = 0
+                upload_url = self._get_upload_url()
+                if self.on_upload_url is not None:
+                    self.on_upload_url(upload_url)
+                if file_size == 0:
+                    # There are no bytes to send: asking for the status
+                    # is what completes an empty upload.
+                    first_byte = self._resume(upload_url, 0) or 0
+
+            # It will be done multiple HTTP requests.
+            f = open(self.filename, 'rb') if stream is None \
+                else _StreamReader(stream)
+            if self.progress is not None:
+                self.progress.start('upload', file_size)
+                self.progress.update(first_byte)
             while first_byte < file_size:
+                self._check()
                 chunk = get_chunk(f, first_byte, upload_chunk_size)
+                if not chunk:
+                    msg = 'Source ended at byte {} of {}'.format(first_byte,
+                                                                 file_size)
+                    log.error(msg)
+                    raise RuntimeError(msg)
 
                 # Prepare the headers for the upload request.
                 headers = _get_upload_headers(first_byte, file_size,
                                               len(chunk))
 
-                # Send the data chunk upload request.
-                request = requests.put(upload_url,
-                                       headers=headers,
-                                       data=chunk)
+                # Send the data chunk upload request.  It waits for a
+                # free slot if too many requests are in flight, and it
+                # is retried if the API asks us to slow down.
+                with tracing.span('chunk', offset=first_byte,
+                                  bytes=len(chunk)) as span:
+                    request = ratelimit.send(self.transport.put, upload_url,
+                                             self.token,
+                                             headers=headers,
+                                             data=chunk,
+                                             timeout=self._timeout(), cancel=self.cancel)
+                    span.set('status', getattr(request, 'status_code'))
 
                 # A response with status code of 200 or 201 indicates
-                # that the upload is complete.
+                # that the upload is complete.  Its body is the
+                # resource of the newly created file.
                 if getattr(request, 'status_code') in (200, 201):
+                    try:
+                        self.file_id = request.json().get('id')
+                    except ValueError:
+                        pass
+                    if self.progress is not None:
+                        self.progress.update(file_size)
                     break
 
                 # The response will contain the last successfully
                 # uploaded byte.  It may or may not differ from the
                 # last byte of the chunk we just tried to upload.
                 first_byte = get_last_uploaded_byte(request) + 1
+                if self.progress is not None:
+                    self.progress.update(first_byte)
+        except cancellation.Cancelled:
+            self._abort_upload(upload_url)
+            raise
         except RuntimeError:
             raise
         except:
+            if self.cancel is not None and self.cancel.cancelled:
+                self._abort_upload(upload_url)
+                self.cancel.check()
             raise
         finally:
             try:
@@ -258,12 +772,57 @@ class Url:
                 pass
 
 
+    def upload_stream(self, stream, size):
+        """Upload SIZE bytes read from STREAM to Google Drive.
+
+        Nothing is written to disk: the bytes go straight from STREAM,
+        a file-like object, into the upload session.  Returns the id of
+        the new file.
+
+        Raises RuntimeError if STREAM ends early or the upload fails,
+        and ‘cancellation.Cancelled’ if the transfer was cancelled."""
+
+        self._upload(stream=stream, size=size)
+        if self.file_id is None:
+            msg = 'Upload of {} did not complete'.format(self._basename)
+            log.error(msg)
+            raise RuntimeError(msg)
+
+        return self.file_id
+
+
+    def _abort_upload(self, upload_url):
+        """Release what a cancelled upload to UPLOAD_URL holds."""
+
+        # An abandoned transfer is being taken over by someone else,
+        # who still needs the session.
+        abandoned = self.cancel is not None and self.cancel.abandoned
+        if upload_url is not None and not abandoned:
+            self._cancel_session(upload_url)
+        self._discard()
+
+
+    @tracing.traced('drive_it')
     def drive_it(self):
         """Save the file from URL to Google Drive."""
 
+        span = tracing.current()
+        span.set('url', self.url)
         try:
             self.download()
-            self._upload()
+
+            fingerprint = None
+            if self.dedup is not None:
+                fingerprint = self.dedup.fingerprint(self.filename)
+                self.file_id = self.dedup.find(fingerprint, self.token,
+                                               self.transport, self.cancel)
+                self.reused = self.file_id is not None
+                span.set('reused', self.reused)
+
+            if not self.reused:
+                self._upload()
+                if fingerprint is not None and self.file_id is not None:
+                    self.dedup.add(fingerprint, self.file_id)
 
             return self.filename, self._basename
         except RuntimeError as e:
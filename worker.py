@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""Workers running the transfers queued in a shared ‘store’.
+
+Each worker claims a job, runs it through ‘url.Url’ and keeps renewing
+its lease with heartbeats, which also carry the progress.  Requests to
+cancel the job are looked for more often, every CANCEL_POLL seconds.  If the lease is lost (e.g. this instance was
+paused for too long and another one took over) the transfer is
+abandoned, leaving the upload session to the new owner.
+
+Jobs often run long after they were queued, or again once a lease
+expired, when the access token they were queued with has expired: it
+is refreshed first, and the new one saved for the next jobs."""
+
+import datetime
+import logging as log
+import os
+import socket
+import threading
+import time
+import uuid
+
+import url as urlm
+import dedup as dedupm
+import progress as progressm
+import cancellation
+import store as storem
+
+
+# Seconds between two looks at an empty queue.
+POLL = 1.0
+
+# Seconds between two looks at whether a running job was asked to stop,
+# more often than its lease is renewed.
+CANCEL_POLL = 1.0
+
+
+def credentials_to_dict(credentials):
+    """Return ‘google.oauth2.credentials.Credentials’ as a dictionary,
+    to be kept in the session or a store."""
+
+    return {'token': credentials.token,
+            'refresh_token': credentials.refresh_token,
+            'token_uri': credentials.token_uri,
+            'client_id': credentials.client_id,
+            'client_secret': credentials.client_secret,
+            'scopes': credentials.scopes,
+            'expiry': credentials.expiry.isoformat()
+            if credentials.expiry is not None else None}
+
+
+def credentials_from_dict(data):
+    """Return the credentials DATA was made from by
+    ‘credentials_to_dict’."""
+
+    # The google.auth stack is slow to import.
+    import google.oauth2.credentials
+
+    fields = dict(data)
+    expiry = fields.pop('expiry', None)
+    credentials = google.oauth2.credentials.Credentials(**fields)
+    if expiry is not None:
+        # In UTC, without a time zone, as google.auth has it.
+        credentials.expiry = datetime.datetime.fromisoformat(expiry)
+    return credentials
+
+
+class Worker:
+    """Claims and runs jobs from a store."""
+
+    def __init__(self, store, name=None, lease=storem.LEASE,
+                 per_user_limit=None, poll=POLL, deadline=None,
+                 phase_deadlines=None, dedup=None):
+        """Work on STORE, under NAME (unique across instances).
+
+        Claimed jobs are held for LEASE seconds between heartbeats; at
+        most PER_USER_LIMIT jobs of a user run at once.  DEADLINE and
+        PHASE_DEADLINES are as for ‘cancellation.CancelToken’.  DEDUP,
+        if not None, enables deduplication with the indexes in that
+        directory (empty for the default one)."""
+
+        self.store = store
+        self.name = name or '{}-{}-{}'.format(socket.gethostname(),
+                                              os.getpid(),
+                                              uuid.uuid4().hex[:8])
+        self.lease = lease
+        self.per_user_limit = per_user_limit
+        self.poll = poll
+        self.deadline = deadline
+        self.phase_deadlines = {phase: seconds for phase, seconds
+                                in (phase_deadlines or {}).items()
+                                if seconds is not None}
+        self.dedup = dedup
+
+
+    def run_once(self):
+        """Run the next job, if any.  Return whether there was one."""
+
+        job = self.store.claim(self.name, self.lease, self.per_user_limit)
+        if job is None:
+            return False
+
+        self._run(job)
+        return True
+
+
+    def run(self, stop=None):
+        """Run jobs until STOP (a ‘threading.Event’) is set."""
+
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            try:
+                busy = self.run_once()
+            except Exception:
+                log.exception('Worker {} failed'.format(self.name))
+                busy = False
+            if not busy:
+                stop.wait(self.poll)
+
+
+    def _token(self, user):
+        """Return a valid access token of USER, refreshing it if it
+        expired (or if it is not known when it does), or None."""
+
+        data = self.store.load_credentials(user)
+        if data is None:
+            return None
+        credentials = credentials_from_dict(data)
+        if not credentials.refresh_token \
+           or not (credentials.expired or credentials.expiry is None):
+            return credentials.token
+
+        import google.auth.exceptions
+        import google.auth.transport.requests
+        try:
+            credentials.refresh(google.auth.transport.requests.Request())
+        except google.auth.exceptions.GoogleAuthError as e:
+            log.error('Could not refresh the credentials of {}: {}'
+                      .format(user, e))
+            return None
+        self.store.save_credentials(user, credentials_to_dict(credentials))
+        return credentials.token
+
+
+    def _run(self, job):
+        token = self._token(job.user)
+        if token is None:
+            self.store.finish(job.id, self.name, 'error',
+                              'Credentials not found, please sign in again')
+            return
+
+        dedup = None
+        if self.dedup is not None:
+            dedup = dedupm.DedupIndex.for_user(
+                job.user, self.dedup or dedupm.DEFAULT_DIRECTORY)
+
+        transfer = progressm.Progress(owner=job.user)
+        cancel = cancellation.CancelToken(self.deadline,
+                                          self.phase_deadlines)
+        url = urlm.Url(job.url, token, dedup=dedup,
+                       progress=transfer, cancel=cancel,
+                       upload_url=job.upload_url,
+                       on_upload_url=lambda upload_url:
+                           self.store.save_upload_url(job.id, upload_url))
+
+        stop = threading.Event()
+        beats = threading.Thread(target=self._heartbeats,
+                                 args=(job, transfer, cancel, stop),
+                                 daemon=True)
+        beats.start()
+        try:
+            filename, basename = url.drive_it()
+            os.remove(filename)
+        except cancellation.Cancelled as e:
+            if not cancel.abandoned:
+                self.store.finish(job.id, self.name, 'error', str(e))
+        except RuntimeError as e:
+            self.store.finish(job.id, self.name, 'error', str(e))
+        except Exception:
+            log.exception('Transfer of {} failed'.format(job.url))
+            self.store.finish(job.id, self.name, 'error', 'Unexpected error')
+        else:
+            if url.reused:
+                msg = 'File "{}" was already in your Drive.'
+            else:
+                msg = 'Success! File "{}" is in your Drive now.'
+            self.store.finish(job.id, self.name, 'done',
+                              msg.format(basename))
+        finally:
+            stop.set()
+            beats.join()
+
+
+    def _heartbeats(self, job, transfer, cancel, stop):
+        """Renew the lease of JOB until STOP is set.
+
+        In between, look every CANCEL_POLL seconds for a request to
+        cancel it, so that the transfer stops promptly."""
+
+        interval = self.lease / 3
+        last_beat = time.monotonic()
+        while not stop.wait(min(CANCEL_POLL, interval)):
+            try:
+                if time.monotonic() - last_beat < interval:
+                    found = self.store.get(job.id)
+                    requested = found is not None and found.cancel_requested
+                else:
+                    last_beat = time.monotonic()
+                    snapshot = transfer.snapshot()
+                    progress = {key: snapshot[key]
+                                for key in ('phase', 'done', 'total', 'rate',
+                                            'eta')}
+                    requested = self.store.heartbeat(job.id, self.name,
+                                                     self.lease, progress)
+                if requested:
+                    cancel.cancel()
+            except storem.LeaseLost:
+                log.error('Lost the lease of job {}'.format(job.id))
+                cancel.abandon()
+                return
+            except Exception:
+                log.exception('Heartbeat of job {} failed'.format(job.id))
+
+
+def start(store, workers, **kwargs):
+    """Start WORKERS threads working on STORE.
+
+    Returns the ‘threading.Event’ that stops them."""
+
+    stop = threading.Event()
+    for _ in range(workers):
+        threading.Thread(target=Worker(store, **kwargs).run, args=(stop,),
+                         daemon=True).start()
+    return stop